@@ -170,6 +170,7 @@ BEGIN
 
     -- GENERAL REGISTERS (GRx) 
     GRx <= GR(3) when (M="11" and uPC < 15) else
+        GR(TO_INTEGER(unsigned(ADR(3 DOWNTO 0)))) when (OP = "10010" and uPC = K1) else -- MOV: AR := GR[adr]
         GR(TO_INTEGER(unsigned(GRx_num)));
     
     -- buzz_frequency_reg <= GR(14);
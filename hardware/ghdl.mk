@@ -59,5 +59,5 @@ surfer:
 	fi
 
 .PHONY: %.s
-%.s: ## Assemble, then insert into program memory
-	python $(SCRIPTDIR)/assembler.py $*.s
\ No newline at end of file
+%.s: ## Assemble and link, then insert into program memory
+	python $(SCRIPTDIR)/linker.py $*.s
\ No newline at end of file
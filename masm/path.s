@@ -207,7 +207,7 @@ monke_animation:
 
     JSR delay
 
-    BRA monke_animation ;b
+    BRA monke_animation ;b // bound: 4, GR6 steps from a monkey tile to the next multiple of 4
 
 //* Goes back 3 frames for tiletype/
 reset_anim_state:
@@ -232,7 +232,7 @@ balloon_animation:
 
     JSR delay
 
-    BRA balloon_animation ;b
+    BRA balloon_animation ;b // bound: 4, GR0 steps to the next of 29, 33, 37
 
 
 dead:
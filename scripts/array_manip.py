@@ -1,5 +1,7 @@
 import re
 
+from expression import evaluate
+
 
 def apply_constants_in_expr(expr, constants):
     """
@@ -26,7 +28,7 @@ def parse_constants(lines):
             if not groups:
                 raise ValueError(f"Invalid constant declaration: {line}")
             name, value = groups.groups()
-            value = eval(value)
+            value = evaluate(value)
 
             constants[name] = int(value)
 
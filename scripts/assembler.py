@@ -2,56 +2,134 @@
 
 """
 Parse the given argument file from monkey-assembly to binary code
+
+The assembler works in two passes over the preassembled lines:
+1. expand macros and sections and give every instruction and data word
+   its address, immediate operands taking a word of their own. This
+   fills the symbol table with the addresses of all labels, in any section.
+2. encode every instruction and data word, labels can be used wherever
+   an address or a value is expected, e.g. `BNE loop`, `LDI GR1, table`
+   or a data word `table+2`.
+
+The elements of the pMem array are then written to hardware/pMem.vhd in
+one go, each with its assembly line (and labels) as comment.
+
+Other output formats leave pMem.vhd as it is, so that a program can be
+swapped without touching the VHDL:
+- bin: raw image of little-endian 32-bit words from address 0, which the
+  emulator and binary_machine.py load directly
+- mem: one binary word per line with `@address` lines for every section,
+  for $readmemb and Vivado
+- coe: Xilinx memory initialization file (radix 2)
+- pkg: VHDL package `pMem_init` with `p_mem_type`, the section constants
+  and the constant `P_MEM_INIT`, for a pMem.vhd that imports it with
+  `USE work.pMem_init.ALL;` and `SIGNAL p_mem : p_mem_type := P_MEM_INIT;`
+Don't care bits are written as 0, except in the package.
+
+    python assembler.py <file.s> [--format vhd|bin|mem|coe|pkg] [--output <file>]
+        [--optimize] [--dce [--export <label> ...]]
+
+With --optimize the preassembled lines go through the peephole optimizer
+(see peephole.py) first, which prints what it saved. With --dce routines
+that cannot be reached from the entry or an exported label are removed
+before the layout (see dce.py).
 """
 
 # standard imports
 import re, sys, os
+import itertools
 from pathlib import Path
+import numpy as np
 
 # add parent dir to path, to be able to import modules
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 
 # custom imports
-from section import Section, use_sections
+from section import Section
 from utils import ERROR
 from preassemble import preassemble
 import utils
 import array_manip as am
-from macros import use_macros
-from instruction_decoding import parse_operation, parse_register_and_address
-
-KNOWN_OPCODES = utils.get_mnemonics()
+from expression import evaluate as evaluate_expression
+from masm_ir import ParsedProgram, ParsedLine, decode_instruction, parse_statement
+from peephole import optimize, print_report
+from dce import eliminate, print_report as print_dead_code_report
+from instruction_decoding import REG_REG_OPS
 
 MASM_DIR = "masm"
 HARDWARE_DIR = "hardware"
 PMEM_FILE = os.path.join(HARDWARE_DIR, "pMem.vhd")
 FAX_FILE = os.path.join(HARDWARE_DIR, "fax.md")
+PMEM_ARRAY_PATTERN = r".*:.*p_mem_type.*:=.*"
+PMEM_HEIGHT = 4096
+
+# output format -> default output file
+OUTPUT_FILES = {
+    "vhd": PMEM_FILE,
+    "bin": os.path.join(HARDWARE_DIR, "pMem.bin"),
+    "mem": os.path.join(HARDWARE_DIR, "pMem.mem"),
+    "coe": os.path.join(HARDWARE_DIR, "pMem.coe"),
+    "pkg": os.path.join(HARDWARE_DIR, "pMem_init.vhd"),
+}
 
 ADR_WIDTH = 12
 DEBUG_ARG = "path.s"
 
 INSTRUCTION_WIDTH = 24
 
+# address mode suffix of a mnemonic -> M field
+ADDRESS_MODES = {"": "00", "I": "01", "X": "10", "N": "11"}
+
+# labels, and sections and macros left for the linker (see linker.py)
+SYMBOL_PATTERN = re.compile(r"%?\b[A-Za-z_]\w*\b")
+
+
+class Statement:
+    """
+    Represent an instruction or data word at its address, found in pass 1
+    """
+
+    def __init__(self, section: Section, offset: int, parsed: ParsedLine, labels: list):
+        self.section = section
+        self.offset = offset  # in the section
+        self.parsed = parsed
+        self.line = parsed.expanded
+        self.labels = labels  # labels of its address
+        self.is_code = parsed.kind == "instruction"
+
+
+def resolve_labels(expr: str, labels: dict) -> str:
+    """
+    Replace all labels in the expression `expr` with their addresses
+    """
+
+    def get_address(match):
+        label = match.group(0)
+        if label not in labels:
+            ERROR(f"Unknown label {label} in `{expr}`")
+        return str(labels[label])
+
+    return SYMBOL_PATTERN.sub(get_address, expr)
 
-def parse_address_mode(addr: str, mode: str):
+
+def evaluate(expr: str, labels: dict) -> int:
+    return evaluate_expression(resolve_labels(expr, labels))
+
+
+def parse_address_mode(addr: str, mode: str, labels: dict):
     """
     Parse the address mode and address from the given address and mode
 
     Args:
-        addr (str): The address to be parsed.
+        addr (str): The address to be parsed, may use labels.
         mode (str): The mode to be parsed.
+        labels (dict): The symbol table, label -> address.
 
     Returns:
         tuple: A tuple containing the binary address mode,
         the binary address, and the immediate value.
     """
 
-    # address is label?
-    if re.match(r"[A-z]+", addr):
-        mode_bin = "00"
-        addr_bin = "?" * ADR_WIDTH  # value will be filled in later
-        return mode_bin, addr_bin, ""
-
     mode_bin = "--"  # assume don't care for mode
     addr_bin = "-" * ADR_WIDTH  # assume don't care for address
     immediate_value = ""  # assume no immediate value
@@ -59,21 +137,17 @@ def parse_address_mode(addr: str, mode: str):
     if addr == "-":
         return mode_bin, addr_bin, immediate_value
 
-    addr = utils.evaluate_expr(addr)
-    if mode == "":  # direct
-        mode_bin = "00"
-        addr_bin = f"{int(addr):0{ADR_WIDTH}b}"
-    elif mode == "I":  # immediate
-        mode_bin = "01"
-        immediate_value = f"{int(addr):0{INSTRUCTION_WIDTH}b}"
-    elif mode == "X":  # indirect
-        mode_bin = "10"
-        addr_bin = f"{int(addr):0{ADR_WIDTH}b}"
-    elif mode == "N":  # indexed
-        mode_bin = "11"
-        addr_bin = f"{int(addr):0{ADR_WIDTH}b}"
-    else:
+    if mode not in ADDRESS_MODES:
         ERROR(f"Unknown address mode {mode}")
+    mode_bin = ADDRESS_MODES[mode]
+
+    value = evaluate(addr, labels)
+    if mode == "I":  # immediate
+        immediate_value = f"{value & (2**INSTRUCTION_WIDTH - 1):0{INSTRUCTION_WIDTH}b}"
+    else:  # direct, indirect or indexed
+        if not 0 <= value < 2**ADR_WIDTH:
+            ERROR(f"Address {addr} = {value} does not fit in {ADR_WIDTH} bits")
+        addr_bin = f"{value:0{ADR_WIDTH}b}"
 
     return mode_bin, addr_bin, immediate_value
 
@@ -93,34 +167,65 @@ def parse_register(grx_name):
     return grx_bin
 
 
-def assemble_binary_line(instruction_line: str, label: str) -> list:
+def is_instruction(line: str) -> bool:
+    """
+    Return True if `line` is an instruction, not a data word
+    (which may start with a label)
     """
-    Assemble a binary line from the given instruction line and label.
 
-    Args:
-        instruction_line (str): The instruction line to be assembled.
-        label (str): The label associated with the instruction line.
+    return decode_instruction(line.strip(), tuple(utils.get_mnemonics())) is not None
 
-    Returns:
-        list: A list of tuples, each containing a binary line and its corresponding assembly instruction.
+
+def get_size(instruction_line: str) -> int:
+    """
+    Return the number of words of an instruction, 2 with an immediate operand
     """
 
-    # Initialize the list to hold the binary lines
-    binary_lines = []
+    return parse_instruction(instruction_line).size
 
-    # Split the instruction line into parts
-    instruction_parts = re.split(r",\s*|\s+", instruction_line)
 
-    # Parse the operation and its address mode from the instruction parts
-    mnemonic, address_mode = parse_operation(instruction_parts)
+def parse_instruction(instruction_line: str) -> ParsedLine:
+    parsed = parse_statement(instruction_line, instruction_line.strip(), tuple(utils.get_mnemonics()))
+    if parsed.kind != "instruction":
+        ERROR(f"Unknown operation in `{instruction_line.strip()}`")
+    return parsed
 
-    # Parse the register and address from the operation
-    register, address = parse_register_and_address(mnemonic, instruction_parts)
+
+def assemble_binary_line(instruction_line: str, labels: dict) -> list:
+    """
+    Assemble the given instruction line, see `assemble_instruction`
+    """
+
+    return assemble_instruction(parse_instruction(instruction_line), labels)
+
+
+def assemble_instruction(parsed: ParsedLine, labels: dict) -> list:
+    """
+    Assemble the given parsed instruction.
+
+    Args:
+        parsed (ParsedLine): The instruction to be assembled.
+        labels (dict): The symbol table, label -> address.
+
+    Returns:
+        list: The binary words of the instruction, the second one is its
+        immediate value if it has one.
+    """
+
+    if parsed.error:
+        ERROR(parsed.error)
+
+    mnemonic, address_mode = parsed.mnemonic, parsed.mode
+    register, address = parsed.register, parsed.operand
 
     # Parse the address mode code, binary address, and immediate value from the address and address mode
-    address_mode_code, binary_address, immediate_value = parse_address_mode(
-        address, address_mode
-    )
+    if mnemonic in REG_REG_OPS:  # e.g. MOV, the source register in ADR
+        address_mode_code, immediate_value = ADDRESS_MODES[address_mode], ""
+        binary_address = f"{int(parse_register(address), 2):0{ADR_WIDTH}b}"
+    else:
+        address_mode_code, binary_address, immediate_value = parse_address_mode(
+            address, address_mode, labels
+        )
 
     # Parse the binary representation of the register
     binary_register = parse_register(register)
@@ -131,18 +236,31 @@ def assemble_binary_line(instruction_line: str, label: str) -> list:
         key = "1"
 
     # Assemble the binary line
-    binary_instruction = f"{KNOWN_OPCODES[mnemonic]}_{binary_register}_{address_mode_code}_{key}_{binary_address}"
-
-    # Add the binary line and its corresponding assembly instruction to the list of binary lines
-    binary_lines += [(binary_instruction, instruction_line.strip(), label)]
+    binary_lines = [
+        f"{utils.get_mnemonics()[mnemonic]}_{binary_register}_{address_mode_code}_{key}_{binary_address}"
+    ]
 
     # If there's an immediate value, add it as a separate binary line
     if immediate_value:
-        binary_lines += [(immediate_value, "", "")]
+        binary_lines.append(immediate_value)
 
     return binary_lines
 
 
+def assemble_data(line: str, labels: dict):
+    """
+    Return the binary word and the value of the given data line
+    """
+
+    # parse the value
+    decimal_data = evaluate(line, labels)
+
+    # convert to binary
+    binary_data = f"{decimal_data & (2**INSTRUCTION_WIDTH - 1):0{INSTRUCTION_WIDTH}b}"
+
+    return binary_data, decimal_data
+
+
 def read_lines(filename):
     """
     Return the lines from the given file
@@ -163,8 +281,12 @@ def get_arg():
     """
     Get the filename argument
     """
-    if len(sys.argv) != 2:
-        print("Usage: python3 assembler.py <filename>")
+    if len(sys.argv) < 2 or sys.argv[1].startswith("--") and sys.argv[1] != "--debug":
+        print(
+            "Usage: python3 assembler.py <filename> "
+            "[--format vhd|bin|mem|coe|pkg] [--output <file>] [--optimize] "
+            "[--dce [--export <label> ...]]"
+        )
         sys.exit(1)
 
     arg = sys.argv[1]
@@ -175,158 +297,251 @@ def get_arg():
     return sys.argv[1]
 
 
-def assemble_data(line):
+def first_pass(asm_lines: list) -> tuple:
     """
-    Return binary lines from the given data line
+    Parse the lines (see masm_ir.py), which expands macros and sections,
+    and find the address of every statement and label. Return the
+    sections, the symbol table (label -> address) and the statements.
     """
 
-    # parse the value
-    decimal_data = utils.evaluate_expr(line)
+    parsed_program = ParsedProgram(asm_lines)
+    sections = parsed_program.sections
 
-    # convert to binary
-    binary_data = f"{int(decimal_data):0{INSTRUCTION_WIDTH}b}"
+    labels = {}
+    statements = []
+    sizes = {name: 0 for name in sections}  # words in every section so far
 
-    return (binary_data, decimal_data, "")
+    current_section = None
+    new_labels = []  # labels of the next statement
+    for parsed in parsed_program.lines:
+        if parsed.kind == "macro":
+            continue
+        elif parsed.kind == "section":
+            current_section = sections[parsed.name]
+            new_labels = []
+            continue
+        elif parsed.kind == "include":
+            ERROR(f"{parsed.get_where()}Unresolved include <{parsed.name}>")
 
+        if current_section is None:
+            ERROR(f"{parsed.get_where()}`{parsed.line.strip()}` is not in any section")
 
+        offset = sizes[current_section.name]
 
-def main():
+        if parsed.kind == "label":
+            if parsed.name in labels:
+                ERROR(f"{parsed.get_where()}Label {parsed.name} is defined more than once")
+            labels[parsed.name] = current_section.start + offset
+            new_labels.append(parsed.name)
+            continue
 
-    # begin by changing dir to root of file
-    utils.change_dir_to_root()
+        statements.append(Statement(current_section, offset, parsed, new_labels))
+        sizes[current_section.name] += parsed.size
+        new_labels = []
 
-    # find the file containing assembly code
-    asm_file_name = get_arg()
+    return sections, labels, statements
 
-    # preassemble
-    asm_lines = preassemble(asm_file_name)
 
-    current_section_name = ""
-    new_label = ""
-    sections = {}
+def second_pass(sections: dict, labels: dict, statements: list) -> dict:
+    """
+    Encode all statements. Return section name -> list of
+    (binary word, comment) in address order.
+    """
 
-    # find all sections beforehand
-    for i, line in enumerate(asm_lines):
-        if line.startswith("%"):  # section
-            this_section = Section(line)
-            sections[this_section.name] = this_section
+    words = {name: [] for name in sections}
 
-    macros = {}
+    for statement in statements:
+        label_string = "".join(f"{label} : " for label in statement.labels)
 
-    # assemble the binary code
-    for i, line in enumerate(asm_lines):
-        if line.startswith("_"):  # macro definition
-            macro_name, macro_value = line.replace(" ", "").strip().split("=")
-            macros[macro_name] = macro_value
-            continue
-        elif line.startswith("%"):  # section declaration
-            current_section_name = line.split()[0].replace("%", "")
-            continue  # already handled
+        try:
+            if statement.is_code:
+                binary_lines = assemble_instruction(statement.parsed, labels)
+                comments = [f"{label_string}{statement.line}"] + [""] * (len(binary_lines) - 1)
+            else:
+                binary_data, decimal_data = assemble_data(statement.parsed.value, labels)
+                binary_lines = [binary_data]
+                comments = [f"{label_string}{decimal_data}"]
+        except Exception as e:
+            if statement.parsed.location is None:
+                raise
+            ERROR(f"{statement.parsed.location}: {e}")
 
-        # macro usage
-        line = use_macros(line, macros)
+        words[statement.section.name] += zip(binary_lines, comments)
 
-        # section usage
-        line = use_sections(line, sections)
+    return words
 
-        if line.endswith(":\n"):  # label
-            new_label = line.strip()[:-1]  # remove the colon
-            continue
 
-        if re.match(r"\s*[A-z]+.*", line):  # code
-            new_line = assemble_binary_line(
-                instruction_line=line.strip(), label=new_label
-            )
-            new_label = ""  # reset label
-        else:  # data
-            new_line = [assemble_data(line=line.strip())]
+def get_element_lines(sections: dict, words: dict):
+    """
+    Yield the lines of the pMem array elements, every section
+    beginning with a comment line
+    """
+
+    for section_name, this_section in sections.items():
+        yield f"        -- {section_name}\n"
+        for i, (binary_line, comment) in enumerate(words[section_name]):
+            yield f'        {this_section.name}+{i} => b"{binary_line}", -- {comment}\n'
 
-        sections[current_section_name].lines += new_line
 
-    # read the program memory file
+def write_pmem(sections: dict, words: dict, pmem_file: str = PMEM_FILE):
+    """
+    Write hardware/pMem.vhd with the elements of the pMem array replaced by
+    `words` to `pmem_file`
+    """
+
     mem_lines = read_lines(PMEM_FILE)
 
-    array_lines = am.extract_vhdl_array(
-        lines=mem_lines, array_start_pattern=r".*:.*p_mem_type.*:=.*"
+    mem_start, mem_end = am.find_array_start_end_index(
+        lines=mem_lines, array_start_pattern=PMEM_ARRAY_PATTERN
     )
 
-    cleared_array_lines = [array_lines[0]] + array_lines[-2:]
+    # keep the declaration, `OTHERS` and the end of the array
+    with open(pmem_file, "w") as f:
+        f.writelines(
+            itertools.chain(
+                mem_lines[: mem_start + 1],
+                get_element_lines(sections, words),
+                mem_lines[mem_end - 1 :],
+            )
+        )
 
-    # add the sections to the cleared array
-    for section_name, this_section in sections.items():
-        cleared_array_lines.insert(-2, f"        -- {section_name}\n")
-        for i, line in enumerate(this_section.lines):
-            binary_line, full_comment, label = line
-            if binary_line == "":
-                continue
-            if not re.match(r"\d+.*", binary_line):
-                ERROR(f"Invalid binary line {binary_line}")
 
-            label_string = f"{label} : " if label else ""
-            new_array_line = f'        {this_section.name}+{i} => b"{binary_line}", -- {label_string}{full_comment}\n'
+def get_image(sections: dict, words: dict) -> list:
+    """
+    Return the words as 24-bit values from address 0 up to the last one
+    used, don't care bits and unused addresses are 0
+    """
+
+    addresses = {
+        this_section.start + i: int(binary_line.replace("_", "").replace("-", "0"), 2)
+        for section_name, this_section in sections.items()
+        for i, (binary_line, _) in enumerate(words[section_name])
+    }
+    if not addresses:
+        return []
+    if max(addresses) >= PMEM_HEIGHT:
+        ERROR(f"Address {max(addresses)} is outside of pMem (0 to {PMEM_HEIGHT - 1})")
+
+    image = [0] * (max(addresses) + 1)
+    for address, value in addresses.items():
+        image[address] = value
 
-            cleared_array_lines.insert(-2, new_array_line)
+    return image
 
-    # find all label start addresses
-    labels = {}  # dictionary of label -> start address
-    for i, line in enumerate(cleared_array_lines):
-        if not re.match(r".*=>.*\n", line):
-            continue  # not an element
-        if not "PROGRAM" in line:
-            break  # end of program memory
 
-        element_index = int(re.search(r"PROGRAM\+(\d+)", line).group(1))
+def write_binary(sections: dict, words: dict, file_name: str):
+    np.array(get_image(sections, words), dtype="<u4").tofile(file_name)
 
-        label_match = re.search(r".*--\s*(\w+)\s*:.*", line)
 
-        if not label_match:
-            continue  # no label
+def write_mem(sections: dict, words: dict, file_name: str):
+    """
+    Write every section as an `@address` line (hexadecimal) and its words
+    """
 
-        label = label_match.group(1)
+    with open(file_name, "w") as f:
+        for section_name, this_section in sections.items():
+            f.write(f"// {section_name}\n@{this_section.start:x}\n")
+            for binary_line, comment in words[section_name]:
+                value = binary_line.replace("_", "").replace("-", "0")
+                f.write(f"{value} // {comment}\n" if comment else f"{value}\n")
 
-        labels[label] = element_index  # save the start address of the label
 
-    # fix unknown addresses in the binary code
-    for i, line in enumerate(cleared_array_lines):
-        if "?" * 12 not in line:
-            continue  # not an unknown address
+def write_coe(sections: dict, words: dict, file_name: str):
+    image = get_image(sections, words)
+    vector = ",\n".join(f"{value:0{INSTRUCTION_WIDTH}b}" for value in image)
 
-        full_comment = re.search(r".*--\s*(.+)\n", line)
+    with open(file_name, "w") as f:
+        f.write(f"; pMem, {len(image)} words of {INSTRUCTION_WIDTH} bits\n")
+        f.write("memory_initialization_radix=2;\n")
+        f.write(f"memory_initialization_vector=\n{vector};\n")
 
-        if not full_comment:
-            utils.ERROR(
-                f"Cant resolve symbolic address in line {i + 1} in {PMEM_FILE}, no comment found"
+
+def write_package(sections: dict, words: dict, file_name: str):
+    """
+    Write a VHDL package holding the initial value of `p_mem`
+    """
+
+    with open(file_name, "w") as f:
+        f.writelines(
+            itertools.chain(
+                [
+                    "LIBRARY IEEE;\n",
+                    "USE IEEE.STD_LOGIC_1164.ALL;\n",
+                    "\n",
+                    "PACKAGE pMem_init IS\n",
+                    f"    TYPE p_mem_type IS ARRAY(0 TO {PMEM_HEIGHT - 1}) "
+                    f"OF STD_LOGIC_VECTOR({INSTRUCTION_WIDTH - 1} DOWNTO 0);\n",
+                    "\n",
+                ],
+                (
+                    f"    CONSTANT {name} : INTEGER := {this_section.start};\n"
+                    for name, this_section in sections.items()
+                ),
+                ["\n", "    CONSTANT P_MEM_INIT : p_mem_type := (\n"],
+                get_element_lines(sections, words),
+                ["        OTHERS => (OTHERS => '-')\n", "    );\n", "END PACKAGE pMem_init;\n"],
             )
+        )
+
 
-        full_comment_parts = full_comment.group(1).split(":")
+def write_output(sections: dict, words: dict, output_format: str = "vhd", file_name: str = None):
+    """
+    Write the words in `output_format` (see OUTPUT_FILES) to `file_name`,
+    by default the file of the format in hardware/
+    """
 
-        comment = full_comment_parts[-1].strip()
+    writers = {
+        "vhd": write_pmem,
+        "bin": write_binary,
+        "mem": write_mem,
+        "coe": write_coe,
+        "pkg": write_package,
+    }
+    if output_format not in writers:
+        ERROR(f"Unknown output format {output_format}, use one of {', '.join(writers)}")
 
-        # get label from the BRANCH instruction
-        seeked_label = comment.split()[1].strip()
+    writers[output_format](sections, words, file_name or OUTPUT_FILES[output_format])
 
-        if seeked_label not in labels:
-            ERROR(f"Label {seeked_label} not found in labels")
 
-        # replace the unknown address with the found address
-        jump_address = labels[seeked_label]
+def assemble(asm_lines: list) -> tuple:
+    """
+    Assemble preassembled lines, return the sections, the symbol table
+    and the binary words of every section (see `second_pass`)
+    """
 
-        if jump_address > 2**ADR_WIDTH:
-            ERROR(f"Jump address {jump_address} is too large")
-        elif jump_address < 0:
-            ERROR(f"Jump address {jump_address} is negative")
+    sections, labels, statements = first_pass(asm_lines)
+    words = second_pass(sections, labels, statements)
 
-        cleared_array_lines[i] = re.sub(r"\?+", f"{jump_address:0{ADR_WIDTH}b}", line)
+    return sections, labels, words
 
-    mem_start, mem_end = am.find_array_start_end_index(
-        lines=mem_lines, array_start_pattern=r".*:.*p_mem_type.*:=.*"
-    )
 
-    # clear the old program memory array
-    mem_lines[mem_start : mem_end + 1] = cleared_array_lines
+def main():
 
-    # write the new program memory file
-    open(PMEM_FILE, "w").writelines(mem_lines)
+    # begin by changing dir to root of file
+    utils.change_dir_to_root()
+
+    # find the file containing assembly code
+    asm_file_name = get_arg()
+
+    # preassemble
+    asm_lines = preassemble(asm_file_name)
+
+    if "--optimize" in sys.argv:
+        asm_lines, report = optimize(asm_lines)
+        print_report(asm_file_name, report)
+
+    if "--dce" in sys.argv:
+        asm_lines, report = eliminate(asm_lines, utils.get_arg_values(sys.argv, "--export"))
+        print_dead_code_report(asm_file_name, report)
+
+    sections, labels, words = assemble(asm_lines)
+
+    write_output(
+        sections,
+        words,
+        utils.get_arg_value(sys.argv, "--format", "vhd"),
+        utils.get_arg_value(sys.argv, "--output"),
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""
+Run many emulations at once over a process pool.
+
+Jobs are the combinations of programs, input scripts and swept memory
+values. Every worker process parses a program once and creates a fresh
+machine from the loaded program for every job on it.
+Final registers, flags, instruction and cycle counts (see cycle_model.py),
+a digest of the memory and errors of all jobs are collected into one
+results table.
+
+Usage: python batch.py [program.s ...] [--inputs <script.txt>]...
+       [--sweep <address>=<v1>,<v2>,...]... [--override-at <label|count>]
+       [--max-instructions N] [--workers N] [--out results.csv] [--vectorized]
+       [--no-cache]
+
+<address> may use macros and sections of the program, e.g.
+    python batch.py path.s --inputs masm/inputs/path_first_round.txt \\
+        --sweep _playergolddigit1=0,5,9 --sweep _playerhpdigit2=1,9 \\
+        --override-at push_balloon_hp
+Swept values are written when the machine first reaches `--override-at`
+(a label or an instruction count, default 0).
+
+With `--vectorized` all jobs of a program run in lockstep in one
+VectorMachine (see vector_machine.py) instead of one machine per job, with
+the same results. A lockstep step costs about as much as 20 instructions
+of one machine, so it pays off from a few dozen jobs of a program on, for
+hundreds or thousands of input scripts or swept values.
+
+Results are kept in the content-addressed cache of result_cache.py, so
+jobs that were run before with the same program, inputs, swept values and
+instruction limit are not run again. `--no-cache` runs every job.
+"""
+
+import csv, hashlib, itertools, os, sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import utils
+from machine import Machine
+from program import Program
+from vector_machine import VectorMachine
+from input_script import read_input_script
+from result_cache import ResultCache, get_key
+from cycle_model import get_cycle_table
+
+DEFAULT_MAX_INSTRUCTIONS = 100000
+REGISTER_NAMES = [f"GR{i}" for i in range(16)] + ["PC", "SP"]
+FLAG_NAMES = ["Z", "N", "C", "V"]
+RESULT_COLUMNS = (
+    ["program", "inputs", "overrides", "instructions", "cycles", "halted", "error"]
+    + REGISTER_NAMES
+    + FLAG_NAMES
+    + ["memory_sha1"]
+)
+TABLE_COLUMNS = [
+    "program",
+    "inputs",
+    "overrides",
+    "instructions",
+    "cycles",
+    "halted",
+    "PC",
+    "error",
+]
+JOB_COLUMNS = ["program", "inputs", "overrides"]  # not part of cached results
+
+# program file name -> loaded Program, per worker process
+_programs = {}
+
+
+def get_machine(program: str) -> Machine:
+    """
+    Return a fresh machine for `program`, parsing the program
+    only the first time it is asked for in this process.
+    """
+
+    if program not in _programs:
+        _programs[program] = Program.from_file(program)
+
+    machine = Machine.from_program(_programs[program])
+    machine.verbose = False
+
+    return machine
+
+
+def get_memory_digest(memory: list) -> str:
+    return hashlib.sha1("\n".join(str(word) for word in memory).encode()).hexdigest()
+
+
+def run_until(machine: Machine, override_at, max_instructions: int):
+    """
+    Run until the label or instruction count `override_at` is reached
+    """
+
+    if isinstance(override_at, int):
+        machine.run(min(override_at, max_instructions) - machine.instruction_count)
+        return
+
+    if override_at not in machine.labels:
+        utils.ERROR(f"Unknown label {override_at}")
+    target_pc = machine.labels[override_at]
+
+    while (
+        machine.registers["PC"] != target_pc
+        and not machine.halted
+        and machine.instruction_count < max_instructions
+    ):
+        machine.execute_next_instruction()
+
+
+def run_job(job: dict) -> dict:
+    """
+    Run a single job, return its row of the results table
+    """
+
+    row = get_job_row(job)
+
+    machine = None
+    try:
+        machine = get_machine(job["program"])
+        machine.schedule_inputs(job["input_events"])
+
+        if job["overrides"]:
+            run_until(machine, job["override_at"], job["max_instructions"])
+            for address_expr, value in job["overrides"].items():
+                machine.set_memory(machine.get_address(address_expr), value)
+
+        machine.run(job["max_instructions"] - machine.instruction_count)
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+
+    if machine is None:
+        return row  # program could not be loaded
+
+    row["instructions"] = machine.instruction_count
+    row["cycles"] = machine.cycle_count
+    row["halted"] = machine.halted
+    row.update(machine.registers)
+    row.update(machine.flags)
+    row["memory_sha1"] = get_memory_digest(machine.memory)
+
+    return row
+
+
+def get_job_row(job: dict) -> dict:
+    return {
+        "program": job["program"],
+        "inputs": job["inputs"] or "",
+        "overrides": " ".join(f"{k}={v}" for k, v in job["overrides"].items()),
+        "error": "",
+    }
+
+
+def run_jobs_vectorized(program: str, jobs: list) -> list:
+    """
+    Run all `jobs` of `program` in lockstep in one VectorMachine.
+    Return their rows of the results table, the same as `run_job` gives.
+    """
+
+    rows = [get_job_row(job) for job in jobs]
+
+    try:
+        vm = VectorMachine(Program.from_file(program), len(jobs))
+    except Exception as e:
+        for row in rows:
+            row["error"] = f"{type(e).__name__}: {e}"
+        return rows
+
+    vm.schedule_inputs([job["input_events"] for job in jobs])
+
+    # jobs of one run share these
+    max_instructions = jobs[0]["max_instructions"]
+    override_at = jobs[0]["override_at"]
+
+    pending = np.array([bool(job["overrides"]) for job in jobs])
+
+    def apply_overrides(indices):
+        for i in indices:
+            try:
+                for address_expr, value in jobs[i]["overrides"].items():
+                    vm.set_memory(vm.get_address(address_expr), value, [i])
+            except Exception as e:
+                vm.fail([i], f"{type(e).__name__}: {e}")  # like `run_job`
+        pending[indices] = False
+
+    # like `run_job`: up to an instruction count override_at machines run
+    # (and skip loops) until it, up to a label they step without skipping
+    max_counts = np.full(len(jobs), max_instructions, dtype=np.int64)
+    override_counts = np.full(len(jobs), max_instructions, dtype=np.int64)
+    if isinstance(override_at, int):
+        override_counts[:] = min(override_at, max_instructions)
+
+    error = ""
+    try:
+        if pending.any() and isinstance(override_at, str):
+            if override_at not in vm.labels:
+                utils.ERROR(f"Unknown label {override_at}")
+            target_pc = vm.labels[override_at]
+
+        while True:
+            skipping = None
+            pending &= ~vm.failed  # stopped before the overrides, as in `run_job`
+            if pending.any():
+                if isinstance(override_at, int):
+                    reached = vm.instruction_count >= override_at
+                else:
+                    reached = vm.registers[:, 16] == target_pc
+                apply_overrides(np.flatnonzero(pending & (reached | vm.halted)))
+                max_counts = np.where(pending, override_counts, max_instructions)
+                if isinstance(override_at, str):
+                    skipping = ~pending
+
+            if not vm.step(max_counts, skipping):
+                break
+
+        # like `run_until`, overrides are written even if never reached
+        apply_overrides(np.flatnonzero(pending & ~vm.failed))
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    for i, row in enumerate(rows):
+        row["error"] = error or vm.errors[i] or ""
+        row["instructions"] = int(vm.instruction_count[i])
+        row["cycles"] = int(vm.cycle_count[i])
+        row["halted"] = bool(vm.halted[i])
+        row.update(vm.get_registers(i))
+        row.update(vm.get_flags(i))
+        row["memory_sha1"] = get_memory_digest(vm.get_memory_words(i))
+
+    return rows
+
+
+def parse_sweep(sweep_arg: str) -> tuple:
+    """
+    Parse `<address>=<v1>,<v2>,...`, return (address, [values])
+    """
+
+    if "=" not in sweep_arg:
+        utils.ERROR(f"Sweep must look like <address>=<v1>,<v2>,..., got {sweep_arg}")
+
+    address_expr, values = sweep_arg.split("=", 1)
+    return address_expr, [utils.get_decimal_int(v) for v in values.split(",")]
+
+
+def make_jobs(programs, input_scripts, sweeps, override_at, max_instructions) -> list:
+    """
+    Return one job per combination of program, input script and swept values
+    """
+
+    input_events = {
+        script: read_input_script(script) if script else []
+        for script in input_scripts
+    }
+    sweep_names = [name for name, _ in sweeps]
+    sweep_products = list(itertools.product(*[values for _, values in sweeps]))
+
+    jobs = []
+    for program, script, values in itertools.product(
+        programs, input_scripts, sweep_products
+    ):
+        jobs.append(
+            {
+                "program": program,
+                "inputs": script,
+                "input_events": input_events[script],
+                "overrides": dict(zip(sweep_names, values)),
+                "override_at": override_at,
+                "max_instructions": max_instructions,
+            }
+        )
+
+    return jobs
+
+
+def run_jobs(jobs: list, workers: int = None) -> list:
+    """
+    Run all jobs over a process pool, return the rows of the results table
+    in the order of `jobs`.
+    """
+
+    workers = workers or os.cpu_count()
+    # big chunks keep jobs of the same program in the same worker
+    chunksize = max(1, len(jobs) // (workers * 4))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_job, jobs, chunksize=chunksize))
+
+
+def run_all_vectorized(jobs: list, workers: int = None) -> list:
+    """
+    Run the jobs of every program in one VectorMachine, programs in
+    parallel. Return the rows of the results table in the order of `jobs`.
+    """
+
+    programs = list(dict.fromkeys(job["program"] for job in jobs))
+    jobs_per_program = [[job for job in jobs if job["program"] == p] for p in programs]
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        rows_per_program = dict(
+            zip(programs, executor.map(run_jobs_vectorized, programs, jobs_per_program))
+        )
+
+    rows_left = {p: iter(rows) for p, rows in rows_per_program.items()}
+    return [next(rows_left[job["program"]]) for job in jobs]
+
+
+def get_job_key(job: dict, program: Program, vectorized: bool) -> str:
+    # the engines word some errors differently, cycles follow the microcode
+    return get_key(
+        program,
+        job["input_events"],
+        job["max_instructions"],
+        extra={
+            "overrides": job["overrides"],
+            "override_at": job["override_at"],
+            "vectorized": vectorized,
+            "cycle_table": get_cycle_table().digest,
+        },
+    )
+
+
+def run_jobs_cached(jobs: list, workers: int = None, vectorized: bool = False) -> list:
+    """
+    Like `run_jobs` (or `run_all_vectorized`), but take the rows of jobs
+    that were run before from the result cache and only run the others
+    """
+
+    cache = ResultCache()
+    rows = [None] * len(jobs)
+    keys = [None] * len(jobs)
+
+    programs = {}
+    for i, job in enumerate(jobs):
+        if job["program"] not in programs:
+            try:
+                programs[job["program"]] = Program.from_file(job["program"])
+            except Exception:
+                programs[job["program"]] = None  # reported by the run
+        if programs[job["program"]] is None:
+            continue
+
+        keys[i] = get_job_key(job, programs[job["program"]], vectorized)
+        result = cache.get(keys[i])
+        if result is not None:
+            rows[i] = get_job_row(job) | result
+
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        missing_jobs = [jobs[i] for i in missing]
+        if vectorized:
+            new_rows = run_all_vectorized(missing_jobs, workers)
+        else:
+            new_rows = run_jobs(missing_jobs, workers)
+
+        for i, row in zip(missing, new_rows):
+            rows[i] = row
+            if keys[i] is not None:
+                result = {k: v for k, v in row.items() if k not in JOB_COLUMNS}
+                cache.put(keys[i], result)
+        cache.evict()
+
+    print(f"{cache.hits} of {len(jobs)} results from the cache")
+
+    return rows
+
+
+def print_table(rows: list):
+    """
+    Print the most important columns of the results table
+    """
+
+    widths = {
+        column: max([len(column)] + [len(str(row.get(column, ""))[:60]) for row in rows])
+        for column in TABLE_COLUMNS
+    }
+
+    print("  ".join(f"{column:{widths[column]}}" for column in TABLE_COLUMNS))
+    for row in rows:
+        print(
+            "  ".join(
+                f"{str(row.get(column, ''))[:60]:{widths[column]}}"
+                for column in TABLE_COLUMNS
+            )
+        )
+
+
+def write_csv(file_name: str, rows: list):
+    with open(file_name, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    utils.change_dir_to_root()
+
+    programs = [arg for arg in sys.argv[1:] if arg.endswith(".s")] or utils.get_programs(
+        "masm"
+    )
+    input_scripts = utils.get_arg_values(sys.argv, "--inputs") or [None]
+    sweeps = [parse_sweep(arg) for arg in utils.get_arg_values(sys.argv, "--sweep")]
+
+    override_at = utils.get_arg_value(sys.argv, "--override-at", 0)
+    if isinstance(override_at, str) and override_at.isdigit():
+        override_at = int(override_at)
+
+    max_instructions = int(
+        utils.get_arg_value(sys.argv, "--max-instructions", DEFAULT_MAX_INSTRUCTIONS)
+    )
+    workers = int(utils.get_arg_value(sys.argv, "--workers", os.cpu_count()))
+    out_file = utils.get_arg_value(sys.argv, "--out")
+
+    jobs = make_jobs(programs, input_scripts, sweeps, override_at, max_instructions)
+    if "--no-cache" not in sys.argv:
+        rows = run_jobs_cached(jobs, workers, "--vectorized" in sys.argv)
+    elif "--vectorized" in sys.argv:
+        rows = run_all_vectorized(jobs, workers)
+    else:
+        rows = run_jobs(jobs, workers)
+
+    print_table(rows)
+    if out_file:
+        write_csv(out_file, rows)
+        print(f"Wrote {len(rows)} results to {out_file}")
+
+
+if __name__ == "__main__":
+    main()
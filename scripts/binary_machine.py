@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+"""
+Instruction-level engine running the assembled machine code, the 24-bit
+words of pMem.vhd that the FPGA runs, instead of the assembly text lines
+interpreted by machine.py.
+
+The two differ: in pMem immediates are the word after the instruction
+(LDI takes two words), labels are numeric addresses, and registers, modes
+and addresses are bit fields:
+
+    OP(23..19) GRx(18..15) M(14..13) KEY(12) ADR(11..0)
+
+Fields are decoded with lookup tables indexed by the 5-bit opcode and the
+2-bit mode of hardware/fax.md, and every decoded word is cached per address
+until it is written. Instructions do what their microprograms in uMem.vhd
+do, including the state of the ALU register AR (25 bits, its flags Z, N,
+C and V are those of alu.vhd):
+
+- indirect addressing works like direct addressing: its microprogram
+  sets ASR to the word still read from pMem, the instruction itself,
+- indexed addressing computes ADR + GR3 in AR,
+- MUL multiplies AR, not GRx (the microprogram never loads GRx into AR),
+- LSR continues into the MUL microprogram,
+- MOV copies the register numbered by the low bits of ADR through AR,
+  setting the flags from it,
+- LSL has no microprogram (K1 in cpu.vhd) and stops the machine.
+
+Values wrap at 24 bits and addresses at 12 bits like in the hardware.
+Don't care bits ('-') in pMem.vhd are read as 0.
+
+Images are loaded from pMem.vhd or from a raw binary file (.bin) of
+little-endian 32-bit words from address 0. Labels and sections are read
+from pMem.vhd, a raw image uses the section constants of hardware/pMem.vhd.
+
+`BinaryMachine` has the interface of `Machine`, e.g. run a headless check:
+
+    python binary_machine.py [hardware/pMem.vhd | image.bin]
+        [--max-instructions N] [--input-script <script.txt>]
+"""
+
+import os, re, sys, time
+import numpy as np
+
+import utils
+import array_manip as am
+from utils import COLORS
+from section import Section
+from machine import Machine
+from cycle_model import get_cycle_table
+from input_script import read_input_script
+
+PMEM_FILE = os.path.join(utils.ROOT_DIR, "hardware", "pMem.vhd")
+MEMORY_HEIGHT = 4096
+DEFAULT_MAX_INSTRUCTIONS = 1000000
+
+WORD_MASK = 2**24 - 1
+AR_MASK = 2**25 - 1  # AR_internal of alu.vhd has a carry bit
+ADDRESS_MASK = 2**12 - 1
+REGISTER_NAMES = [f"GR{i}" for i in range(16)]
+
+# values of the mode field M
+DIRECT, IMMEDIATE, INDIRECT, INDEXED = range(4)
+
+PMEM_ELEMENT_PATTERN = re.compile(
+    r'\s*(?:(\w+)\+)?(\d+)\s*=>\s*b"([01_\-]+)",?\s*(?:--\s*(.*))?'
+)
+
+
+class Image:
+    """
+    Represent assembled machine code:
+    - memory of 24-bit words
+    - labels and sections
+    - the assembly line of every word, if known
+    """
+
+    def __init__(self, memory: list, labels: dict, sections: dict, lines: list):
+        self.memory = memory
+        self.labels = labels
+        self.sections = sections
+        self.lines = lines
+
+    def get_section_at(self, address: int):
+        """
+        Return the section whose words hold `address`, None if there is none
+        """
+
+        for section in self.sections.values():
+            if section.start <= address < section.start + len(section.lines):
+                return section
+
+        return None
+
+    @classmethod
+    def from_pmem(cls, file_name: str = PMEM_FILE):
+        """
+        Load the initial value of `p_mem` in the VHDL file `file_name`
+        """
+
+        lines = open(file_name).readlines()
+        constants = am.parse_constants(lines)
+        array_lines = am.extract_vhdl_array(lines, r".*:.*p_mem_type.*:=.*")
+
+        memory = [0] * MEMORY_HEIGHT
+        asm_lines = [""] * MEMORY_HEIGHT
+        labels = {}
+        sections = {
+            name: Section(f"%{name} {start}")
+            for name, start in sorted(constants.items(), key=lambda item: item[1])
+        }
+
+        for line in array_lines:
+            match = PMEM_ELEMENT_PATTERN.match(line)
+            if not match:
+                continue
+            section_name, offset, bits, comment = match.groups()
+
+            address = constants.get(section_name, 0) + int(offset)
+            memory[address] = int(bits.replace("_", "").replace("-", "0"), 2)
+
+            comment = (comment or "").strip()
+            label_match = re.match(r"(\w+)\s+:\s*(.*)", comment)
+            while label_match:  # all labels of the address
+                labels[label_match.group(1)] = address
+                comment = label_match.group(2)
+                label_match = re.match(r"(\w+)\s+:\s*(.*)", comment)
+            asm_lines[address] = comment
+
+            if section_name in sections:
+                sections[section_name].lines.append(comment)
+
+        return cls(memory, labels, sections, asm_lines)
+
+    @classmethod
+    def from_binary(cls, file_name: str):
+        """
+        Load a raw image of little-endian 32-bit words
+        """
+
+        words = np.fromfile(file_name, dtype="<u4")
+        if len(words) > MEMORY_HEIGHT:
+            utils.ERROR(f"{file_name} holds {len(words)} words, memory has {MEMORY_HEIGHT}")
+
+        memory = [0] * MEMORY_HEIGHT
+        memory[: len(words)] = [int(word) & WORD_MASK for word in words]
+
+        # the video port reads VMEM where the hardware puts it
+        sections = Image.from_pmem(PMEM_FILE).sections
+        for section in sections.values():
+            section.lines = []
+
+        return cls(memory, {}, sections, [""] * MEMORY_HEIGHT)
+
+    @classmethod
+    def from_file(cls, file_name: str):
+        if file_name.endswith(".bin"):
+            return cls.from_binary(file_name)
+        return cls.from_pmem(file_name)
+
+
+class BinaryMachine(Machine):
+    """
+    Represent the state of the machine running assembled machine code
+    """
+
+    def __init__(self, image_file_name: str = PMEM_FILE, image: Image = None, isa=None):
+        """
+        Create a machine running either the image file `image_file_name`
+        (pMem.vhd or .bin), which is read again on every reset, or an
+        already loaded `image`
+        """
+
+        self.image_file_name = None if image is not None else image_file_name
+        self.image = image
+        self.isa = isa if isa is not None else utils.get_mnemonics()
+        self.init_decode_tables()
+
+        # skip the assembly file handling of Machine
+        super().__init__(program=image or Image([], {}, {}, []), isa=self.isa)
+
+    def init_decode_tables(self):
+        """
+        Fill the tables of the execute methods (by opcode) and the
+        address modes (by mode field)
+        """
+
+        executes = {
+            "LD": self.execute_load,
+            "ST": self.execute_store,
+            "ADD": self.execute_add,
+            "SUB": self.execute_sub,
+            "CMP": self.execute_cmp,
+            "AND": self.execute_and,
+            "OR": self.execute_or,
+            "LSR": self.execute_lsr,
+            "MUL": self.execute_mul,
+            "JSR": self.execute_jsr,
+            "BRA": self.execute_bra,
+            "BNE": self.execute_bne,
+            "BEQ": self.execute_beq,
+            "PUSH": self.execute_push,
+            "POP": self.execute_pop,
+            "RET": self.execute_ret,
+            "SWAP": self.execute_swap,
+            "MOV": self.execute_mov,
+            "HALT": self.execute_halt,
+        }
+
+        self.execute_table = [self.execute_undefined] * 32
+        self.mnemonic_table = ["?"] * 32
+        for mnemonic, opcode in self.isa.items():
+            self.mnemonic_table[int(opcode, 2)] = mnemonic
+            if mnemonic in executes:
+                self.execute_table[int(opcode, 2)] = executes[mnemonic]
+
+        self.address_table = [
+            self.address_direct,
+            self.address_immediate,
+            self.address_indirect,
+            self.address_indexed,
+        ]
+
+    def reset(self):
+        if self.image_file_name is not None:
+            self.image = Image.from_file(self.image_file_name)
+            self.program = self.image
+            self.cycle_table = get_cycle_table()  # the microcode may have changed too
+
+        super().reset()
+
+    def init_memory(self, image: Image):
+        self.sections = image.sections
+        self.labels = image.labels
+        self.macros = {}
+        self.memory = list(image.memory)
+        self.breakpoints = [i for i, line in enumerate(image.lines) if ";b" in line]
+        self.counted_loops = {}  # found in assembly text only
+        self.decoded = [None] * len(self.memory)
+        self.init_cycle_costs()
+
+    def init_registers(self):
+        super().init_registers()
+        self.registers["AR"] = 0
+        self.fetch_address = 0  # of the instruction being executed
+
+    def init_flags(self):
+        self.flags = {}
+        self.set_ar(self.registers["AR"])  # Z is set after reset
+
+    def restore(self, snapshot):
+        super().restore(snapshot)
+        self.decoded = [None] * len(self.memory)
+
+    def mark_memory_change(self, address, word):
+        super().mark_memory_change(address, word)
+        self.decoded[address] = None
+
+    def get_instruction_cycles(self, word) -> int:
+        return self.cycle_table.get_word_cycles(word)
+
+    def set_memory(self, address, value: int):
+        """
+        Store the 24-bit `value` at `address`
+        """
+
+        self.write(address, value & WORD_MASK)
+
+    def write(self, address: int, value: int):
+        if self.memory[address] != value:
+            self.memory[address] = value
+            self.memory_changed = True
+            self.decoded[address] = None
+            self.cycle_costs[address] = self.cycle_table.get_word_cycles(value)
+
+    def decode(self, word: int) -> tuple:
+        """
+        Return (execute method, GRx name, address mode method, ADR) of an instruction word
+        """
+
+        return (
+            self.execute_table[word >> 19 & 0b11111],
+            REGISTER_NAMES[word >> 15 & 0b1111],
+            self.address_table[word >> 13 & 0b11],
+            word & ADDRESS_MASK,
+        )
+
+    def disassemble(self, word: int) -> str:
+        mnemonic = self.mnemonic_table[word >> 19 & 0b11111]
+        mode = "_IXN"[word >> 13 & 0b11].strip("_")
+        return f"{mnemonic}{mode} GR{word >> 15 & 0b1111}, {word & ADDRESS_MASK}"
+
+    def execute_next_instruction(self):
+        """
+        Fetch, decode and execute the word at PC
+        """
+
+        if self.halted:
+            print("Machine is halted! Press 'r' to reset")
+            return
+
+        self.idle_period = None
+
+        if self.instruction_count >= self.next_input_count:
+            self.press_scheduled_keys()
+
+        registers = self.registers
+        pc = registers["PC"]
+        decoded = self.decoded[pc]
+        if decoded is None:
+            decoded = self.decoded[pc] = self.decode(self.memory[pc])
+
+        if self.coverage is not None:
+            self.coverage[pc] = 1
+
+        self.fetch_address = pc
+        registers["PC"] = (pc + 1) & ADDRESS_MASK
+        self.cycle_count += self.cycle_costs[pc]
+
+        execute, grx, get_address, adr = decoded
+        execute(grx, get_address(adr), adr)
+
+        self.instruction_count += 1
+
+    def set_ar(self, value: int):
+        """
+        Write the ALU register, its flags follow it
+        """
+
+        value &= AR_MASK
+        self.registers["AR"] = value
+        flags = self.flags
+        flags["Z"] = 1 if value == 0 else 0
+        flags["N"] = value >> 23 & 1
+        flags["C"] = flags["V"] = value >> 24
+
+    # address modes (K2), return the address of the operand (ASR)
+
+    def address_direct(self, adr: int) -> int:
+        return adr
+
+    def address_immediate(self, adr: int) -> int:
+        pc = self.registers["PC"]
+        self.registers["PC"] = (pc + 1) & ADDRESS_MASK
+        return pc
+
+    def address_indirect(self, adr: int) -> int:
+        return self.memory[self.fetch_address] & ADDRESS_MASK  # = adr
+
+    def address_indexed(self, adr: int) -> int:
+        self.set_ar(adr + self.registers["GR3"])
+        return self.registers["AR"] & ADDRESS_MASK
+
+    # execution (K1), one method per microprogram
+
+    def execute_load(self, grx, asr, adr):
+        self.registers[grx] = self.memory[asr]
+
+    def execute_store(self, grx, asr, adr):
+        self.write(asr, self.registers[grx])
+
+    def execute_add(self, grx, asr, adr):
+        self.set_ar(self.registers[grx] + self.memory[asr])
+        self.registers[grx] = self.registers["AR"] & WORD_MASK
+
+    def execute_sub(self, grx, asr, adr):
+        self.set_ar(self.registers[grx] - self.memory[asr])
+        self.registers[grx] = self.registers["AR"] & WORD_MASK
+
+    def execute_cmp(self, grx, asr, adr):
+        self.set_ar(self.registers[grx] - self.memory[asr])
+
+    def execute_and(self, grx, asr, adr):
+        self.set_ar(self.registers[grx] & self.memory[asr])
+        self.registers[grx] = self.registers["AR"] & WORD_MASK
+
+    def execute_or(self, grx, asr, adr):
+        self.set_ar(self.registers[grx] | self.memory[asr])
+        self.registers[grx] = self.registers["AR"] & WORD_MASK
+
+    def execute_lsr(self, grx, asr, adr):
+        self.set_ar(self.registers["AR"] >> self.memory[asr])
+        self.execute_mul(grx, asr, adr)  # no jump back to uPC 0
+
+    def execute_mul(self, grx, asr, adr):
+        self.set_ar(self.registers["AR"] * self.memory[asr])
+        self.registers[grx] = self.registers["AR"] & WORD_MASK
+
+    def jump(self, destination: int):
+        """
+        Set PC to `destination`, check for idle loops on backward branches
+        """
+
+        self.registers["PC"] = destination
+        if destination <= self.fetch_address and self.detect_idle_loops:
+            self.check_idle_loop(self.fetch_address)
+
+    def execute_bra(self, grx, asr, adr):
+        self.jump(adr)
+
+    def execute_bne(self, grx, asr, adr):
+        if self.flags["Z"] == 0:
+            self.cycle_count += self.taken_branch_cycles["BNE"]
+            self.jump(adr)
+
+    def execute_beq(self, grx, asr, adr):
+        if self.flags["Z"] == 1:
+            self.cycle_count += self.taken_branch_cycles["BEQ"]
+            self.jump(adr)
+
+    def push(self, value: int):
+        if self.check_limits:
+            self.check_stack_pointer()
+        self.write(self.registers["SP"], value)
+        self.registers["SP"] = (self.registers["SP"] - 1) & ADDRESS_MASK
+
+    def execute_jsr(self, grx, asr, adr):
+        self.push(self.registers["PC"])
+        self.jump(adr)
+
+    def execute_push(self, grx, asr, adr):
+        self.push(self.registers[grx])
+
+    def execute_pop(self, grx, asr, adr):
+        self.registers["SP"] = (self.registers["SP"] + 1) & ADDRESS_MASK
+        self.registers[grx] = self.memory[self.registers["SP"]]
+
+    def execute_ret(self, grx, asr, adr):
+        self.registers["SP"] = (self.registers["SP"] + 1) & ADDRESS_MASK
+        self.registers["PC"] = self.memory[self.registers["SP"]] & ADDRESS_MASK
+
+    def execute_mov(self, grx, asr, adr):
+        self.set_ar(self.registers[REGISTER_NAMES[adr & 0b1111]])
+        self.registers[grx] = self.registers["AR"] & WORD_MASK
+
+    def execute_swap(self, grx, asr, adr):
+        # uPC 59-67: GRx gets the operand, then the word at ADR is read as
+        # an instruction whose GRx gets the word after this one, and PC
+        # jumps to that value
+        memory = self.memory
+        registers = self.registers
+        registers[grx] = memory[asr]
+        pc = (registers["PC"] + 1) & ADDRESS_MASK
+        second = REGISTER_NAMES[memory[adr] >> 15 & 0b1111]
+        registers[second] = memory[pc]
+        registers["PC"] = registers[second] & ADDRESS_MASK
+
+    def execute_halt(self, grx, asr, adr):
+        if self.verbose:
+            print("HALT instruction reached")
+        self.halted = True
+
+    def execute_undefined(self, grx, asr, adr):
+        word = self.memory[self.fetch_address]
+        utils.ERROR(
+            f"Opcode {word >> 19:05b} ({self.mnemonic_table[word >> 19]}) at "
+            f"address {self.fetch_address} has no microprogram"
+        )
+
+
+def main():
+    utils.change_dir_to_root()
+
+    args = [arg for arg in sys.argv[1:] if arg.endswith((".vhd", ".bin"))]
+    image_file_name = args[0] if args else PMEM_FILE
+    max_instructions = int(
+        utils.get_arg_value(sys.argv, "--max-instructions", DEFAULT_MAX_INSTRUCTIONS)
+    )
+    input_script = utils.get_arg_value(sys.argv, "--input-script")
+
+    machine = BinaryMachine(image_file_name)
+    if input_script:
+        machine.schedule_inputs(read_input_script(input_script))
+
+    t = time.time()
+    error = None
+    try:
+        machine.run(max_instructions)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    duration = time.time() - t
+
+    print(
+        f"{COLORS.BOLD}{image_file_name}{COLORS.ENDC}: {machine.instruction_count} "
+        f"instructions in {machine.cycle_count} cycles"
+    )
+    print("  ".join(f"{name}={value}" for name, value in machine.registers.items()))
+    print("  ".join(f"{name}={value}" for name, value in machine.flags.items()))
+    if error:
+        print(f"{COLORS.FAIL}{error}{COLORS.ENDC} at address {machine.fetch_address}")
+    print(f"{machine.instruction_count / duration:,.0f} instructions/s")
+
+
+if __name__ == "__main__":
+    main()
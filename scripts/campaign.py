@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Run large batch campaigns (see batch.py) on worker processes of many hosts.
+
+A coordinator makes the jobs, the combinations of programs, input scripts
+and swept values, and hands them out to the workers that connect to it.
+Every worker runs jobs on a process pool of its host with `batch.run_job`
+and sends back their result rows, which the coordinator appends to one
+JSON lines file as they arrive.
+
+Coordinator and workers talk over TCP (or a Unix socket, see
+debug_server.parse_address) in JSON lines:
+
+    worker -> {"hello": hostname, "processes": N, "engine": ENGINE_VERSION}
+    coord  -> {"id": job id, "job": job}           (up to 2 N at a time)
+    worker -> {"id": job id, "row": result row}
+    worker -> {"heartbeat": true}                  (every HEARTBEAT_S)
+    coord  -> {"done": true}                       (all jobs finished)
+
+A worker that disconnects or stays silent for HEARTBEAT_TIMEOUT_S is lost,
+its unfinished jobs go back into the queue for the other workers.
+Workers need the same checkout of the repository as the coordinator, jobs
+name program files and not their contents.
+
+Usage:
+    python campaign.py coordinate [batch.py job arguments] [--listen <address>]
+        [--out results.jsonl] [--resume]
+    python campaign.py work <address> [--processes N]
+e.g.
+    python campaign.py coordinate path.s --inputs masm/inputs/path_first_round.txt \\
+        --sweep _playergolddigit1=0,1,2,3,4,5,6,7,8,9 --listen 0.0.0.0:5600
+    python campaign.py work coordinator-host:5600      # on every host
+
+With `--resume` jobs already in the results file are not run again, the
+job arguments must be the same as in the interrupted campaign.
+"""
+
+import asyncio, json, multiprocessing, os, socket, sys, time
+from concurrent.futures import ProcessPoolExecutor
+
+import utils
+import batch
+from utils import COLORS
+from machine import ENGINE_VERSION
+from debug_server import parse_address
+
+DEFAULT_ADDRESS = "5600"
+DEFAULT_OUT_FILE = "campaign.jsonl"
+HEARTBEAT_S = 10
+HEARTBEAT_TIMEOUT_S = 60
+JOBS_PER_PROCESS = 2  # jobs in flight per worker process
+
+
+def encode(message: dict) -> bytes:
+    return (json.dumps(message) + "\n").encode()
+
+
+def read_done_jobs(file_name: str) -> set:
+    """
+    Return the ids of the jobs in the results file `file_name`
+    """
+
+    done = set()
+    with open(file_name) as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["job"])
+            except (json.JSONDecodeError, KeyError):
+                pass  # cut off when the coordinator stopped
+
+    return done
+
+
+class Coordinator:
+    """
+    Hand out `jobs` to connecting workers and write their results to `out_file`
+    """
+
+    def __init__(self, jobs: list, out_file: str, resume: bool = False):
+        self.jobs = jobs
+        self.done = read_done_jobs(out_file) if resume and os.path.exists(out_file) else set()
+        self.out = open(out_file, "a" if resume else "w")
+
+        self.queue = asyncio.Queue()
+        for job_id in range(len(jobs)):
+            if job_id not in self.done:
+                self.queue.put_nowait(job_id)
+
+        self.finished = asyncio.Event()
+        self.writers = set()
+        self.handlers = set()  # tasks serving a worker
+        self.start_time = time.time()
+
+    async def run(self, address: str):
+        """
+        Serve workers on `address` until all jobs are done
+        """
+
+        if len(self.done) == len(self.jobs):
+            self.finished.set()
+
+        kind, where = parse_address(address)
+        if kind == "unix":
+            server = await asyncio.start_unix_server(self.handle_worker, where)
+        else:
+            server = await asyncio.start_server(self.handle_worker, *where)
+
+        print(
+            f"Coordinating {len(self.jobs)} jobs ({len(self.done)} already done) "
+            f"on {address}"
+        )
+
+        await self.finished.wait()
+
+        for writer in list(self.writers):
+            writer.write(encode({"done": True}))
+            writer.close()
+        await asyncio.gather(*self.handlers)
+        server.close()
+        self.out.close()
+
+    async def handle_worker(self, reader, writer):
+        name = "?"
+        jobs_in_flight = set()
+        feeder = None
+        self.handlers.add(asyncio.current_task())
+
+        try:
+            hello = json.loads(await asyncio.wait_for(reader.readline(), HEARTBEAT_TIMEOUT_S))
+            name = f"{hello['hello']}/{writer.get_extra_info('peername')}"
+            if hello["engine"] != ENGINE_VERSION:
+                print(
+                    f"{COLORS.WARNING}Rejected worker {name} with engine version "
+                    f"{hello['engine']}, expected {ENGINE_VERSION}{COLORS.ENDC}"
+                )
+                return
+
+            self.writers.add(writer)
+            print(f"Worker {name} joined with {hello['processes']} processes")
+
+            slots = asyncio.Semaphore(hello["processes"] * JOBS_PER_PROCESS)
+            feeder = asyncio.create_task(self.feed(writer, jobs_in_flight, slots))
+
+            while not self.finished.is_set():
+                line = await asyncio.wait_for(reader.readline(), HEARTBEAT_TIMEOUT_S)
+                if not line:
+                    break  # disconnected
+
+                message = json.loads(line)
+                if "id" in message:
+                    jobs_in_flight.discard(message["id"])
+                    slots.release()
+                    self.add_result(message["id"], message["row"])
+        except (asyncio.TimeoutError, ConnectionError, json.JSONDecodeError, KeyError):
+            pass
+        finally:
+            if feeder is not None:
+                feeder.cancel()
+            self.writers.discard(writer)
+            self.handlers.discard(asyncio.current_task())
+
+            if not self.finished.is_set():
+                lost = [job_id for job_id in jobs_in_flight if job_id not in self.done]
+                for job_id in lost:
+                    self.queue.put_nowait(job_id)
+                print(
+                    f"{COLORS.WARNING}Lost worker {name}, "
+                    f"requeued {len(lost)} jobs{COLORS.ENDC}"
+                )
+                writer.close()
+
+    async def feed(self, writer, jobs_in_flight: set, slots: asyncio.Semaphore):
+        """
+        Send jobs from the queue to a worker while it has free slots
+        """
+
+        while True:
+            await slots.acquire()
+            job_id = await self.queue.get()
+            if job_id in self.done:
+                slots.release()
+                continue  # finished by a worker thought to be lost
+
+            jobs_in_flight.add(job_id)
+            writer.write(encode({"id": job_id, "job": self.jobs[job_id]}))
+            await writer.drain()
+
+    def add_result(self, job_id: int, row: dict):
+        if job_id in self.done:
+            return  # also ran on a worker thought to be lost
+
+        self.done.add(job_id)
+        self.out.write(json.dumps({"job": job_id} | row) + "\n")
+        self.out.flush()
+
+        num_done = len(self.done)
+        if num_done % max(1, len(self.jobs) // 20) == 0 or num_done == len(self.jobs):
+            print(
+                f"{num_done}/{len(self.jobs)} jobs done, "
+                f"{num_done / (time.time() - self.start_time):.1f} jobs/s"
+            )
+        if num_done == len(self.jobs):
+            self.finished.set()
+
+
+async def work(address: str, processes: int):
+    """
+    Run jobs of the coordinator at `address` on `processes` processes
+    until it has no more
+    """
+
+    kind, where = parse_address(address)
+    if kind == "unix":
+        reader, writer = await asyncio.open_unix_connection(where)
+    else:
+        reader, writer = await asyncio.open_connection(*where)
+
+    writer.write(
+        encode({"hello": socket.gethostname(), "processes": processes, "engine": ENGINE_VERSION})
+    )
+
+    loop = asyncio.get_running_loop()
+    num_jobs = 0
+
+    async def run(job_id, job):
+        try:
+            row = await loop.run_in_executor(executor, batch.run_job, job)
+        except Exception as e:
+            # e.g. a killed pool process, leave so the coordinator requeues the jobs
+            print(f"{COLORS.FAIL}Job {job_id} failed: {type(e).__name__}: {e}{COLORS.ENDC}")
+            writer.close()
+            return
+
+        writer.write(encode({"id": job_id, "row": row}))
+        await writer.drain()
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(HEARTBEAT_S)
+            writer.write(encode({"heartbeat": True}))
+            await writer.drain()
+
+    # forked processes would keep the connection open when the worker dies
+    with ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        tasks = {asyncio.create_task(heartbeat())}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break  # coordinator went away
+
+                message = json.loads(line)
+                if message.get("done"):
+                    break
+
+                task = asyncio.create_task(run(message["id"], message["job"]))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                num_jobs += 1
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    print(f"Ran {num_jobs} jobs")
+
+
+def main():
+    utils.change_dir_to_root()
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ("coordinate", "work"):
+        utils.ERROR("Usage: python campaign.py coordinate|work ..., see campaign.py")
+
+    if sys.argv[1] == "work":
+        if len(sys.argv) < 3:
+            utils.ERROR("Give the address of the coordinator")
+        processes = int(utils.get_arg_value(sys.argv, "--processes", os.cpu_count()))
+        asyncio.run(work(sys.argv[2], processes))
+        return
+
+    programs = [arg for arg in sys.argv[2:] if arg.endswith(".s")] or utils.get_programs(
+        "masm"
+    )
+    input_scripts = utils.get_arg_values(sys.argv, "--inputs") or [None]
+    sweeps = [batch.parse_sweep(arg) for arg in utils.get_arg_values(sys.argv, "--sweep")]
+
+    override_at = utils.get_arg_value(sys.argv, "--override-at", 0)
+    if isinstance(override_at, str) and override_at.isdigit():
+        override_at = int(override_at)
+
+    max_instructions = int(
+        utils.get_arg_value(sys.argv, "--max-instructions", batch.DEFAULT_MAX_INSTRUCTIONS)
+    )
+    address = utils.get_arg_value(sys.argv, "--listen", DEFAULT_ADDRESS)
+    out_file = utils.get_arg_value(sys.argv, "--out", DEFAULT_OUT_FILE)
+
+    jobs = batch.make_jobs(programs, input_scripts, sweeps, override_at, max_instructions)
+    coordinator = Coordinator(jobs, out_file, "--resume" in sys.argv)
+    asyncio.run(coordinator.run(address))
+
+    print(f"{COLORS.OKGREEN}Wrote {len(coordinator.done)} results to {out_file}{COLORS.ENDC}")
+
+
+if __name__ == "__main__":
+    main()
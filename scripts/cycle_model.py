@@ -0,0 +1,186 @@
+"""
+Cycle costs of instructions, derived from the microcode (see microcode.py)
+so that the instruction-level engines count the same clock cycles as the
+hardware without running any microinstructions.
+
+Every instruction goes through three microprograms:
+- fetch, uPC 0 up to the jump to K2
+- its address mode, from K2 up to the jump to K1
+- its opcode, from K1 up to the jump to uPC 0 or HALT
+Each microinstruction takes one cycle. Opcodes with a conditional jump in
+their microprogram (BNE, BEQ) take a different number of cycles when the
+branch is taken, kept as the extra cycles of the taken path.
+
+    python cycle_model.py    # print the table of the current microcode
+
+Tables are cached by the content of uMem.vhd and cpu.vhd, so a changed
+microprogram gives a new table the next time one is asked for. The files
+are hashed again only when their modification time changed.
+"""
+
+import hashlib, os
+
+import utils
+from loops import decode
+from microcode import (
+    Microcode,
+    UMEM_FILE,
+    CPU_FILE,
+    UMEM_SIZE,
+    UNDEFINED,
+    SEQ_NEXT,
+    SEQ_K1,
+    SEQ_K2,
+    SEQ_ZERO,
+    SEQ_JUMP,
+    SEQ_HALT,
+)
+
+# address modes of assembly lines, as encoded by assembler.py
+MODE_CODES = {"": 0b00, "I": 0b01, "X": 0b10, "N": 0b11}
+MODE_NAMES = ["direct", "immediate", "indirect", "indexed"]
+
+# (uMem digest, cpu digest) -> CycleTable, same digests as result_cache.get_file_digest
+_tables = {}
+# file name -> (modification time, digest)
+_digests = {}
+
+
+class CycleTable:
+    """
+    Represent the cycles of fetch, every address mode and every opcode
+    """
+
+    def __init__(self, microcode: Microcode, digest: str = ""):
+        self.digest = digest  # of the microcode files, part of cache keys
+
+        self.fetch = get_path_cycles(microcode, 0, SEQ_K2)[0]
+        self.modes = [
+            get_path_cycles(microcode, upc, SEQ_K1)[0] if upc != UNDEFINED else 0
+            for upc in microcode.k2
+        ]
+
+        self.opcodes = [UNDEFINED] * len(microcode.k1)  # branch not taken
+        self.taken = [0] * len(microcode.k1)  # extra cycles of a taken branch
+        for opcode, upc in enumerate(microcode.k1):
+            if upc != UNDEFINED:
+                cycles, taken_cycles = get_path_cycles(microcode, upc, SEQ_ZERO)
+                self.opcodes[opcode] = cycles
+                self.taken[opcode] = taken_cycles - cycles
+
+    def get_cycles(self, opcode: int, mode: int) -> int:
+        """
+        Cycles of an instruction, with its branch not taken.
+        Opcodes without microprogram only count fetch and address mode.
+        """
+
+        return self.fetch + self.modes[mode] + max(self.opcodes[opcode], 0)
+
+    def get_word_cycles(self, word: int) -> int:
+        """
+        Cycles of the instruction in a machine code word
+        """
+
+        return self.get_cycles(word >> 19 & 0b11111, word >> 13 & 0b11)
+
+    def get_line_cycles(self, line, isa: dict) -> int:
+        """
+        Cycles of the instruction in an assembly line, 0 if it is none
+        """
+
+        if not isinstance(line, str) or not line[:1].isalpha():
+            return 0  # data, pushed values or empty
+
+        decoded = decode(line, isa)
+        if decoded is None or decoded[1] not in MODE_CODES:
+            return 0
+
+        mnemonic, address_mode, _ = decoded
+        return self.get_cycles(int(isa[mnemonic], 2), MODE_CODES[address_mode])
+
+    def get_taken_cycles(self, mnemonic: str, isa: dict) -> int:
+        return self.taken[int(isa[mnemonic], 2)]
+
+
+def get_path_cycles(microcode: Microcode, upc: int, end: int) -> tuple:
+    """
+    Follow the microprogram from `upc` up to and including the
+    microinstruction with sequencer operation `end` (or HALT).
+    Return its cycles with the conditional jump not taken and taken,
+    the same if there is none.
+    """
+
+    cycles = 0
+    taken_cycles = None  # once the path has split
+
+    for _ in range(UMEM_SIZE):
+        cycles += 1
+        seq = microcode.seq[upc]
+
+        if seq == end or seq == SEQ_HALT:
+            if taken_cycles is None:
+                return cycles, cycles
+            return cycles, taken_cycles
+
+        if seq == SEQ_NEXT:
+            upc = upc + 1 & 0xFF
+        elif seq == SEQ_JUMP:
+            upc = microcode.uadr[upc]
+        elif seq in (SEQ_K1, SEQ_K2, SEQ_ZERO):
+            utils.ERROR(f"Microprogram jumps out of its path at uPC {upc}")
+        else:  # conditional jump
+            if taken_cycles is not None:
+                utils.ERROR(f"More than one conditional jump in path at uPC {upc}")
+            taken_cycles = cycles + get_path_cycles(microcode, microcode.uadr[upc], end)[0]
+            upc = upc + 1 & 0xFF
+
+    utils.ERROR(f"Microprogram from uPC {upc} does not reach its end")
+
+
+def get_file_digest(file_name: str) -> str:
+    """
+    Return the SHA-256 of a file, read again only when it was modified
+    """
+
+    mtime = os.stat(file_name).st_mtime_ns
+    if _digests.get(file_name, (None,))[0] != mtime:
+        with open(file_name, "rb") as f:
+            _digests[file_name] = (mtime, hashlib.sha256(f.read()).hexdigest())
+
+    return _digests[file_name][1]
+
+
+def get_cycle_table(umem_file: str = UMEM_FILE, cpu_file: str = CPU_FILE) -> CycleTable:
+    """
+    Return the cycle table of the microcode in `umem_file` and `cpu_file`,
+    made again only when their contents changed
+    """
+
+    key = (get_file_digest(umem_file), get_file_digest(cpu_file))
+    if key not in _tables:
+        digest = hashlib.sha256("".join(key).encode()).hexdigest()
+        _tables[key] = CycleTable(Microcode.from_files(umem_file, cpu_file), digest)
+
+    return _tables[key]
+
+
+def main():
+    utils.change_dir_to_root()
+
+    table = get_cycle_table()
+    print(f"fetch: {table.fetch} cycles")
+    for mode, cycles in enumerate(table.modes):
+        print(f"{MODE_NAMES[mode]}: {cycles} cycles")
+
+    for mnemonic, opcode in utils.get_mnemonics().items():
+        cycles = table.opcodes[int(opcode, 2)]
+        if cycles == UNDEFINED:
+            print(f"{mnemonic}: no microprogram")
+        elif table.taken[int(opcode, 2)]:
+            print(f"{mnemonic}: {cycles} cycles, {cycles + table.taken[int(opcode, 2)]} if taken")
+        else:
+            print(f"{mnemonic}: {cycles} cycle{'s' if cycles != 1 else ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Dead code elimination for preassembled masm lines (see preassemble.py),
+an optional pass before the assembler lays out the program:
+
+    python dce.py <file.s> [--export <label> ...]   # report what it would free
+    python assembler.py <file.s> --dce
+
+Included files like STANDARD.s bring all their routines, used or not.
+Instructions are live if they can be reached from the program entry (the
+first statement at address 0 and `start`) or an exported label, following
+the next instruction and every label an operand refers to, so JSR, BRA,
+BNE, BEQ and labels loaded as values all count. Labels named by data
+words or macros are live too. Everything else in a code section is
+removed, with the labels in front of it.
+
+A SWAP or a branch to a number may jump anywhere, with one of them live
+nothing is removed.
+"""
+
+import re, sys
+
+import utils
+from utils import COLORS
+from peephole import decode_lines
+from section import Section
+from preassemble import preassemble
+
+ENTRY_LABEL = "start"
+PMEM_HEIGHT = 4096
+
+SYMBOL_PATTERN = re.compile(r"\b[A-Za-z_]\w*\b")
+
+# instructions that never go on to the next one
+NO_FALLTHROUGH = {"BRA", "RET", "HALT", "SWAP"}
+
+
+class DeadCode:
+    """
+    Find the live lines of a preassembled program
+    """
+
+    def __init__(self, asm_lines: list, exports: list = (), isa: dict = None):
+        self.lines = list(asm_lines)
+        self.isa = isa if isa is not None else utils.get_mnemonics()
+        self.instructions, self.labels = decode_lines(self.lines, self.isa)
+        self.exports = list(exports)
+
+        for label in self.exports:
+            if label not in self.labels:
+                utils.ERROR(f"Exported label {label} is not defined")
+
+        self.find_sections()
+
+    def find_sections(self):
+        """
+        Find the section of every line and the sections with code
+        """
+
+        self.sections = []  # section of every line, None before the first
+        self.code_sections = set()
+        section = None
+        for line, instruction in zip(self.lines, self.instructions):
+            if line.startswith("%"):
+                section = Section(line)
+            self.sections.append(section)
+            if instruction is not None:
+                self.code_sections.add(section.name)
+
+    def is_statement(self, i: int) -> bool:
+        """
+        Return True if line `i` is an instruction or a data word
+        """
+
+        line = self.lines[i]
+        return not (line.startswith(("_", "%")) or line.strip().endswith(":"))
+
+    def next_statement(self, i: int):
+        """
+        Return the index of the first statement from line `i` on in the
+        same section, None if there is none
+        """
+
+        for j in range(i, len(self.lines)):
+            if self.lines[j].startswith("%"):
+                return None
+            if self.is_statement(j):
+                return j
+
+        return None
+
+    def get_referenced_labels(self, text: str) -> list:
+        return [symbol for symbol in SYMBOL_PATTERN.findall(text) if symbol in self.labels]
+
+    def get_roots(self) -> list:
+        """
+        Return the line indices execution can start at or jump to from
+        data: address 0, `start`, exported labels and labels named by
+        data words or macros
+        """
+
+        roots = []
+        for i, line in enumerate(self.lines):
+            if line.startswith("%") and self.sections[i].start == 0:
+                roots.append(i + 1)
+
+        labels = [ENTRY_LABEL] if ENTRY_LABEL in self.labels else []
+        labels += self.exports
+        for i, line in enumerate(self.lines):
+            if line.startswith("_") or self.is_statement(i) and self.instructions[i] is None:
+                labels += self.get_referenced_labels(line.split("=", 1)[-1])
+
+        roots += [self.labels[label] for label in labels]
+        return roots
+
+    def find_live(self):
+        """
+        Return the set of live line indices, None if any line may be
+        """
+
+        live = set()
+        stack = self.get_roots()
+        while stack:
+            i = self.next_statement(stack.pop())
+            if i is None or i in live:
+                continue
+            live.add(i)
+
+            instruction = self.instructions[i]
+            if instruction is None:
+                continue  # data word
+
+            if instruction.mnemonic == "SWAP":
+                return None
+            referenced = self.get_referenced_labels(instruction.address or "")
+            if instruction.mnemonic in {"BRA", "BNE", "BEQ", "JSR"} and not referenced:
+                if instruction.address not in (None, "-"):
+                    return None  # to a number
+
+            stack += [self.labels[label] for label in referenced]
+            if instruction.mnemonic not in NO_FALLTHROUGH:
+                stack.append(i + 1)
+
+        return live
+
+    def get_words(self, i: int) -> int:
+        instruction = self.instructions[i]
+        if instruction is None:
+            return 1
+        return 2 if instruction.mode == "I" and instruction.address != "-" else 1
+
+    def eliminate(self) -> tuple:
+        """
+        Return the live lines and the words removed by routine, the label
+        in front of them (in line order)
+        """
+
+        live = self.find_live()
+        if live is None:
+            return self.lines, {}
+
+        lines = []
+        removed = {}
+        routine = None
+        for i, line in enumerate(self.lines):
+            if line.strip().endswith(":") and not line.startswith("_"):
+                routine = line.strip()[:-1]
+            if line.startswith("%"):
+                routine = None
+
+            if self.sections[i] is None or self.sections[i].name not in self.code_sections:
+                lines.append(line)
+            elif self.is_statement(i):
+                if i in live or self.instructions[i] is None:
+                    lines.append(line)
+                else:
+                    name = routine or self.sections[i].name
+                    removed[name] = removed.get(name, 0) + self.get_words(i)
+            elif line.strip().endswith(":") and not line.startswith("_"):
+                following = self.next_statement(i)
+                if following is None or following in live or self.instructions[following] is None:
+                    lines.append(line)
+            else:
+                lines.append(line)
+
+        return lines, removed
+
+    def get_size(self, lines: list) -> int:
+        """
+        Return the words of the code sections in `lines`
+        """
+
+        instructions, _ = decode_lines(lines, self.isa)
+        words = 0
+        section = None
+        for line, instruction in zip(lines, instructions):
+            if line.startswith("%"):
+                section = Section(line)
+            elif section is None or section.name not in self.code_sections:
+                continue
+            elif instruction is not None:
+                words += 2 if instruction.mode == "I" and instruction.address != "-" else 1
+            elif not (line.startswith("_") or line.strip().endswith(":")):
+                words += 1
+
+        return words
+
+
+def eliminate(asm_lines: list, exports: list = (), isa: dict = None) -> tuple:
+    """
+    Remove the dead code of preassembled lines, return the live lines and
+    the lines of a size report
+    """
+
+    dead_code = DeadCode(asm_lines, exports, isa)
+    lines, removed = dead_code.eliminate()
+
+    if not removed and dead_code.find_live() is None:
+        return lines, ["SWAP or a branch to a number is live, nothing removed"]
+
+    report = [f"{'routine':<28} {'words':>6}"]
+    for routine, words in removed.items():
+        report.append(f"{routine:<28} {words:>6}")
+
+    before, after = dead_code.get_size(asm_lines), dead_code.get_size(lines)
+    report.append(
+        f"{'total':<28} {before - after:>6}, code {before} -> {after} words "
+        f"of {PMEM_HEIGHT} in pMem"
+    )
+
+    return lines, report
+
+
+def print_report(file_name: str, report: list):
+    print(f"{COLORS.BOLD}Dead code {file_name}{COLORS.ENDC}, removed:")
+    print("\n".join(report))
+
+
+def main():
+    utils.change_dir_to_root()
+
+    if len(sys.argv) < 2:
+        utils.ERROR("Usage: python dce.py <file.s> [--export <label> ...]")
+    file_name = sys.argv[1]
+    exports = utils.get_arg_values(sys.argv, "--export")
+
+    _, report = eliminate(preassemble(file_name), exports)
+    print_report(file_name, report)
+
+
+if __name__ == "__main__":
+    main()
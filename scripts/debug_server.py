@@ -0,0 +1,441 @@
+"""
+Debug server to drive the emulator from other programs: editor
+integrations, test harnesses, dashboards.
+
+The server runs on an asyncio event loop, over TCP (`host:port` or `port`)
+or a Unix socket (`unix:<path>`). The machine runs on the same loop
+(`run_machine`), in slices between requests, and sleeps while halted,
+paused or waiting for a keypress. STEP runs in such slices too, so other
+clients may change the machine during a long STEP. In the window the loop
+also paces the frames of emulate.py. Everything that changes the machine
+runs on this one thread, so no locks are needed.
+
+Protocol: every message is a frame, a 4-byte big-endian length followed
+by that many bytes. A request frame holds a batch of commands, the
+response frame their results in the same order, so e.g. all of VMEM and
+the registers can be fetched in one round trip:
+
+    request  = u16 number of commands, then per command: u8 id, arguments
+    response = u16 number of results, then per result: u8 status, data
+               status 0 = ok, 1 = error with data str (the message)
+
+All integers are big-endian. Commands (id, arguments -> data):
+
+    1  STEP          u32 n             -> u32 executed instructions
+    2  CONTINUE                        -> (run until a breakpoint)
+    3  BREAK                           -> (pause)
+    4  RESET                           ->
+    5  READ_MEMORY   u16 start, u16 n  -> n words
+    6  WRITE_MEMORY  u16 start, u16 n, n words ->
+    7  READ_STATE                      -> 18 x i64 registers (GR0-GR15, PC, SP),
+                                          4 x u8 flags (Z, N, C, V),
+                                          u64 instruction count, u8 halted,
+                                          u8 running
+    8  SET_REGISTER  u8 register, i64 value ->
+    9  BREAKPOINT    u16 address, u8 on ->
+    10 SAVE_SNAPSHOT u8 slot           ->
+    11 LOAD_SNAPSHOT u8 slot           ->
+    12 PRESS_KEY     str key name      -> (see machine.KEY_NUMBERS)
+
+    str  = u16 length, utf-8 bytes
+    word = u8 tag, then tag 0: empty, 1: i64 number, 2: str text
+Memory holds assembly text and numbers as in `Machine.memory`. Written
+numbers are stored like ST does, as 24-bit binary strings.
+
+`DebugClient` is a small blocking client:
+
+    client = DebugClient("localhost:5555")
+    vmem, state = client.request([("read_memory", 1500, 130), ("read_state",)])
+"""
+
+import asyncio, socket, struct
+
+import utils
+
+PROTOCOL_COMMANDS = {
+    "step": 1,
+    "continue": 2,
+    "break": 3,
+    "reset": 4,
+    "read_memory": 5,
+    "write_memory": 6,
+    "read_state": 7,
+    "set_register": 8,
+    "breakpoint": 9,
+    "save_snapshot": 10,
+    "load_snapshot": 11,
+    "press_key": 12,
+}
+COMMAND_NAMES = {number: name for name, number in PROTOCOL_COMMANDS.items()}
+
+REGISTER_NAMES = [f"GR{i}" for i in range(16)] + ["PC", "SP"]
+FLAG_NAMES = ["Z", "N", "C", "V"]
+
+WORD_EMPTY, WORD_NUMBER, WORD_TEXT = range(3)
+
+STATUS_OK, STATUS_ERROR = range(2)
+
+SLICE_INSTRUCTIONS = 2000  # executed between serving requests and frames
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def pack_str(text: str) -> bytes:
+    data = text.encode()
+    return struct.pack(">H", len(data)) + data
+
+
+def pack_word(word) -> bytes:
+    if isinstance(word, int):
+        return struct.pack(">Bq", WORD_NUMBER, word)
+    if not word:
+        return struct.pack(">B", WORD_EMPTY)
+    return struct.pack(">B", WORD_TEXT) + pack_str(word)
+
+
+class Reader:
+    """
+    Read big-endian values from a frame
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.offset = 0
+
+    def read(self, fmt: str):
+        values = struct.unpack_from(">" + fmt, self.data, self.offset)
+        self.offset += struct.calcsize(">" + fmt)
+        return values if len(values) > 1 else values[0]
+
+    def read_str(self) -> str:
+        length = self.read("H")
+        text = self.data[self.offset : self.offset + length].decode()
+        self.offset += length
+        return text
+
+    def read_word(self):
+        tag = self.read("B")
+        if tag == WORD_EMPTY:
+            return ""
+        elif tag == WORD_NUMBER:
+            return self.read("q")
+        elif tag == WORD_TEXT:
+            return self.read_str()
+        utils.ERROR(f"Unknown word tag {tag}")
+
+
+async def read_frame(reader) -> bytes:
+    length = struct.unpack(">I", await reader.readexactly(4))[0]
+    if length > MAX_FRAME_SIZE:
+        utils.ERROR(f"Frame of {length} bytes is too large")
+    return await reader.readexactly(length)
+
+
+def parse_address(address: str) -> tuple:
+    """
+    Return ("unix", path) or ("tcp", (host, port)) for a server address
+    """
+
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:") :]
+
+    host, _, port = address.rpartition(":")
+    return "tcp", (host or "127.0.0.1", int(port))
+
+
+class DebugServer:
+    """
+    Serve debug requests for a machine on an asyncio event loop
+    """
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.snapshots = {}  # slot -> Machine.snapshot()
+
+    async def start(self, address: str):
+        """
+        Start listening on `address`, see `parse_address`
+        """
+
+        kind, where = parse_address(address)
+        if kind == "unix":
+            self.server = await asyncio.start_unix_server(self.handle_client, where)
+        else:
+            self.server = await asyncio.start_server(self.handle_client, *where)
+
+        print(f"Debug server listening on {address}")
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                request = await read_frame(reader)
+                response = await self.handle_request(request)
+                writer.write(struct.pack(">I", len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # client went away
+        except Exception as e:
+            print(f"Debug server closed connection: {e}")
+        finally:
+            writer.close()
+
+    async def handle_request(self, request: bytes) -> bytes:
+        """
+        Execute a batch of commands, return the response frame
+        """
+
+        reader = Reader(request)
+        num_commands = reader.read("H")
+
+        results = [struct.pack(">H", num_commands)]
+        for _ in range(num_commands):
+            command = reader.read("B")
+            if command not in COMMAND_NAMES:
+                # the arguments can not be skipped, nothing after it is readable
+                utils.ERROR(f"Unknown command {command}")
+
+            try:
+                data = getattr(self, f"do_{COMMAND_NAMES[command]}")(reader)
+                if asyncio.iscoroutine(data):
+                    data = await data
+                results.append(struct.pack(">B", STATUS_OK) + data)
+            except struct.error:
+                raise  # malformed request
+            except Exception as e:
+                results.append(struct.pack(">B", STATUS_ERROR) + pack_str(str(e)))
+
+        # anything may have changed, let the machine run again
+        if self.machine.wake_event is not None:
+            self.machine.wake_event.set()
+
+        return b"".join(results)
+
+    async def do_step(self, reader) -> bytes:
+        num_instructions = reader.read("I")
+        self.machine.wake()  # count the parked time first
+
+        # in slices, like run_machine, so frames and other clients are
+        # served meanwhile
+        executed = 0
+        while executed < num_instructions and not self.machine.halted:
+            executed += self.machine.run(min(SLICE_INSTRUCTIONS, num_instructions - executed))
+            await asyncio.sleep(0)
+
+        return struct.pack(">I", executed)
+
+    def do_continue(self, reader) -> bytes:
+        self.machine.stop_at_breakpoints = bool(self.machine.breakpoints)
+        self.machine.running_free = True
+        self.machine.wake()
+        return b""
+
+    def do_break(self, reader) -> bytes:
+        self.machine.running_free = False
+        self.machine.wake()
+        return b""
+
+    def do_reset(self, reader) -> bytes:
+        self.machine.reset()
+        return b""
+
+    def do_read_memory(self, reader) -> bytes:
+        start, count = reader.read("HH")
+
+        if start + count > len(self.machine.memory):
+            utils.ERROR(f"Can not read {count} words at {start}, memory ends at {len(self.machine.memory)}")
+
+        return b"".join(pack_word(word) for word in self.machine.memory[start : start + count])
+
+    def do_write_memory(self, reader) -> bytes:
+        start, count = reader.read("HH")
+        words = [reader.read_word() for _ in range(count)]
+
+        if start + count > len(self.machine.memory):
+            utils.ERROR(f"Can not write {count} words at {start}, memory ends at {len(self.machine.memory)}")
+
+        for address, word in enumerate(words, start):
+            if isinstance(word, int):
+                self.machine.set_memory(address, word)
+            else:
+                self.machine.mark_memory_change(address, word)
+                self.machine.memory[address] = word
+
+        return b""
+
+    def do_read_state(self, reader) -> bytes:
+        machine = self.machine
+        return struct.pack(
+            ">18q4BQ2B",
+            *[utils.get_decimal_int(machine.registers[name]) for name in REGISTER_NAMES],
+            *[machine.flags[name] for name in FLAG_NAMES],
+            machine.instruction_count,
+            machine.halted,
+            machine.running_free,
+        )
+
+    def do_set_register(self, reader) -> bytes:
+        index, value = reader.read("Bq")
+        if index >= len(REGISTER_NAMES):
+            utils.ERROR(f"Unknown register number {index}")
+        self.machine.set_register(REGISTER_NAMES[index], value)
+        return b""
+
+    def do_breakpoint(self, reader) -> bytes:
+        address, on = reader.read("HB")
+        if on and address not in self.machine.breakpoints:
+            self.machine.breakpoints.append(address)
+        elif not on and address in self.machine.breakpoints:
+            self.machine.breakpoints.remove(address)
+        return b""
+
+    def do_save_snapshot(self, reader) -> bytes:
+        self.snapshots[reader.read("B")] = self.machine.snapshot()
+        return b""
+
+    def do_load_snapshot(self, reader) -> bytes:
+        slot = reader.read("B")
+        if slot not in self.snapshots:
+            utils.ERROR(f"No snapshot in slot {slot}")
+        self.machine.restore(self.snapshots[slot])
+        return b""
+
+    def do_press_key(self, reader) -> bytes:
+        key_name = reader.read_str()
+        self.machine.register_keypress(key_name)
+        return b""
+
+
+async def run_machine(machine):
+    """
+    Run `machine` on this event loop while it is running free, in slices of
+    SLICE_INSTRUCTIONS, serving requests, frames and file changes between
+    them. Wait without using the CPU while it is halted, paused or waiting
+    for a keypress: the machine gets an asyncio.Event as `wake_event`,
+    which `Machine.wake`, resets and the debug server set.
+    """
+
+    machine.wake_event = asyncio.Event()
+
+    async def wait_for_wake():
+        await machine.wake_event.wait()
+        machine.wake_event.clear()
+
+    while True:
+        if machine.halted or not machine.running_free:
+            await wait_for_wake()
+            continue
+
+        for _ in range(SLICE_INSTRUCTIONS):
+            if machine.halted or not machine.running_free:
+                break
+            try:
+                waiting = machine.step_free()
+            except Exception as e:
+                print(f"Machine stopped: {e}")
+                machine.running_free = False
+                break
+            if waiting:
+                machine.start_parking()
+                await wait_for_wake()
+                machine.wake()  # count the parked time, if not done yet
+                machine.wake_event.clear()
+                break
+
+        await asyncio.sleep(0)  # serve requests
+
+
+async def serve_headless(machine, address: str):
+    """
+    Serve `machine` on `address` and run it without a window, forever
+    """
+
+    await DebugServer(machine).start(address)
+    await run_machine(machine)
+
+
+class DebugClient:
+    """
+    Blocking client for the debug server
+    """
+
+    def __init__(self, address: str):
+        kind, where = parse_address(address)
+        family = socket.AF_UNIX if kind == "unix" else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.connect(where)
+
+    def close(self):
+        self.socket.close()
+
+    def request(self, commands: list) -> list:
+        """
+        Send a batch of commands, e.g. [("step", 100), ("read_state",)].
+        Return their results, errors are raised.
+        """
+
+        request = [struct.pack(">H", len(commands))]
+        for name, *args in commands:
+            request.append(struct.pack(">B", PROTOCOL_COMMANDS[name]) + self.pack_args(name, args))
+        request = b"".join(request)
+
+        self.socket.sendall(struct.pack(">I", len(request)) + request)
+        reader = Reader(self.receive_frame())
+
+        results = []
+        num_results = reader.read("H")
+        for name, *args in commands[:num_results]:
+            if reader.read("B") == STATUS_ERROR:
+                utils.ERROR(f"{name} failed: {reader.read_str()}")
+            results.append(self.unpack_result(name, args, reader))
+
+        return results
+
+    def receive_frame(self) -> bytes:
+        length = struct.unpack(">I", self.receive_exactly(4))[0]
+        return self.receive_exactly(length)
+
+    def receive_exactly(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                utils.ERROR("Debug server closed the connection")
+            data += chunk
+        return data
+
+    @staticmethod
+    def pack_args(name: str, args: list) -> bytes:
+        if name == "step":
+            return struct.pack(">I", *args)
+        elif name == "read_memory":
+            return struct.pack(">HH", *args)
+        elif name == "write_memory":
+            start, words = args
+            return struct.pack(">HH", start, len(words)) + b"".join(pack_word(w) for w in words)
+        elif name == "set_register":
+            register, value = args
+            return struct.pack(">Bq", REGISTER_NAMES.index(register), value)
+        elif name == "breakpoint":
+            address, on = args
+            return struct.pack(">HB", address, on)
+        elif name in {"save_snapshot", "load_snapshot"}:
+            return struct.pack(">B", *args)
+        elif name == "press_key":
+            return pack_str(*args)
+        return b""
+
+    @staticmethod
+    def unpack_result(name: str, args: list, reader: Reader):
+        if name == "step":
+            return reader.read("I")
+        elif name == "read_memory":
+            return [reader.read_word() for _ in range(args[1])]
+        elif name == "read_state":
+            values = reader.read("18q4BQ2B")
+            return {
+                "registers": dict(zip(REGISTER_NAMES, values[:18])),
+                "flags": dict(zip(FLAG_NAMES, values[18:22])),
+                "instruction_count": values[22],
+                "halted": bool(values[23]),
+                "running": bool(values[24]),
+            }
+        return None
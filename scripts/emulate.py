@@ -3,150 +3,61 @@
 # includes pg and enum
 from emulation_config import *
 
+import asyncio
+import atexit
 import threading
 import sys
 import numpy as np
-import re
 import easygui
 import time
 
 import utils
-import array_manip as am
-from machine import Machine, TICK_DELAY_S
+from frames import (
+    MAP_SIZE_X_TILES,
+    MAP_SIZE_Y_TILES,
+    TILE_SIZE_PX,
+    load_tile_images,
+    render_map,
+)
+from machine import Machine
+from binary_machine import BinaryMachine
+from input_script import read_input_script, write_input_script
+from debug_server import DebugServer, run_machine, serve_headless
+from watch import watch_program
+from record import (
+    DEFAULT_EVERY_K_INSTRUCTIONS,
+    DEFAULT_NUM_FRAMES,
+    print_summary,
+    record_frames,
+)
 
 
 # Global variables
-CONSTANTS = {}
-PALETTE = []
+TILE_IMAGES = None
 window_scale = 1
 
 # Constants
 BEEP_VOLUME = 0.1
+BEEP_POLL_S = 0.01  # how often the beeper looks at GR14
 SAMPLE_RATE = 44100
 FPS = 60
 SURFACE_WIDTH_PX = 640
 SURFACE_HEIGHT_PX = 480
-# With MENU implemented, map tile size is unsymmetrical can not use (MAP_SIZE_TILES = 10)
-MAP_SIZE_X_TILES = 13
-MAP_SIZE_Y_TILES = 10
-# With MENU implemented, map tile size is unsymmetrical can not use (MAP_SIZE_PX = SURFACE_HEIGHT_PX)
-MAP_SIZE_X_PX = (
-    MAP_SIZE_X_TILES * 12 * 4
-)  # ( amount of tiles x axis*amount of macropixels x axis*macropixel size)
-MAP_SIZE_Y_PX = (
-    MAP_SIZE_Y_TILES * 12 * 4
-)  # ( amount of tiles y axis*amount of macropixels y axis*macropixel size)
-TILE_SIZE_PX = 48  # Commented out (MAP_SIZE_PX // MAP_SIZE_TILES) because it should not be dependent on neither of them
 FONT_PATH = os.path.join("scripts", "fonts", "jetbrainsmono.ttf")
 
 
 DEBUG_ASSEMBLY_FILE = "path.s"  # change this to which file you want to debug
 
 
-def read_palette(tile_rom_lines: list) -> list:
-    """
-    Read the palette from lines of tile_rom.vhd
-    """
-
-    palette_array = am.extract_vhdl_array(
-        tile_rom_lines, r"\s*CONSTANT\s*palette_rom.*"
-    )
-    palette_elements = am.get_vhdl_array_elements(
-        palette_array, element_pattern=r'\d+ => x"\w+"'
-    )
-
-    palette = []
-
-    for elem in palette_elements:
-        # Extract the 3-digit hex values
-        hex_color = re.search(r'x"(\w+)"', elem).group(1)
-        # Convert to 0-255 r,g,b values
-        r = int(hex_color[0:2], 16)
-        g = int(hex_color[2:4], 16)
-        b = int(hex_color[4:6], 16)
-        palette.append((r, g, b))
-
-    return palette
-
-
-def read_tile_rom(tile_rom_lines: list) -> np.ndarray:
-    """
-    Read the tile ROM from lines of tile_rom.vhd
-    """
-
-    tile_rom_array = am.extract_vhdl_array(
-        tile_rom_lines, r"\s*CONSTANT.*tile_rom_type\s*:="
-    )
-    tile_rom_elements = am.get_vhdl_array_elements(
-        lines=tile_rom_array, element_pattern=r"\d+"
-    )
-
-    # Flatten the list comprehension to create a flat list of elements
-    tile_rom = []
-    for elem in tile_rom_elements:
-        tile_rom += [int(re.search(r"\d+", elem).group(0), 2)]
-
-    return np.array(tile_rom, dtype=np.uint8)
-
-
-def get_tile(tile_type: int, tile_rom: list) -> pg.Surface:
-    """
-    Get tile appearance from tile ROM, use the values from it to fetch
-    real colors from the palette.
-    """
-
-    TILE_SIZE_MACROPIXELS = TILE_SIZE_PX // 4  # 12x12 macropixels per tile
-
-    surface = pg.Surface((TILE_SIZE_MACROPIXELS, TILE_SIZE_MACROPIXELS))
-
-    # Get the tile from the tile ROM
-    tile_data = tile_rom[
-        tile_type
-        * TILE_SIZE_MACROPIXELS**2 : (tile_type + 1)
-        * TILE_SIZE_MACROPIXELS**2
-    ]
-
-    # Map the palette indices to colors
-    tile_colors = []
-    for palette_index in tile_data:
-        tile_colors.append(PALETTE[palette_index])
-
-    for y in range(TILE_SIZE_MACROPIXELS):
-        for x in range(TILE_SIZE_MACROPIXELS):
-            color = tile_colors[y * TILE_SIZE_MACROPIXELS + x]
-            surface.set_at((x, y), color)
-    return pg.transform.scale(surface, (TILE_SIZE_PX, TILE_SIZE_PX))
-
-
-def get_map_surface(machine, tile_rom):
+def get_map_surface(machine, tile_images):
     """
     Draw the map from video memory to a surface, return it.
     """
 
-    VMEM = machine.sections["VMEM"].start
-
-    surface = pg.Surface(
-        (MAP_SIZE_X_TILES * TILE_SIZE_PX, MAP_SIZE_Y_TILES * TILE_SIZE_PX)
-    )
-
-    for y in range(MAP_SIZE_Y_TILES):
-        for x in range(MAP_SIZE_X_TILES):
-            id = y * MAP_SIZE_X_TILES + x
-            vmem_row = machine.memory[VMEM + id]
-            current_tile_type = utils.get_decimal_int(vmem_row)
-            if current_tile_type > tile_rom.size // 144:
-                raise ValueError(
-                    f"""
-    VMEM contains too big tile type {current_tile_type} at address VMEM+{id} (x={x}, y={y}).
-    Tile ROM only has {tile_rom.size // 144} tiles.
-    """
-                )
+    map_rgb = render_map(machine, tile_images)
 
-            tile = get_tile(current_tile_type, tile_rom)
-            tile_pos = (x * TILE_SIZE_PX, y * TILE_SIZE_PX)
-            surface.blit(tile, tile_pos)
-
-    return surface
+    # surfarray is indexed (x, y), the rendered map (y, x)
+    return pg.surfarray.make_surface(map_rgb.swapaxes(0, 1))
 
 
 def handle_args():
@@ -156,6 +67,28 @@ def handle_args():
 
     if len(sys.argv) < 2:
         print("Usage: python emulate.py <assembly_file.s> <args>")
+        print(
+            "       python emulate.py <image.bin|pMem.vhd> <args>  run assembled machine code"
+        )
+        print(
+            "       python emulate.py <assembly_file.s> --record <out_dir> "
+            "[--frames N] [--every-k-instructions K] [--format png|raw]"
+        )
+        print(
+            "       --input-script <file>  replay keypresses from an input script"
+        )
+        print(
+            "       --record-input <file>  save keypresses as an input script on exit"
+        )
+        print(
+            "       --check-limits  stop on stack overflow into sections and values above 24 bits"
+        )
+        print(
+            "       --serve <[host:]port|unix:path> [--headless]  run the debug server"
+        )
+        print(
+            "       --watch  reload the program into the running machine when its files change"
+        )
         sys.exit(1)
 
     if sys.argv[1] == "--debug":
@@ -259,6 +192,8 @@ def get_nearest_lines(machine, pc_value):
             continue
 
         line = machine.memory[i]
+        if isinstance(machine, BinaryMachine):
+            line = machine.image.lines[i] or machine.disassemble(line)
 
         nearest_line = f"{i:3}:\u3000{line}"
         if i == pc_value:
@@ -309,6 +244,11 @@ def get_debug_pane(machine, surface_size):
 
     debug_text_lines += [flags_line]
 
+    # --- COUNTS ---
+    debug_text_lines += ["", "<b>Counts"]
+    debug_text_lines += [f"{machine.instruction_count} instructions"]
+    debug_text_lines += [f"{machine.cycle_count} cycles"]
+
     blit_textlines_to_surface(debug_surface, debug_text_lines, font)
 
     # Draw a border around the debug_surface
@@ -335,7 +275,7 @@ def update_screen(screen, machine, show_debug_pane, cursor_position):
     )
 
     # Draw game map
-    map_surface = get_map_surface(machine, TILE_ROM)
+    map_surface = get_map_surface(machine, TILE_IMAGES)
     small_surface.blit(map_surface, (0, 0))
     scaled_surface = pg.transform.scale_by(small_surface, window_scale)
     screen.blit(scaled_surface, (0, 0))
@@ -515,6 +455,7 @@ def beeper_handler(machine):
     global current_frequency
 
     while True:
+        time.sleep(BEEP_POLL_S)
 
         if machine.running_free is False:
             end_beep()
@@ -527,61 +468,66 @@ def beeper_handler(machine):
 
         begin_beep(frequency)
 
-        time.sleep(TICK_DELAY_S)
 
+async def run_emulator(screen, machine, serve_address=None, watch_file_name=None):
+    """
+    Run the window and the machine, and on the same event loop the debug
+    server if `serve_address` is given and the file watcher if
+    `watch_file_name` is. Only this thread changes the machine.
+    """
 
-if __name__ == "__main__":
-    # change the working directory to the root of the project
-    utils.change_dir_to_root()
+    if serve_address is not None:
+        await DebugServer(machine).start(serve_address)
+    if watch_file_name is not None:
+        asyncio.create_task(watch_program(machine, watch_file_name))
 
-    # get tile_rom and palette from tile_rom.vhd
-    tile_rom_lines = open(TILE_ROM_FILE).readlines()
-    PALETTE = read_palette(tile_rom_lines)
-    TILE_ROM = read_tile_rom(tile_rom_lines)
+    asyncio.create_task(run_machine(machine))
+    await run_window(screen, machine)
 
-    # find which assembly file to emulate
-    asm_file_name = handle_args()
 
-    # create machine object
-    machine = Machine(asm_file_name)
+async def serve_and_watch(machine, serve_address, watch_file_name=None):
+    """
+    Run the debug server without a window, and the file watcher if
+    `watch_file_name` is given
+    """
 
-    show_debug_pane = False  # show machine state on screen
+    if watch_file_name is not None:
+        asyncio.create_task(watch_program(machine, watch_file_name))
 
-    # initialise pg
-    pg.init()
-    pg.mixer.init(channels=2, frequency=SAMPLE_RATE)
-    screen = pg.display.set_mode(
-        (window_scale * SURFACE_WIDTH_PX, window_scale * SURFACE_HEIGHT_PX),
-        PYGAME_FLAGS,
-    )
-    pg.display.set_caption(WINDOW_TITLE)
-    cursor_position = (-1, -1)
-    update_screen(screen, machine, show_debug_pane, cursor_position)
+    await serve_headless(machine, serve_address)
 
-    clock = pg.time.Clock()
 
-    # Start a new thread that will run machine fast whenever `running_free` is True
-    # This is done to prevent the main thread from being blocked by the machine
-    machine_run_thread = threading.Thread(target=machine.run_fast)
-    machine_run_thread.daemon = True
-    machine_run_thread.start()
+async def run_window(screen, machine):
+    """
+    Draw the machine and handle window events, FPS times per second
+    """
 
-    beep_thread = threading.Thread(target=beeper_handler, args=(machine,))
-    beep_thread.daemon = True
-    beep_thread.start()
+    show_debug_pane = False  # show machine state on screen
+    cursor_position = (-1, -1)
 
+    drawn_state = None
     while True:
-        update_screen(screen, machine, show_debug_pane, cursor_position)
+        frame_start = time.perf_counter()
+
+        # only draw when something changed, an idle machine costs no CPU
+        state = (machine.instruction_count, machine.halted, machine.running_free)
+        if state != drawn_state:
+            update_screen(screen, machine, show_debug_pane, cursor_position)
+            drawn_state = state
+
+        # wait for the next frame, serving debug requests meanwhile
+        await asyncio.sleep(max(0, 1 / FPS - (time.perf_counter() - frame_start)))
 
-        clock.tick(FPS)
         for event in pg.event.get():
+            drawn_state = None  # redraw after any event
+
             if event.type == pg.QUIT:
                 sys.exit()
             elif event.type == pg.KEYDOWN:
 
                 # handle in-game keypresses
                 if event.key not in KEYBINDINGS:
-                    machine.register_keypress(event.key)
+                    machine.register_keypress(GAME_KEYS.get(event.key))
                     continue
 
                 emulation_event = KEYBINDINGS.get(event.key)
@@ -621,3 +567,87 @@ if __name__ == "__main__":
                     cursor_position = (-1, -1)
                     continue
                 cursor_position = event.pos
+
+
+if __name__ == "__main__":
+    # change the working directory to the root of the project
+    utils.change_dir_to_root()
+
+    # get tile images from tile ROM and palette in tile_rom.vhd
+    TILE_IMAGES = load_tile_images()
+
+    # find which assembly file to emulate
+    asm_file_name = handle_args()
+
+    # create machine object, assembled images start without assembling
+    if asm_file_name.endswith((".bin", ".vhd")):
+        machine = BinaryMachine(asm_file_name)
+    else:
+        machine = Machine(asm_file_name)
+    machine.check_limits = "--check-limits" in sys.argv
+
+    # replay scripted keypresses
+    input_script_file = utils.get_arg_value(sys.argv, "--input-script")
+    if input_script_file is not None:
+        machine.schedule_inputs(read_input_script(input_script_file))
+
+    # save keypresses of this session as input script
+    record_input_file = utils.get_arg_value(sys.argv, "--record-input")
+    if record_input_file is not None:
+        machine.start_input_recording()
+        atexit.register(
+            lambda: write_input_script(record_input_file, machine.recorded_inputs)
+        )
+
+    # headless recording, never opens a window
+    record_dir = utils.get_arg_value(sys.argv, "--record")
+    if record_dir is not None:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        num_frames = int(utils.get_arg_value(sys.argv, "--frames", DEFAULT_NUM_FRAMES))
+        every_k_instructions = int(
+            utils.get_arg_value(
+                sys.argv, "--every-k-instructions", DEFAULT_EVERY_K_INSTRUCTIONS
+            )
+        )
+        frame_format = utils.get_arg_value(sys.argv, "--format", "png")
+
+        num_written = record_frames(
+            machine,
+            record_dir,
+            num_frames,
+            every_k_instructions,
+            frame_format,
+            tile_images=TILE_IMAGES,
+        )
+        print_summary(record_dir, frame_format, num_written)
+        sys.exit(0)
+
+    # hot reload, see watch.py
+    watch_file_name = None
+    if "--watch" in sys.argv:
+        if isinstance(machine, BinaryMachine):
+            utils.ERROR("--watch needs an assembly file, not an assembled image")
+        watch_file_name = asm_file_name
+
+    # debug server, see debug_server.py
+    serve_address = utils.get_arg_value(sys.argv, "--serve")
+    if "--headless" in sys.argv:
+        if serve_address is None:
+            utils.ERROR("--headless needs a debug server address, e.g. --serve 5555")
+        asyncio.run(serve_and_watch(machine, serve_address, watch_file_name))
+        sys.exit(0)
+
+    # initialise pg
+    pg.init()
+    pg.mixer.init(channels=2, frequency=SAMPLE_RATE)
+    screen = pg.display.set_mode(
+        (window_scale * SURFACE_WIDTH_PX, window_scale * SURFACE_HEIGHT_PX),
+        PYGAME_FLAGS,
+    )
+    pg.display.set_caption(WINDOW_TITLE)
+
+    beep_thread = threading.Thread(target=beeper_handler, args=(machine,))
+    beep_thread.daemon = True
+    beep_thread.start()
+
+    asyncio.run(run_emulator(screen, machine, serve_address, watch_file_name))
@@ -11,7 +11,6 @@ WINDOW_TITLE = "monkey-emulator🐒"
 FONT_SIZE = 16
 
 # File paths
-TILE_ROM_FILE = os.path.join("hardware", "tile_rom.vhd")
 MASM_DIR = "masm"
 
 
@@ -27,6 +26,16 @@ class EmulationEvent(Enum):
     resume = auto()
 
 
+# pygame keys that are passed on to the machine, see machine.KEY_NUMBERS
+GAME_KEYS = {
+    pg.K_a: "a",
+    pg.K_d: "d",
+    pg.K_w: "w",
+    pg.K_s: "s",
+    pg.K_SPACE: "space",
+    pg.K_RETURN: "return",
+}
+
 KEYBINDINGS = {
     pg.K_n: EmulationEvent.step,
     pg.K_F10: EmulationEvent.step,
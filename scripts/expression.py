@@ -0,0 +1,110 @@
+"""
+Evaluate constant integer expressions without eval(): operands and data
+words of masm lines once labels, macros and sections are substituted
+(`1500+56`, `1700+1`), and the constants of the VHDL files (`12 * 12`).
+
+    expression := or
+    or         := and ("|" and)*
+    and        := shift ("&" shift)*
+    shift      := sum (("<<" | ">>") sum)*
+    sum        := product (("+" | "-") product)*
+    product    := unary ("*" unary)*
+    unary      := ("+" | "-") unary | "(" expression ")" | number
+
+Numbers are binary (0b101), hexadecimal (0x1F or $1F) or decimal, the
+operators have the precedence they have in Python. Tokens come from
+lexer.py, so comments after an expression are ignored.
+
+Results are memoized by the expression string: the machines evaluate the
+same operands over and over, each is parsed once per process.
+"""
+
+import operator
+from functools import lru_cache
+
+import utils
+from lexer import tokenize, strip
+
+# binary operators by precedence, lowest first
+BINARY_OPERATORS = [
+    {"|": operator.or_},
+    {"&": operator.and_},
+    {"<<": operator.lshift, ">>": operator.rshift},
+    {"+": operator.add, "-": operator.sub},
+    {"*": operator.mul},
+]
+UNARY_OPERATORS = {"+": operator.pos, "-": operator.neg}
+
+
+class ExpressionParser:
+    """
+    Parse and evaluate one expression by recursive descent
+    """
+
+    def __init__(self, expr: str):
+        self.expr = expr
+        self.tokens = strip(tokenize(expr))
+        self.position = 0
+
+    def fail(self, reason: str):
+        utils.ERROR(f"Invalid expression `{self.expr.strip()}`: {reason}")
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            self.fail("unexpected end")
+        self.position += 1
+        return token
+
+    def parse(self) -> int:
+        value = self.parse_binary(0)
+        if self.peek() is not None:
+            self.fail(f"unexpected `{self.peek().text}`")
+        return value
+
+    def parse_binary(self, level: int) -> int:
+        if level == len(BINARY_OPERATORS):
+            return self.parse_unary()
+
+        operators = BINARY_OPERATORS[level]
+        value = self.parse_binary(level + 1)
+        while self.peek() is not None and self.peek().kind == "operator":
+            function = operators.get(self.peek().text)
+            if function is None:
+                break
+            self.position += 1
+            right = self.parse_binary(level + 1)
+            if function in {operator.lshift, operator.rshift} and right < 0:
+                self.fail("negative shift count")
+            value = function(value, right)
+
+        return value
+
+    def parse_unary(self) -> int:
+        token = self.take()
+
+        if token.kind == "operator" and token.text in UNARY_OPERATORS:
+            return UNARY_OPERATORS[token.text](self.parse_unary())
+        if token.text == "(":
+            value = self.parse_binary(0)
+            if self.take().text != ")":
+                self.fail("missing `)`")
+            return value
+        if token.kind == "number":
+            return utils.get_decimal_int(token.text)
+
+        self.fail(f"unknown symbol `{token.text}`")
+
+
+@lru_cache(maxsize=65536)
+def evaluate(expr: str) -> int:
+    """
+    Return the integer value of a constant expression
+    """
+
+    return ExpressionParser(expr).parse()
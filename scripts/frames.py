@@ -0,0 +1,216 @@
+"""
+Render the game map from the memory of a machine into plain RGB arrays.
+
+Nothing in here depends on pygame, so frames can be produced on machines
+without a display (or without pygame installed at all). emulate.py converts
+the arrays to pygame surfaces, the headless recorder writes them to disk.
+"""
+
+import os, re, struct, zlib
+import numpy as np
+
+import array_manip as am
+import utils
+
+TILE_ROM_FILE = os.path.join(utils.ROOT_DIR, "hardware", "tile_rom.vhd")
+
+# With MENU implemented, map tile size is unsymmetrical can not use (MAP_SIZE_TILES = 10)
+MAP_SIZE_X_TILES = 13
+MAP_SIZE_Y_TILES = 10
+TILE_SIZE_MACROPIXELS = 12  # 12x12 macropixels per tile
+MACROPIXEL_SIZE_PX = 4
+TILE_SIZE_PX = TILE_SIZE_MACROPIXELS * MACROPIXEL_SIZE_PX  # 48
+# ( amount of tiles x axis*amount of macropixels x axis*macropixel size)
+MAP_SIZE_X_PX = MAP_SIZE_X_TILES * TILE_SIZE_PX
+# ( amount of tiles y axis*amount of macropixels y axis*macropixel size)
+MAP_SIZE_Y_PX = MAP_SIZE_Y_TILES * TILE_SIZE_PX
+
+
+def read_palette(tile_rom_lines: list) -> list:
+    """
+    Read the palette from lines of tile_rom.vhd
+    """
+
+    palette_array = am.extract_vhdl_array(
+        tile_rom_lines, r"\s*CONSTANT\s*palette_rom.*"
+    )
+    palette_elements = am.get_vhdl_array_elements(
+        palette_array, element_pattern=r'\d+ => x"\w+"'
+    )
+
+    palette = []
+
+    for elem in palette_elements:
+        # Extract the 3-digit hex values
+        hex_color = re.search(r'x"(\w+)"', elem).group(1)
+        # Convert to 0-255 r,g,b values
+        r = int(hex_color[0:2], 16)
+        g = int(hex_color[2:4], 16)
+        b = int(hex_color[4:6], 16)
+        palette.append((r, g, b))
+
+    return palette
+
+
+def read_tile_rom(tile_rom_lines: list) -> np.ndarray:
+    """
+    Read the tile ROM from lines of tile_rom.vhd
+    """
+
+    tile_rom_array = am.extract_vhdl_array(
+        tile_rom_lines, r"\s*CONSTANT.*tile_rom_type\s*:="
+    )
+    tile_rom_elements = am.get_vhdl_array_elements(
+        lines=tile_rom_array, element_pattern=r"\d+"
+    )
+
+    # Flatten the list comprehension to create a flat list of elements
+    tile_rom = []
+    for elem in tile_rom_elements:
+        tile_rom += [int(re.search(r"\d+", elem).group(0), 2)]
+
+    return np.array(tile_rom, dtype=np.uint8)
+
+
+def get_tile_images(tile_rom: np.ndarray, palette: list) -> np.ndarray:
+    """
+    Look up every macropixel of the tile ROM in the palette and scale
+    the tiles up to screen size.
+
+    Return array of shape (number of tiles, TILE_SIZE_PX, TILE_SIZE_PX, 3)
+    """
+
+    num_tiles = tile_rom.size // TILE_SIZE_MACROPIXELS**2
+    tile_rom = tile_rom[: num_tiles * TILE_SIZE_MACROPIXELS**2]
+
+    palette_array = np.array(palette, dtype=np.uint8)
+    tiles = palette_array[tile_rom].reshape(
+        num_tiles, TILE_SIZE_MACROPIXELS, TILE_SIZE_MACROPIXELS, 3
+    )
+
+    # every macropixel becomes MACROPIXEL_SIZE_PX x MACROPIXEL_SIZE_PX pixels
+    tiles = tiles.repeat(MACROPIXEL_SIZE_PX, axis=1)
+    tiles = tiles.repeat(MACROPIXEL_SIZE_PX, axis=2)
+
+    return tiles
+
+
+def load_tile_images(tile_rom_file: str = TILE_ROM_FILE) -> np.ndarray:
+    """
+    Read tile ROM and palette from `tile_rom_file` (tile_rom.vhd),
+    return the tile images as given by `get_tile_images`.
+    """
+
+    tile_rom_lines = open(tile_rom_file).readlines()
+    palette = read_palette(tile_rom_lines)
+    tile_rom = read_tile_rom(tile_rom_lines)
+
+    return get_tile_images(tile_rom, palette)
+
+
+def get_vmem_tile_types(machine) -> np.ndarray:
+    """
+    Return the tile types of the map as a (MAP_SIZE_Y_TILES, MAP_SIZE_X_TILES) array
+    """
+
+    VMEM = machine.sections["VMEM"].start
+    num_map_tiles = MAP_SIZE_X_TILES * MAP_SIZE_Y_TILES
+
+    tile_types = [
+        utils.get_decimal_int(row) for row in machine.memory[VMEM : VMEM + num_map_tiles]
+    ]
+
+    return np.array(tile_types, dtype=np.int64).reshape(
+        MAP_SIZE_Y_TILES, MAP_SIZE_X_TILES
+    )
+
+
+def render_map(machine, tile_images: np.ndarray) -> np.ndarray:
+    """
+    Draw the map from video memory of `machine`.
+
+    Return RGB array of shape (MAP_SIZE_Y_PX, MAP_SIZE_X_PX, 3)
+    """
+
+    tile_types = get_vmem_tile_types(machine)
+    num_tiles = len(tile_images)
+
+    too_big = np.argwhere(tile_types >= num_tiles)
+    if too_big.size:
+        y, x = too_big[0]
+        id = y * MAP_SIZE_X_TILES + x
+        raise ValueError(
+            f"""
+    VMEM contains too big tile type {tile_types[y, x]} at address VMEM+{id} (x={x}, y={y}).
+    Tile ROM only has {num_tiles} tiles.
+    """
+        )
+
+    # (tiles y, tiles x, px y, px x, rgb) -> (px y total, px x total, rgb)
+    frame = tile_images[tile_types]
+    frame = frame.transpose(0, 2, 1, 3, 4)
+
+    return frame.reshape(MAP_SIZE_Y_PX, MAP_SIZE_X_PX, 3)
+
+
+def write_png(file_name: str, rgb: np.ndarray):
+    """
+    Write RGB array of shape (height, width, 3) as a PNG image
+    """
+
+    height, width, _ = rgb.shape
+
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        body = chunk_type + data
+        return (
+            struct.pack(">I", len(data))
+            + body
+            + struct.pack(">I", zlib.crc32(body) & 0xFFFFFFFF)
+        )
+
+    # every scanline starts with filter type 0 (none)
+    scanlines = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = rgb.reshape(height, width * 3)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+
+    with open(file_name, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", header))
+        f.write(chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def read_png(file_name: str) -> np.ndarray:
+    """
+    Read a PNG image written by `write_png` back into an RGB array.
+    Only 8-bit RGB images without scanline filters are supported.
+    """
+
+    data = open(file_name, "rb").read()
+    if not data.startswith(b"\x89PNG\r\n\x1a\n"):
+        utils.ERROR(f"{file_name} is not a PNG image")
+
+    position = 8
+    idat = b""
+    while position < len(data):
+        (length,) = struct.unpack(">I", data[position : position + 4])
+        chunk_type = data[position + 4 : position + 8]
+        chunk_data = data[position + 8 : position + 8 + length]
+        position += length + 12
+
+        if chunk_type == b"IHDR":
+            width, height, bit_depth, color_type = struct.unpack(
+                ">IIBB", chunk_data[:10]
+            )
+            if (bit_depth, color_type) != (8, 2):
+                utils.ERROR(f"{file_name} is not an 8-bit RGB image")
+        elif chunk_type == b"IDAT":
+            idat += chunk_data
+
+    scanlines = np.frombuffer(zlib.decompress(idat), dtype=np.uint8)
+    scanlines = scanlines.reshape(height, width * 3 + 1)
+    if scanlines[:, 0].any():
+        utils.ERROR(f"{file_name} uses PNG filters, which are not supported")
+
+    return scanlines[:, 1:].reshape(height, width, 3).copy()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Coverage-guided fuzzer for the keypress inputs of the programs in masm/.
+
+The program is booted once with the keypresses of `--prefix` until it first
+reaches `--snapshot-at` (the start of the shopping phase by default), and
+the machine state there is kept in memory. Every run restores that snapshot
+instead of booting again, then replays a mutated sequence of keypresses
+(the keys of machine.KEY_NUMBERS) for `--budget` instructions.
+
+Runs are done in parallel worker processes. A run that executes an address
+no run has executed before joins the corpus and is mutated further. Runs
+stopped by an error are crashes: errors of the machine such as empty
+instructions and unknown registers, and with `Machine.check_limits` the
+stack pointer running into a section or values above 24 bits.
+
+Every crash is written to <out>/crashes/ as an input script (prefix
+included) with its error as comment, replay it with
+    python emulate.py <program.s> --check-limits --input-script <crash.txt>
+The corpus is written to <out>/corpus/.
+
+Usage: python fuzz.py [program.s] [--prefix <script.txt>] [--snapshot-at <label>]
+       [--budget N] [--rounds N] [--batch N] [--workers N] [--seed N] [--out <dir>]
+e.g.
+    python fuzz.py path.s --prefix masm/inputs/path_start.txt
+"""
+
+import os, random, sys, time
+from concurrent.futures import ProcessPoolExecutor
+
+import utils
+from utils import COLORS
+from machine import KEY_NUMBERS, Machine
+from program import MEMORY_HEIGHT
+from input_script import read_input_script, write_input_script
+
+DEFAULT_PROGRAM = "path.s"
+DEFAULT_SNAPSHOT_LABEL = "shopping_phase"
+DEFAULT_BUDGET = 50000  # instructions per run after the snapshot
+DEFAULT_ROUNDS = 20
+DEFAULT_BATCH = 64  # runs per round
+DEFAULT_OUT_DIR = "fuzz_out"
+BOOT_LIMIT = 1000000  # instructions to reach the snapshot label
+MAX_EVENTS = 32  # keypresses per run
+MAX_MUTATIONS = 4  # stacked mutations per new input
+KEYS = list(KEY_NUMBERS)
+
+# machine and snapshot of the worker process
+_worker = {}
+
+
+def boot(program: str, prefix_events: list, snapshot_label: str) -> Machine:
+    """
+    Run `program` with the keypresses `prefix_events` until it reaches
+    `snapshot_label`. Without the label in the program, stay at the start.
+    """
+
+    machine = Machine(program)
+    machine.verbose = False
+    machine.check_limits = True
+    machine.schedule_inputs(prefix_events)
+
+    if snapshot_label not in machine.labels:
+        return machine
+    target_pc = machine.labels[snapshot_label]
+
+    while machine.registers["PC"] != target_pc:
+        if machine.halted or machine.instruction_count >= BOOT_LIMIT:
+            utils.ERROR(
+                f"{program} did not reach {snapshot_label} within {BOOT_LIMIT} "
+                "instructions, give the keypresses to get there with --prefix"
+            )
+        machine.execute_next_instruction()
+
+    return machine
+
+
+def init_worker(program: str, prefix_events: list, snapshot_label: str):
+    machine = boot(program, prefix_events, snapshot_label)
+    machine.coverage = bytearray(MEMORY_HEIGHT)
+
+    _worker["machine"] = machine
+    _worker["snapshot"] = machine.snapshot()
+
+
+def run_input(events: list, budget: int) -> dict:
+    """
+    Restore the snapshot and run `budget` instructions with keypresses `events`.
+    Return the run with its coverage bitmap and error, if any.
+    """
+
+    machine = _worker["machine"]
+    machine.restore(_worker["snapshot"])
+    machine.schedule_inputs(events)
+    machine.coverage[:] = bytes(MEMORY_HEIGHT)
+
+    error = None
+    try:
+        machine.run(budget)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    return {
+        "events": events,
+        "coverage": bytes(machine.coverage),
+        "error": error,
+        "pc": machine.registers["PC"],
+        "instructions": machine.instruction_count,
+    }
+
+
+def mutate(events: list, corpus: list, start: int, budget: int, rng) -> list:
+    """
+    Return a mutated copy of the keypresses `events`: keys are inserted,
+    removed, changed or moved, or the sequence is spliced with another one
+    of the corpus.
+    """
+
+    events = list(events)
+
+    for _ in range(rng.randint(1, MAX_MUTATIONS)):
+        mutation = rng.choice(["insert", "remove", "change", "move", "splice"])
+
+        if mutation == "insert" or not events:
+            if len(events) < MAX_EVENTS:
+                events.append((rng.randrange(start, start + budget), rng.choice(KEYS)))
+        elif mutation == "remove":
+            events.pop(rng.randrange(len(events)))
+        elif mutation == "change":
+            i = rng.randrange(len(events))
+            events[i] = (events[i][0], rng.choice(KEYS))
+        elif mutation == "move":
+            i = rng.randrange(len(events))
+            count = events[i][0] + int(rng.gauss(0, budget / 20))
+            events[i] = (min(max(count, start), start + budget - 1), events[i][1])
+        elif mutation == "splice":
+            other = rng.choice(corpus)
+            split = rng.randrange(start, start + budget)
+            events = [e for e in events if e[0] < split] + [
+                e for e in other if e[0] >= split
+            ]
+            events = events[:MAX_EVENTS]
+
+        events.sort(key=lambda event: event[0])
+
+    return events
+
+
+def fuzz(program, prefix_events, snapshot_label, budget, rounds, batch, workers, seed, out_dir):
+    """
+    Fuzz `program`, return (corpus, crashes, covered addresses)
+    """
+
+    rng = random.Random(seed)
+
+    # the snapshot is taken at the same instruction count in every worker
+    start = boot(program, prefix_events, snapshot_label).instruction_count
+    print(f"Snapshot of {program} at instruction {start}")
+
+    corpus = []  # keypresses after the snapshot that found new addresses
+    crashes = {}  # error -> keypresses after the snapshot
+    covered = bytearray(MEMORY_HEIGHT)
+
+    def add_run(run):
+        new = sum(1 for a, b in zip(run["coverage"], covered) if a and not b)
+        for address, hit in enumerate(run["coverage"]):
+            if hit:
+                covered[address] = 1
+
+        if run["error"] is not None:
+            if run["error"] not in crashes:
+                crashes[run["error"]] = run["events"]
+                print(f"  {COLORS.FAIL}crash{COLORS.ENDC} {run['error']}")
+        elif new or not corpus:
+            corpus.append(run["events"])
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(program, prefix_events, snapshot_label),
+    ) as executor:
+        chunksize = max(1, batch // (workers * 4))
+
+        for run in executor.map(run_input, [[]], [budget]):
+            add_run(run)
+
+        for round_num in range(rounds):
+            t = time.time()
+            num_instructions = 0
+            inputs = [mutate(rng.choice(corpus), corpus, start, budget, rng) for _ in range(batch)]
+            for run in executor.map(
+                run_input, inputs, [budget] * len(inputs), chunksize=chunksize
+            ):
+                add_run(run)
+                num_instructions += run["instructions"] - start
+
+            print(
+                f"round {round_num + 1}/{rounds}: {sum(covered)} addresses covered, "
+                f"corpus {len(corpus)}, crashes {len(crashes)}, "
+                f"{num_instructions / (time.time() - t):,.0f} instructions/s"
+            )
+
+    os.makedirs(os.path.join(out_dir, "corpus"), exist_ok=True)
+    os.makedirs(os.path.join(out_dir, "crashes"), exist_ok=True)
+    for i, events in enumerate(corpus):
+        write_input_script(os.path.join(out_dir, "corpus", f"{i}.txt"), prefix_events + events)
+    for i, (error, events) in enumerate(crashes.items()):
+        write_input_script(
+            os.path.join(out_dir, "crashes", f"crash_{i}.txt"), prefix_events + events, error
+        )
+
+    return corpus, crashes, covered
+
+
+def main():
+    utils.change_dir_to_root()
+
+    programs = [arg for arg in sys.argv[1:] if arg.endswith(".s")]
+    program = programs[0] if programs else DEFAULT_PROGRAM
+
+    prefix_file = utils.get_arg_value(sys.argv, "--prefix")
+    prefix_events = read_input_script(prefix_file) if prefix_file else []
+    snapshot_label = utils.get_arg_value(sys.argv, "--snapshot-at", DEFAULT_SNAPSHOT_LABEL)
+    budget = int(utils.get_arg_value(sys.argv, "--budget", DEFAULT_BUDGET))
+    rounds = int(utils.get_arg_value(sys.argv, "--rounds", DEFAULT_ROUNDS))
+    batch = int(utils.get_arg_value(sys.argv, "--batch", DEFAULT_BATCH))
+    workers = int(utils.get_arg_value(sys.argv, "--workers", os.cpu_count()))
+    seed = int(utils.get_arg_value(sys.argv, "--seed", 0))
+    out_dir = utils.get_arg_value(sys.argv, "--out", DEFAULT_OUT_DIR)
+
+    corpus, crashes, covered = fuzz(
+        program, prefix_events, snapshot_label, budget, rounds, batch, workers, seed, out_dir
+    )
+
+    print(
+        f"{COLORS.BOLD}{program}{COLORS.ENDC}: {sum(covered)} addresses covered, "
+        f"{len(corpus)} inputs in corpus, {len(crashes)} distinct crashes, written to {out_dir}"
+    )
+    if crashes:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Golden-frame regression tests for the programs in masm/.
+
+Every program is run headless with its input schedule, the map is captured
+at the given instruction counts and compared against the golden frames in
+masm/golden/. A frame matches if its SHA-1 is unchanged. With `--tolerance`
+it also matches if its perceptual hash (dHash) is within that many bits
+of the golden one.
+On mismatch an image with golden frame, new frame and their difference is
+written to golden_diff/. Programs are checked in parallel.
+Captured hashes are kept in the result cache (see result_cache.py), a
+program whose code, inputs, checkpoints and tile ROM are unchanged is not
+run again unless its cached frames differ. `--no-cache` always runs it.
+
+masm/golden/<program>.json holds the schedule and the golden hashes:
+    {
+        "inputs": "at instruction 1000 press space; at 6000 press d",
+        "checkpoints": [0, 6000, 30000],
+        "frames": {"6000": {"sha1": "...", "phash": "..."}, ...}
+    }
+and masm/golden/<program>/<checkpoint>.png the golden images.
+"inputs" is an input script, see input_script.py.
+
+Usage: python golden.py [program.s ...] [--update] [--tolerance BITS] [--jobs N]
+       [--no-cache]
+"""
+
+import hashlib, json, os, sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import utils
+import frames
+from utils import COLORS
+from machine import Machine
+from program import Program
+from input_script import parse_input_script
+from result_cache import ResultCache, get_file_digest, get_key
+
+MASM_DIR = "masm"
+GOLDEN_DIR = os.path.join(MASM_DIR, "golden")
+DIFF_DIR = "golden_diff"
+DEFAULT_CHECKPOINTS = [0, 1000, 10000, 100000]
+PHASH_SIZE = 8  # 8x8 = 64 bit perceptual hash
+
+# tile images of the worker process, loaded once per process
+_tile_images = None
+
+
+def get_perceptual_hash(frame: np.ndarray) -> str:
+    """
+    Return the difference hash (dHash) of an RGB frame as hex string.
+    The frame is shrunk to (PHASH_SIZE + 1) x PHASH_SIZE block averages of
+    its brightness, every bit tells if a block is brighter than its right
+    neighbour. Small changes to the image only flip a few bits.
+    """
+
+    gray = frame.astype(np.float64).mean(axis=2)
+
+    rows = np.array_split(np.arange(gray.shape[0]), PHASH_SIZE)
+    cols = np.array_split(np.arange(gray.shape[1]), PHASH_SIZE + 1)
+    blocks = np.array(
+        [[gray[np.ix_(r, c)].mean() for c in cols] for r in rows]
+    )
+
+    bits = (blocks[:, 1:] > blocks[:, :-1]).flatten()
+    value = int("".join("1" if bit else "0" for bit in bits), 2)
+
+    return f"{value:0{PHASH_SIZE**2 // 4}x}"
+
+
+def hamming_distance(hash_a: str, hash_b: str) -> int:
+    """
+    Number of differing bits between two hex hashes
+    """
+
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+
+def get_spec_path(program: str) -> str:
+    return os.path.join(GOLDEN_DIR, program.replace(".s", ".json"))
+
+
+def get_golden_image_path(program: str, checkpoint: int) -> str:
+    return os.path.join(GOLDEN_DIR, program.replace(".s", ""), f"{checkpoint}.png")
+
+
+def load_spec(program: str) -> dict:
+    """
+    Load inputs, checkpoints and golden hashes of `program`,
+    use defaults if there are none yet.
+    """
+
+    spec = {"inputs": "", "checkpoints": DEFAULT_CHECKPOINTS, "frames": {}}
+
+    spec_path = get_spec_path(program)
+    if os.path.exists(spec_path):
+        spec.update(json.load(open(spec_path)))
+
+    return spec
+
+
+def save_spec(program: str, spec: dict):
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    with open(get_spec_path(program), "w") as f:
+        json.dump(spec, f, indent=4)
+        f.write("\n")
+
+
+def capture_frames(program: str, inputs: str, checkpoints: list) -> dict:
+    """
+    Run `program` with the keypresses of input script `inputs`
+    and capture its map at every checkpoint.
+    Return dictionary of checkpoint -> (hashes or error, frame or None)
+    """
+
+    captured = {}
+
+    try:
+        machine = Machine(program)
+    except Exception as e:
+        error = {"error": f"{type(e).__name__}: {e}"}
+        return {checkpoint: (error, None) for checkpoint in checkpoints}
+
+    machine.schedule_inputs(parse_input_script(inputs))
+
+    error = None
+    for checkpoint in sorted(checkpoints):
+        if error is None:
+            try:
+                machine.run(checkpoint - machine.instruction_count)
+                frame = frames.render_map(machine, _tile_images)
+            except Exception as e:
+                error = {"error": f"{type(e).__name__}: {e}"}
+
+        if error is not None:
+            captured[checkpoint] = (error, None)  # crashed, no more frames
+            continue
+
+        hashes = {
+            "sha1": hashlib.sha1(frame.tobytes()).hexdigest(),
+            "phash": get_perceptual_hash(frame),
+        }
+        captured[checkpoint] = (hashes, frame)
+
+    return captured
+
+
+def write_diff_image(file_name: str, golden_frame: np.ndarray, frame: np.ndarray):
+    """
+    Write golden frame, new frame and the difference side by side.
+    Differing pixels are red, the rest is the new frame dimmed.
+    """
+
+    differs = (golden_frame != frame).any(axis=2)
+
+    diff = frame // 4
+    diff[differs] = (255, 0, 0)
+
+    frames.write_png(file_name, np.concatenate([golden_frame, frame, diff], axis=1))
+
+
+def compare_frame(program, checkpoint, golden, captured, frame, tolerance):
+    """
+    Compare captured hashes against the golden ones.
+    Return (matches, message)
+    """
+
+    if golden is None:
+        return False, "no golden frame, run with --update"
+
+    if "error" in golden or "error" in captured:
+        if golden == captured:
+            return True, f"error as expected: {captured['error']}"
+        return False, f"expected {golden}, got {captured}"
+
+    if captured["sha1"] == golden["sha1"]:
+        return True, "identical"
+
+    distance = hamming_distance(captured["phash"], golden["phash"])
+
+    golden_image_path = get_golden_image_path(program, checkpoint)
+    if frame is not None and os.path.exists(golden_image_path):
+        os.makedirs(DIFF_DIR, exist_ok=True)
+        diff_path = os.path.join(
+            DIFF_DIR, f"{program.replace('.s', '')}_{checkpoint}_diff.png"
+        )
+        write_diff_image(diff_path, frames.read_png(golden_image_path), frame)
+        diff_note = f", diff in {diff_path}"
+    else:
+        diff_note = ""
+
+    if distance <= tolerance:
+        return True, f"perceptual distance {distance} bits{diff_note}"
+    return False, f"differs, perceptual distance {distance} bits{diff_note}"
+
+
+def init_worker():
+    global _tile_images
+    _tile_images = frames.load_tile_images()
+
+
+def get_frames_key(program: str, spec: dict):
+    """
+    Return the result cache key of the frames of `program`,
+    None if the program can not be loaded
+    """
+
+    try:
+        loaded = Program.from_file(program)
+    except Exception:
+        return None
+
+    return get_key(
+        loaded,
+        parse_input_script(spec["inputs"]),
+        max(spec["checkpoints"]),
+        extra={
+            "checkpoints": sorted(spec["checkpoints"]),
+            "tile_rom": get_file_digest(frames.TILE_ROM_FILE),
+        },
+    )
+
+
+def check_cached(program: str, spec: dict, key: str, tolerance: int):
+    """
+    Compare the cached hashes of `program` against the golden ones.
+    Return the report lines if all of them match, None otherwise.
+    """
+
+    cached = ResultCache().get(key)
+    if cached is None:
+        return None
+
+    report = []
+    for checkpoint in sorted(spec["checkpoints"]):
+        golden = spec["frames"].get(str(checkpoint))
+        matches, message = compare_frame(
+            program, checkpoint, golden, cached["frames"][str(checkpoint)], None, tolerance
+        )
+        if not matches:
+            return None  # capture again for the diff images
+        report.append(f"  {checkpoint:>9}: {COLORS.OKGREEN}ok{COLORS.ENDC} {message} (cached)")
+
+    return report
+
+
+def check_program(program: str, update: bool, tolerance: int, use_cache: bool = True) -> tuple:
+    """
+    Capture the frames of `program` and compare them, or store them
+    as new golden frames if `update` is set.
+    Return (program, all frames match, report lines)
+    """
+
+    spec = load_spec(program)
+
+    key = get_frames_key(program, spec) if use_cache else None
+    if key is not None and not update:
+        report = check_cached(program, spec, key, tolerance)
+        if report is not None:
+            return program, True, report
+
+    captured = capture_frames(program, spec["inputs"], spec["checkpoints"])
+    if key is not None:
+        cache = ResultCache()
+        hashes = {str(checkpoint): hashes for checkpoint, (hashes, _) in captured.items()}
+        cache.put(key, {"frames": hashes})
+        cache.evict()
+
+    if update:
+        spec["frames"] = {}
+        for checkpoint, (hashes, frame) in captured.items():
+            spec["frames"][str(checkpoint)] = hashes
+            if frame is None:
+                continue
+            image_path = get_golden_image_path(program, checkpoint)
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            frames.write_png(image_path, frame)
+        save_spec(program, spec)
+        return program, True, [f"  updated {len(captured)} golden frames"]
+
+    all_match = True
+    report = []
+    for checkpoint, (hashes, frame) in captured.items():
+        golden = spec["frames"].get(str(checkpoint))
+        matches, message = compare_frame(
+            program, checkpoint, golden, hashes, frame, tolerance
+        )
+        all_match &= matches
+        status = f"{COLORS.OKGREEN}ok{COLORS.ENDC}" if matches else f"{COLORS.FAIL}FAIL{COLORS.ENDC}"
+        report.append(f"  {checkpoint:>9}: {status} {message}")
+
+    return program, all_match, report
+
+
+def main():
+    utils.change_dir_to_root()
+
+    update = "--update" in sys.argv
+    # -1 => only identical frames match
+    tolerance = int(utils.get_arg_value(sys.argv, "--tolerance", -1))
+    jobs = int(utils.get_arg_value(sys.argv, "--jobs", os.cpu_count()))
+    use_cache = "--no-cache" not in sys.argv
+
+    programs = [arg for arg in sys.argv[1:] if arg.endswith(".s")] or utils.get_programs(MASM_DIR)
+
+    num_failed = 0
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as executor:
+        results = executor.map(
+            check_program,
+            programs,
+            [update] * len(programs),
+            [tolerance] * len(programs),
+            [use_cache] * len(programs),
+        )
+        for program, all_match, report in results:
+            print(f"{COLORS.BOLD}{program}{COLORS.ENDC}")
+            print("\n".join(report))
+            num_failed += not all_match
+
+    if num_failed:
+        print(f"{COLORS.FAIL}{num_failed} of {len(programs)} programs differ{COLORS.ENDC}")
+        sys.exit(1)
+
+    print(f"{COLORS.OKGREEN}All {len(programs)} programs match{COLORS.ENDC}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Read and write input scripts: keypresses scheduled by instruction count.
+
+An input script is a list of statements, separated by newlines or `;`:
+
+    at instruction 120000 press d
+    at instruction 240000 press return; at 250000 press space
+
+Key names are those of machine.KEY_NUMBERS (case does not matter).
+Comments start with `//` or `#`. Since the schedule is keyed by the number
+of executed instructions and not by wall time, replaying a script gives the
+exact same run, headless or windowed.
+"""
+
+import re
+
+import utils
+from machine import KEY_NUMBERS
+
+STATEMENT_PATTERN = re.compile(
+    r"at\s+(?:instruction\s+)?(\d+)\s+press\s+(\w+)", re.IGNORECASE
+)
+
+
+def parse_input_script(text: str) -> list:
+    """
+    Parse input script text.
+    Return list of (instruction count, key name) sorted by instruction count.
+    """
+
+    events = []
+
+    for line_num, line in enumerate(text.splitlines(), start=1):
+        # remove comments
+        line = re.split(r"//|#", line)[0]
+
+        for statement in line.split(";"):
+            statement = statement.strip()
+            if not statement:
+                continue
+
+            match = STATEMENT_PATTERN.fullmatch(statement)
+            if not match:
+                utils.ERROR(f"Could not parse input script line {line_num}: `{statement}`")
+
+            count, key_name = int(match.group(1)), match.group(2).lower()
+            if key_name not in KEY_NUMBERS:
+                utils.ERROR(
+                    f"Unknown key `{key_name}` in input script line {line_num}, "
+                    f"known keys are {list(KEY_NUMBERS)}"
+                )
+
+            events.append((count, key_name))
+
+    # stable sort, keys pressed at the same instruction keep their order
+    return sorted(events, key=lambda event: event[0])
+
+
+def format_input_script(events: list) -> str:
+    """
+    Return input script text for list of (instruction count, key name)
+    """
+
+    return "".join(f"at instruction {count} press {key_name}\n" for count, key_name in events)
+
+
+def read_input_script(file_name: str) -> list:
+    """
+    Read input script file, return its events as given by `parse_input_script`
+    """
+
+    try:
+        text = open(file_name, "r").read()
+    except FileNotFoundError:
+        utils.ERROR(f"Input script {file_name} not found")
+
+    return parse_input_script(text)
+
+
+def write_input_script(file_name: str, events: list, comment: str = None):
+    """
+    Write events (instruction count, key name) as an input script, after
+    `comment` as a comment line if given
+    """
+
+    with open(file_name, "w") as f:
+        if comment:
+            f.write(f"# {comment}\n")
+        f.write(format_input_script(events))
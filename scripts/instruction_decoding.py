@@ -10,14 +10,21 @@ REG_OPS = {"POP", "PUSH"}
 ADDR_OPS = {"BRA", "JSR", "BNE", "BEQ"}
 NO_ARGS_OPS = {"RET", "HALT"}
 
-KNOWN_MNEMONICS = utils.get_mnemonics()
 
+def parse_operation(parts: Sequence, known_mnemonics: dict = None) -> tuple[str, str]:
+    """
+    Split the first part of an instruction into mnemonic base and
+    address mode, e.g. `LDI` -> (`LD`, `I`).
+    `known_mnemonics` defaults to the opcodes of hardware/fax.md.
+    """
+
+    if known_mnemonics is None:
+        known_mnemonics = utils.get_mnemonics()
 
-def parse_operation(parts: Sequence) -> tuple[str, str]:
     mnemonic = parts[0]
     op_basename = None
     op_address_mode = None
-    for known_mnemonic in KNOWN_MNEMONICS:
+    for known_mnemonic in known_mnemonics:
         if mnemonic.startswith(known_mnemonic):
             op_basename = known_mnemonic
             op_address_mode = mnemonic[len(op_basename) :]
@@ -41,6 +48,8 @@ def parse_register_and_address(mnemonic_base: str, parts: Sequence) -> tuple[str
         grx_name, op_adr = parts[1], parts[2]
     elif mnemonic_base in ADR_REG_OPS:
         op_adr, grx_name = parts[1], parts[2]
+    elif mnemonic_base in REG_REG_OPS:
+        grx_name, op_adr = parts[1], parts[2]  # source register as address
     elif mnemonic_base in REG_OPS:
         grx_name = parts[1]
     elif mnemonic_base in NO_ARGS_OPS:
@@ -0,0 +1,106 @@
+"""
+The one lexer of masm lines, shared by the assembler, the linker, the
+machines and everything that reads programs (see masm_ir.py).
+
+A line is split into tokens that join back to the line exactly:
+
+    ST _cursorpos, GR2 ;b // save it
+    name space macro comma space name space breakpoint space comment
+
+Macros (`_name`) and sections (`%NAME`) are substituted token by token in
+one pass over the line, so a macro never changes part of a longer name
+(`_playerhp` in `_playerhpdigit1`), labels containing `_` or comments.
+"""
+
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import utils
+
+Token = namedtuple("Token", ["kind", "text", "column"])
+
+TOKEN_KINDS = [
+    ("comment", f"(?:{'|'.join(map(re.escape, utils.COMMENT_INITIATORS))}).*"),
+    ("breakpoint", r";b\b"),
+    ("number", r"0b[01]+\b|0x[0-9A-Fa-f]+\b|\$[0-9A-Fa-f]+\b|\d+\b"),
+    ("section", r"%\w+"),
+    ("macro", r"_\w*"),
+    ("name", r"[A-Za-z]\w*"),
+    ("operator", r"<<|>>|[-+*/&|~()=]"),
+    ("comma", r","),
+    ("colon", r":"),
+    ("include", r"<[^>]+>"),
+    ("space", r"\s+"),
+    ("other", r"."),
+]
+TOKEN_PATTERN = re.compile("|".join(f"(?P<{kind}>{pattern})" for kind, pattern in TOKEN_KINDS))
+
+# tokens without meaning for the program
+TRIVIA = {"space", "comment"}
+
+
+@lru_cache(maxsize=65536)
+def tokenize(line: str) -> tuple:
+    """
+    Return the tokens of a line, all of it including spaces and comments
+    """
+
+    return tuple(
+        Token(match.lastgroup, match.group(), match.start())
+        for match in TOKEN_PATTERN.finditer(line)
+    )
+
+
+def get_text(tokens) -> str:
+    return "".join(token.text for token in tokens)
+
+
+def strip(tokens) -> list:
+    """
+    Return `tokens` without spaces and comments
+    """
+
+    return [token for token in tokens if token.kind not in TRIVIA]
+
+
+def expand_macro(name: str, macros: dict, expanding: tuple = ()) -> str:
+    """
+    Return the value of macro `name` with the macros it uses expanded
+    """
+
+    if name in expanding:
+        utils.ERROR(f"Macro {name} is defined in terms of itself")
+
+    value = macros[name]
+    if "_" not in value:
+        return value
+
+    return "".join(
+        expand_macro(token.text, macros, expanding + (name,))
+        if token.kind == "macro" and token.text in macros
+        else token.text
+        for token in tokenize(value)
+    )
+
+
+def substitute(line: str, macros: dict = None, sections: dict = None) -> str:
+    """
+    Replace the macros (name -> value) and sections (name -> Section) used
+    in `line` with their values and start addresses. Unknown names are
+    left as they are, comments are not changed.
+    """
+
+    if not (macros and "_" in line or sections and "%" in line):
+        return line  # nothing to do
+
+    parts = []
+    for token in tokenize(line):
+        if token.kind == "macro" and macros and token.text in macros:
+            parts.append(substitute(expand_macro(token.text, macros), None, sections))
+        elif token.kind == "section" and sections and token.text[1:] in sections:
+            parts.append(str(sections[token.text[1:]].start))
+        else:
+            parts.append(token.text)
+
+    return "".join(parts)
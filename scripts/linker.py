@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Assemble every masm source file on its own into a relocatable object and
+link the objects of a program into the pMem array.
+
+An object holds the encoded words of one file, without its includes, in
+chunks: a chunk starts at a section declaration (or continues the section
+the file is included into) and ends at the next declaration or `<include>`.
+
+    {
+        "source": "path.s",
+        "chunks": [{"section": "PROGRAM", "start": 0, "words": [[bits, comment], ...]},
+                   {"include": "STANDARD.s", "labels": [...]}, ...],
+        "symbols": {label: [chunk, offset]},         # exported labels
+        "macros": {name: value},                     # exported macros
+        "relocations": [[chunk, offset, kind, expression], ...],
+    }
+
+Operands and data words that use labels, `%SECTION` starts or macros of
+other files are encoded with 0 and listed as relocations ("address" for
+the ADR field, "immediate" for the word after the instruction, "data" for
+data words), which the linker patches once it has placed all chunks and
+knows every symbol. Comments get the same expanded lines as with
+assembler.py.
+
+Macros and sections of one file are visible in all others, like with the
+textual includes of preassemble.py.
+
+Objects are cached in .objcache/ by the hash of their file name, source
+and the opcodes of fax.md, so only changed files are assembled again and an
+unchanged program is only linked:
+
+    python linker.py path.s [--no-cache] [--format vhd|bin|mem|coe|pkg] [--output <file>]
+
+The output formats are those of assembler.py.
+"""
+
+import hashlib, json, os, sys
+
+import utils
+import assembler
+from section import Section, use_sections
+from macros import use_macros
+from masm_ir import MASM_DIR, ParsedProgram, read_file
+from result_cache import ResultCache
+from instruction_decoding import REG_REG_OPS
+from utils import COLORS, ERROR
+
+OBJECT_CACHE_DIR = os.path.join(utils.ROOT_DIR, ".objcache")
+OBJECT_VERSION = 3  # increase when the object format or encoding changes
+
+
+def read_source(file_name: str, masm_dir: str = MASM_DIR) -> list:
+    """
+    Return the lines of a source file with comment-only and empty lines
+    removed, like preassemble.py but keeping includes
+    """
+
+    return read_file(file_name, masm_dir, expand_includes=False)
+
+
+def get_zero_symbols(expr: str) -> dict:
+    return {symbol: 0 for symbol in assembler.SYMBOL_PATTERN.findall(expr)}
+
+
+def assemble_object(asm_lines: list, source: str) -> dict:
+    """
+    Assemble the lines of one source file into an object
+    """
+
+    chunks = [{"section": None, "words": []}]  # the first one continues the includer's
+    symbols = {}
+    macros = {}
+    relocations = []
+
+    new_labels = []  # labels of the next word
+    # macros of this file, sections are left for the linker
+    parsed_program = ParsedProgram(asm_lines, use_sections=False)
+    for parsed in parsed_program.lines:
+        if parsed.kind == "macro":
+            macros[parsed.name] = parsed.value
+            continue
+        elif parsed.kind == "section":
+            chunks.append({"section": parsed.name, "start": parsed.section.start, "words": []})
+            new_labels = []
+            continue
+        elif parsed.kind == "include":
+            chunks.append({"include": parsed.name, "labels": new_labels})
+            chunks.append({"section": None, "words": []})
+            new_labels = []
+            continue
+
+        chunk_index = len(chunks) - 1
+        words = chunks[-1]["words"]
+        offset = len(words)
+
+        if parsed.kind == "label":
+            if parsed.name in symbols:
+                ERROR(f"{parsed.get_where()}Label {parsed.name} is defined more than once in {source}")
+            symbols[parsed.name] = [chunk_index, offset]
+            new_labels.append(parsed.name)
+            continue
+
+        line = parsed.expanded
+        label_string = "".join(f"{label} : " for label in new_labels)
+        new_labels = []
+
+        if parsed.kind == "instruction":
+            address = parsed.operand
+            zero_symbols = {}
+            if address != "-" and parsed.mnemonic not in REG_REG_OPS:
+                zero_symbols = get_zero_symbols(address)
+            binary_lines = assembler.assemble_instruction(parsed, zero_symbols)
+            if zero_symbols:
+                kind = "immediate" if parsed.mode == "I" else "address"
+                relocations.append([chunk_index, offset, kind, address])
+
+            words.append([binary_lines[0], f"{label_string}{line}"])
+            words += [[binary_line, ""] for binary_line in binary_lines[1:]]
+        else:
+            zero_symbols = get_zero_symbols(parsed.value)
+            binary_data, decimal_data = assembler.assemble_data(parsed.value, zero_symbols)
+            if zero_symbols:
+                relocations.append([chunk_index, offset, "data", parsed.value])
+                words.append([binary_data, label_string])  # value added by the linker
+            else:
+                words.append([binary_data, f"{label_string}{decimal_data}"])
+
+    return {
+        "source": source,
+        "chunks": chunks,
+        "symbols": symbols,
+        "macros": macros,
+        "relocations": relocations,
+    }
+
+
+def get_object_key(file_name: str, source_text: str) -> str:
+    description = [
+        OBJECT_VERSION,
+        file_name,
+        source_text,
+        sorted(utils.get_mnemonics().items()),
+    ]
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+
+class ObjectLoader:
+    """
+    Load the objects of source files, assembling only files whose
+    content changed since they were last assembled
+    """
+
+    def __init__(self, masm_dir: str = MASM_DIR, use_cache: bool = True):
+        self.masm_dir = masm_dir
+        self.cache = ResultCache(OBJECT_CACHE_DIR) if use_cache else None
+        self.assembled = []  # file names assembled, not from the cache
+
+    def load(self, file_name: str) -> dict:
+        path = os.path.join(self.masm_dir, file_name)
+        try:
+            source_text = open(path, "r").read()
+        except FileNotFoundError:
+            ERROR(f"File {path} not found")
+
+        key = get_object_key(file_name, source_text)
+        if self.cache is not None:
+            obj = self.cache.get(key)
+            if obj is not None:
+                return obj
+
+        obj = assemble_object(read_source(file_name, self.masm_dir), file_name)
+        self.assembled.append(file_name)
+        if self.cache is not None:
+            self.cache.put(key, obj)
+
+        return obj
+
+
+class Linker:
+    """
+    Place the chunks of a program and its included objects in their
+    sections, resolve symbols and patch relocations
+    """
+
+    def __init__(self, loader: ObjectLoader):
+        self.loader = loader
+        self.objects = {}  # file name -> object
+
+    def get_object(self, file_name: str) -> dict:
+        if file_name not in self.objects:
+            self.objects[file_name] = self.loader.load(file_name)
+        return self.objects[file_name]
+
+    def walk(self, file_name: str, including: tuple = ()):
+        """
+        Yield (object, chunk index, chunk) in the order of the textually
+        expanded program, includes expanded where they are
+        """
+
+        if file_name in including:
+            ERROR(f"{file_name} includes itself: {' -> '.join(including + (file_name,))}")
+
+        obj = self.get_object(file_name)
+        for chunk_index, chunk in enumerate(obj["chunks"]):
+            yield obj, chunk_index, chunk
+            if "include" in chunk:
+                yield from self.walk(chunk["include"], including + (file_name,))
+
+    def link(self, file_name: str) -> tuple:
+        """
+        Link the program `file_name`. Return its sections, its symbol table
+        and the binary words of every section (see assembler.second_pass).
+        """
+
+        chunks = list(self.walk(file_name))
+
+        # pass 1: place chunks, find the address of every label
+        sections = {}
+        for obj, _, chunk in chunks:
+            if chunk.get("section") is not None:
+                sections[chunk["section"]] = Section(f"%{chunk['section']} {chunk['start']}")
+
+        sizes = {name: 0 for name in sections}
+        bases = {}  # (source, chunk index) -> section name, offset in it
+        labels = {}
+        current_section = None
+        for obj, chunk_index, chunk in chunks:
+            if "include" in chunk:
+                continue
+            if chunk["section"] is not None:
+                current_section = sections[chunk["section"]]
+            if current_section is None:
+                if chunk["words"] or self.has_labels(obj, chunk_index):
+                    ERROR(f"Code of {obj['source']} is not in any section")
+                continue
+
+            bases[(obj["source"], chunk_index)] = (current_section.name, sizes[current_section.name])
+            sizes[current_section.name] += len(chunk["words"])
+
+        for obj in self.objects.values():
+            for label, (chunk_index, offset) in obj["symbols"].items():
+                if label in labels:
+                    ERROR(f"Label {label} is defined more than once ({obj['source']})")
+                section_name, base = bases[(obj["source"], chunk_index)]
+                labels[label] = sections[section_name].start + base + offset
+
+        macros = {}
+        for obj in self.objects.values():
+            macros.update(obj["macros"])
+        symbols = self.get_symbols(sections, labels, macros)
+
+        # pass 2: copy the words, patch relocations
+        words = {name: [] for name in sections}
+        pending_labels = []  # of an include, for the comment of its first word
+        current_section = None
+        for obj, chunk_index, chunk in chunks:
+            if "include" in chunk:
+                pending_labels = chunk["labels"]
+                continue
+            if chunk["section"] is not None:
+                current_section = sections[chunk["section"]]
+                pending_labels = []
+            if not chunk["words"]:
+                continue
+
+            section_words = words[current_section.name]
+            start = len(section_words)
+            section_words += [list(word) for word in chunk["words"]]
+            if pending_labels:
+                label_string = "".join(f"{label} : " for label in pending_labels)
+                section_words[start][1] = label_string + section_words[start][1]
+                pending_labels = []
+
+            for reloc_chunk, offset, kind, expr in obj["relocations"]:
+                if reloc_chunk != chunk_index:
+                    continue
+                word = section_words[start + offset]
+                if kind == "immediate":
+                    self.patch(section_words[start + offset + 1], kind, expr, symbols)
+                else:
+                    self.patch(word, kind, expr, symbols)
+                if kind != "data":
+                    # the line as assembler.py would have seen it
+                    word[1] = use_sections(use_macros(word[1], macros), sections)
+
+        return sections, labels, words
+
+    @staticmethod
+    def has_labels(obj: dict, chunk_index: int) -> bool:
+        return any(chunk == chunk_index for chunk, _ in obj["symbols"].values())
+
+    @staticmethod
+    def get_symbols(sections: dict, labels: dict, macros: dict) -> dict:
+        """
+        Return the values of all labels, section starts (`%NAME`) and macros
+        """
+
+        symbols = dict(labels)
+        for section in sections.values():
+            symbols[f"%{section.name}"] = section.start
+
+        # macro values may use sections, labels and other macros
+        def evaluate_macro(name, evaluating):
+            if name in evaluating:
+                ERROR(f"Macro {name} is defined by itself")
+            value = macros[name]
+            for symbol in assembler.SYMBOL_PATTERN.findall(value):
+                if symbol not in symbols and symbol in macros:
+                    symbols[symbol] = evaluate_macro(symbol, evaluating + (name,))
+            return assembler.evaluate(value, symbols)
+
+        for name in macros:
+            if name not in symbols:
+                symbols[name] = evaluate_macro(name, ())
+
+        return symbols
+
+    @staticmethod
+    def patch(word: list, kind: str, expr: str, symbols: dict):
+        """
+        Write the value of `expr` into `word` ([bits, comment])
+        """
+
+        value = assembler.evaluate(expr, symbols)
+        if kind == "address":
+            if not 0 <= value < 2**assembler.ADR_WIDTH:
+                ERROR(f"Address {expr} = {value} does not fit in {assembler.ADR_WIDTH} bits")
+            word[0] = word[0][: -assembler.ADR_WIDTH] + f"{value:0{assembler.ADR_WIDTH}b}"
+        else:
+            word[0] = f"{value & (2**assembler.INSTRUCTION_WIDTH - 1):0{assembler.INSTRUCTION_WIDTH}b}"
+            if kind == "data":
+                word[1] += str(value)
+
+
+def link_program(file_name: str, masm_dir: str = MASM_DIR, use_cache: bool = True) -> tuple:
+    """
+    Assemble the changed files of program `file_name` and link it.
+    Return its sections, symbol table, words (see `Linker.link`) and
+    the names of the files that had to be assembled.
+    """
+
+    loader = ObjectLoader(masm_dir, use_cache)
+    sections, labels, words = Linker(loader).link(file_name)
+    if loader.cache is not None:
+        loader.cache.evict()
+
+    return sections, labels, words, loader.assembled
+
+
+def main():
+    utils.change_dir_to_root()
+
+    if len(sys.argv) < 2:
+        ERROR(
+            "Usage: python linker.py <program.s> [--no-cache] "
+            "[--format vhd|bin|mem|coe|pkg] [--output <file>]"
+        )
+    file_name = sys.argv[1]
+
+    sections, labels, words, assembled = link_program(
+        file_name, use_cache="--no-cache" not in sys.argv
+    )
+    assembler.write_output(
+        sections,
+        words,
+        utils.get_arg_value(sys.argv, "--format", "vhd"),
+        utils.get_arg_value(sys.argv, "--output"),
+    )
+
+    num_words = sum(len(section_words) for section_words in words.values())
+    print(
+        f"{COLORS.OKGREEN}Linked {file_name}{COLORS.ENDC}: {num_words} words, "
+        f"assembled {', '.join(assembled) or 'nothing'}"
+    )
+
+
+if __name__ == "__main__":
+    main()
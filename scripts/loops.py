@@ -0,0 +1,132 @@
+"""
+Find counted delay loops in the memory of a program, so that the machine
+can jump over them instead of executing every iteration.
+
+A counted loop is a register stepped by an immediate and a branch back
+while the register has not reached its end value:
+
+    delay_loop:                     count_up:
+        SUBI GR0, 1                     ADDI GR4, 2
+        BNE delay_loop                  CMPI GR4, 40
+                                        BNE count_up
+
+Nothing else happens in the loop, so after n more iterations the register
+holds its value plus n steps, and the loop ends after the iteration where
+it equals the end value (0 without CMPI). Values are not wrapped to 24
+bits, so a loop whose end value is never hit runs forever and is left to
+normal execution.
+"""
+
+from masm_ir import split_instruction
+from expression import evaluate
+from instruction_decoding import parse_operation, parse_register_and_address
+
+
+class CountedLoop:
+    """
+    Represent a counted loop from `start` to the BNE at `branch`
+    """
+
+    def __init__(self, start: int, branch: int, register: str, step: int, end_value: int):
+        self.start = start
+        self.branch = branch
+        self.register = register
+        self.step = step  # added to the register every iteration
+        self.end_value = end_value
+        self.length = branch - start + 1  # instructions per iteration
+
+    def iterations_left(self, value: int):
+        """
+        Number of iterations until the loop ends, starting at its first
+        instruction with `value` in the register. None if it never ends.
+        """
+
+        distance = self.end_value - value
+        if self.step == 0:
+            return 1 if distance == 0 else None
+
+        if distance % self.step != 0 or distance // self.step < 1:
+            return None
+
+        return distance // self.step
+
+    def __repr__(self) -> str:
+        return (
+            f"CountedLoop({self.start}-{self.branch}, {self.register} "
+            f"{self.step:+} until {self.end_value})"
+        )
+
+
+def decode(line: str, isa: dict):
+    """
+    Return (mnemonic, address mode, parts) of an assembly line,
+    None if it is no instruction
+    """
+
+    parts = split_instruction(line)
+    try:
+        mnemonic, address_mode = parse_operation(parts, isa)
+    except Exception:
+        return None
+
+    return mnemonic, address_mode, parts
+
+
+def get_immediate(decoded, mnemonics: set):
+    """
+    Return (register, value) of an immediate `mnemonics` instruction,
+    None if `decoded` is something else
+    """
+
+    if decoded is None:
+        return None
+
+    mnemonic, address_mode, parts = decoded
+    if mnemonic not in mnemonics or address_mode != "I":
+        return None
+
+    try:
+        register, value = parse_register_and_address(mnemonic, parts)
+        return register, evaluate(value) if isinstance(value, str) else int(value)
+    except Exception:
+        return None
+
+
+def find_counted_loops(memory: list, labels: dict, isa: dict) -> dict:
+    """
+    Find all counted loops in `memory`.
+    Return dictionary of loop start address -> CountedLoop
+    """
+
+    loops = {}
+
+    for branch, line in enumerate(memory):
+        if not line.startswith("BNE"):
+            continue
+
+        decoded = decode(line, isa)
+        if decoded is None or len(decoded[2]) < 2:
+            continue
+        destination = decoded[2][1]
+        start = labels.get(destination, int(destination) if destination.isdigit() else None)
+        if start is None or not branch - 2 <= start < branch:
+            continue
+
+        decoded_start = decode(memory[start], isa)
+        stepped = get_immediate(decoded_start, {"ADD", "SUB"})
+        if stepped is None:
+            continue
+        register, step = stepped
+        if decoded_start[0] == "SUB":
+            step = -step
+
+        end_value = 0
+        if start == branch - 2:  # with CMPI
+            compared = get_immediate(decode(memory[branch - 1], isa), {"CMP"})
+            if compared is None or compared[0] != register:
+                continue
+            end_value = compared[1]
+
+        loops[start] = CountedLoop(start, branch, register, step, end_value)
+
+    return loops
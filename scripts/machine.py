@@ -6,22 +6,54 @@ Should be used in conjunction with emulate.py to visualise the state of the mach
 after each instruction.
 
 The methods of the machine are to be called from emulate.py, and are not
-intended to be run directly.
+intended to be run directly. Machines can also be created from source text
+or an already loaded program (`Machine.from_source`, `Machine.from_program`),
+without touching the working directory or any other global state.
 """
 
 import numpy as np
-import pygame as pg
 import re
 import time
 
 import array_manip as am
 import utils
-from section import Section, use_sections
+from section import use_sections
 from macros import use_macros
+from masm_ir import split_instruction
+from expression import evaluate
 from instruction_decoding import parse_operation, parse_register_and_address
-from preassemble import preassemble
+from program import MEMORY_HEIGHT, Program
+from loops import find_counted_loops
+from cycle_model import get_cycle_table
+
+# increase when a change to the machine changes results of programs,
+# cached results of older versions are then not used (see result_cache.py)
+ENGINE_VERSION = 4
+
+MAX_VALUE = 2**24 - 1
+
+# in-game keys and the value they put in GR15, same as kbd_enc.vhd/cpu.vhd
+KEY_NUMBERS = {
+    "a": 1,
+    "d": 2,
+    "space": 3,
+    "w": 4,
+    "return": 5,
+    "s": 8,
+}
+
+
+def get_section_extents(program: Program) -> dict:
+    """
+    Return section name -> (start, end) of the memory of every section,
+    from its start up to the start of the next one or the end of memory
+    """
+
+    starts = sorted((section.start, name) for name, section in program.sections.items())
+    ends = [start for start, _ in starts[1:]] + [len(program.memory)]
+
+    return {name: (start, end) for (start, name), end in zip(starts, ends)}
 
-TICK_DELAY_S = 1e-6
 
 class Machine:
     """
@@ -31,81 +63,220 @@ class Machine:
     - flags
     """
 
-    MEMORY_HEIGHT = 4096
+    MEMORY_HEIGHT = MEMORY_HEIGHT
+
+    def __init__(self, asm_file_name=None, program=None, isa=None, cycle_table=None):
+        """
+        Create a machine running either `asm_file_name` from the masm
+        directory, which is read again on every reset, or an already
+        loaded `program` (see program.py), which is never modified.
+        `isa` maps mnemonics to binary opcodes, if not given it is read
+        once from hardware/fax.md. `cycle_table` (see cycle_model.py) is
+        likewise looked up once from the microcode if not given.
+        """
+
+        if (asm_file_name is None) == (program is None):
+            utils.ERROR("Give either an assembly file name or a program")
 
-    def __init__(self, asm_file_name):
         self.asm_file_name = asm_file_name
+        self.program = program
+        self.isa = isa if isa is not None else utils.get_mnemonics()
+        self.cycle_table = cycle_table if cycle_table is not None else get_cycle_table()
         self.running_free = False
+        self.verbose = True  # print when halting
+        self.input_schedule = []  # (instruction count, key name), sorted
+        self.recorded_inputs = None  # list of (instruction count, key name) when recording
+        # stop with an error when the stack runs into a section or a value
+        # does not fit in 24 bits, instead of going on with a broken state
+        self.check_limits = False
+        self.coverage = None  # bytearray, set to 1 at every executed address
+        # skip idle loops, see `check_idle_loop`
+        self.detect_idle_loops = True
+        # jump over counted loops, see loops.py
+        self.skip_counted_loops = True
+        # set by `wake` when parked, paused or reset, owned by the runner
+        # (an asyncio.Event, see debug_server.run_machine)
+        self.wake_event = None
+        self.parked = None  # (since, idle period, its duration in s) when parked
         self.reset()
 
+    @classmethod
+    def from_source(cls, source: str, isa=None, includes: dict = None, cycle_table=None):
+        """
+        Create a machine from assembly source text, see Program.from_source
+        """
+
+        program = Program.from_source(source, includes, isa)
+        return cls(program=program, isa=isa, cycle_table=cycle_table)
+
+    @classmethod
+    def from_program(cls, program: Program, isa=None, cycle_table=None):
+        """
+        Create a machine from an already loaded program. Cheap, so a
+        program can be loaded once and run by any number of machines.
+        The program is parsed already, load it with the same `isa`.
+        """
+
+        return cls(program=program, isa=isa, cycle_table=cycle_table)
+
     def reset(self):
         """
-        Reset the machine state, loading memory from the assembly file,
-        and resetting registers and flags.
+        Reset the machine state, loading memory from the assembly file
+        (or the program), and resetting registers and flags.
+        """
+
+        if self.asm_file_name is not None:
+            self.program = Program.from_file(self.asm_file_name, isa=self.isa)
+            self.cycle_table = get_cycle_table()  # the microcode may have changed too
+
+        self.reset_with(self.program)
+
+    def reset_with(self, program: Program):
+        """
+        Reset the machine state, loading memory from `program`
         """
 
-        self.init_memory(self.asm_file_name)
-        self.find_all_breakpoints()
+        self.program = program
+        self.init_memory(program)
         self.init_registers()
         self.init_flags()
         self.halted = False
         self.stop_at_breakpoints = False
+        self.instruction_count = 0
+        self.cycle_count = 0  # clock cycles of the hardware, see cycle_model.py
+        self.forget_idle_loop()
+        self.rewind_input_schedule()
+        if self.recorded_inputs is not None:
+            self.recorded_inputs = []  # instruction counts start over
 
-    def init_memory(self, asm_file_name):
-        """
-        Expand the assembly lines into the full memory.
-        - Includes are resolved,
-        - Macros are expanded,
-        - Sections are used
-        """
-
-        # read the assembly file
-        asm_lines = preassemble(asm_file_name)
-
-        self.sections = {}  # section name -> Section object
-        macros = {}  # macro name -> macro value
-
-        # begin by finding all sections
-        for i, line in enumerate(asm_lines):
-            if not line.startswith("%"):
-                continue  # not a section declaration
-            new_section = Section(line)
-            self.sections[new_section.name] = new_section  # store section
-
-        current_section = None
-        self.labels = {}  # label name -> line number
-        for i, line in enumerate(asm_lines):
-            # macro declaration
-            if line.startswith("_"):
-                parts = re.match(r"(_\w+)\s*=\s*(.+)", line).groups()
-                macro_name, macro_value = parts
-                macros[macro_name] = macro_value  # store macro value
-                continue
-            # section declaration
-            if line.startswith("%"):
-                current_section = self.sections[line.replace("%", "").split()[0]]
-                continue
-            if line.endswith(":\n"):
-                new_label = line.replace(":", "").strip()
-                label_linenum = len(current_section.lines) + current_section.start
-                self.labels[new_label] = label_linenum
-                continue
-
-            # replace macros with their values
-            line = use_macros(line, macros)
-            # replace section names with their start line number
-            line = use_sections(line, self.sections)
-
-            current_section.lines.append(line)
-
-        # init empty memory
-        self.memory = [""] * self.MEMORY_HEIGHT
-
-        # now that all macros and sections have been expanded, we can
-        # fill the memory
-        for section in self.sections.values():
-            for i, line in enumerate(section.lines):
-                self.memory[section.start + i] = line.strip()
+        # wake the runner, without counting the parked time
+        self.parked = None
+        if self.wake_event is not None:
+            self.wake_event.set()
+
+    def init_memory(self, program: Program):
+        """
+        Load the expanded memory, labels, sections and breakpoints of `program`
+        """
+
+        self.sections = program.sections
+        self.labels = program.labels
+        self.macros = program.macros
+        self.memory = list(program.memory)
+        self.breakpoints = list(program.breakpoints)
+        self.counted_loops = find_counted_loops(program.memory, program.labels, self.isa)
+        self.init_cycle_costs()
+
+    def init_cycle_costs(self):
+        """
+        Look up the cycles of every instruction in memory once, so counting
+        cycles costs one addition per instruction. Conditional branches are
+        counted as not taken, `branch` adds the rest.
+        """
+
+        self.cycle_costs = [self.get_instruction_cycles(word) for word in self.memory]
+        self.taken_branch_cycles = {
+            mnemonic: self.cycle_table.get_taken_cycles(mnemonic, self.isa)
+            for mnemonic in ("BNE", "BEQ")
+            if mnemonic in self.isa  # an explicit ISA may leave out unused opcodes
+        }
+
+    def get_instruction_cycles(self, word) -> int:
+        return self.cycle_table.get_line_cycles(word, self.isa)
+
+    def snapshot(self):
+        """
+        Return a copy of the machine state, which can be given to `restore`
+        """
+
+        return {
+            "memory": list(self.memory),
+            "registers": dict(self.registers),
+            "flags": dict(self.flags),
+            "halted": self.halted,
+            "instruction_count": self.instruction_count,
+            "cycle_count": self.cycle_count,
+            "cycle_costs": list(self.cycle_costs),
+        }
+
+    def restore(self, snapshot):
+        """
+        Return the machine to a state given by `snapshot`
+        """
+
+        self.memory = list(snapshot["memory"])
+        self.registers = dict(snapshot["registers"])
+        self.flags = dict(snapshot["flags"])
+        self.halted = snapshot["halted"]
+        self.instruction_count = snapshot["instruction_count"]
+        self.cycle_count = snapshot["cycle_count"]
+        self.cycle_costs = list(snapshot["cycle_costs"])
+        self.forget_idle_loop()
+        self.rewind_input_schedule()
+
+    def hot_reload(self, program: Program):
+        """
+        Load `program`, a changed version of the running one, keeping as
+        much of the machine state as its layout allows.
+
+        If the sections start where they did and all labels kept their
+        addresses, only the words whose source changed are written:
+        registers, flags, the stack and data written since reset are kept.
+        Otherwise the machine is reset with `program` and every section
+        whose extent and source are unchanged (e.g. VMEM, PATH or HEAP) gets
+        back its words from before, see `get_section_extents`.
+
+        Call it on the thread that runs the machine (see
+        `debug_server.run_machine`). Return the number of patched words,
+        None after a reset.
+        """
+
+        old_program = self.program
+        old_starts = {name: section.start for name, section in old_program.sections.items()}
+        new_starts = {name: section.start for name, section in program.sections.items()}
+
+        if old_starts != new_starts or old_program.labels != program.labels:
+            old_memory = self.memory  # reset_with loads a new list
+            self.reset_with(program)
+
+            old_extents = get_section_extents(old_program)
+            for name, (start, end) in get_section_extents(program).items():
+                if old_extents.get(name) != (start, end):
+                    continue
+                if old_program.sections[name].lines != program.sections[name].lines:
+                    continue
+                for address in range(start, end):
+                    self.mark_memory_change(address, old_memory[address])
+                self.memory[start:end] = old_memory[start:end]
+            return None
+
+        patched = 0
+        for address, (old_word, new_word) in enumerate(zip(old_program.memory, program.memory)):
+            if old_word != new_word:
+                self.mark_memory_change(address, new_word)
+                self.memory[address] = new_word
+                patched += 1
+
+        self.program = program
+        self.sections = program.sections
+        self.macros = program.macros
+        self.breakpoints = list(program.breakpoints)
+        self.counted_loops = find_counted_loops(program.memory, program.labels, self.isa)
+        self.forget_idle_loop()
+        self.wake()  # an idle loop waiting for a key may have been changed
+
+        return patched
+
+    def get_address(self, address_expr):
+        """
+        Return the memory address given by an expression which may use
+        macros and sections, e.g. `_cursorpos` or `%HEAP+3`
+        """
+
+        address_expr = use_macros(address_expr, self.macros)
+        address_expr = use_sections(address_expr, self.sections)
+
+        return evaluate(address_expr)
 
     def set_register(self, register, value):
         """
@@ -115,7 +286,7 @@ class Machine:
         if register not in self.registers:
             utils.ERROR(f"Unknown register {register}")
 
-        if value > 2**24 - 1:
+        if value > MAX_VALUE:
             utils.ERROR(f"Value {value} is too large for 24-bit register")
 
         self.registers[register] = value
@@ -145,27 +316,67 @@ class Machine:
     def init_flags(self):
         self.flags = {"Z": 0, "N": 0, "C": 0, "V": 0}
 
-    def register_keypress(self, key):
+    def register_keypress(self, key_name):
         """
-        Store the keypress in GR15
+        Store the keypress in GR15. `key_name` is one of KEY_NUMBERS,
+        unknown keys are ignored.
         """
 
-        if key == pg.K_a:
-            key_num = 1
-        elif key == pg.K_d:
-            key_num = 2
-        elif key == pg.K_w:
-            key_num = 4
-        elif key == pg.K_RETURN:
-            key_num = 5
-        elif key == pg.K_s:
-            key_num = 8
-        elif key == pg.K_SPACE:
-            key_num = 3
-        else:
+        if key_name is None or key_name.lower() not in KEY_NUMBERS:
             return  # no known key
 
-        self.set_register("GR15", key_num)
+        self.wake()
+        self.set_register("GR15", KEY_NUMBERS[key_name.lower()])
+
+        if self.recorded_inputs is not None:
+            self.recorded_inputs.append((self.instruction_count, key_name.lower()))
+
+    def schedule_inputs(self, events):
+        """
+        Press keys when the instruction count is reached.
+        `events` is a list of (instruction count, key name), see input_script.py
+        """
+
+        self.input_schedule = sorted(events, key=lambda event: event[0])
+        self.rewind_input_schedule()
+
+    def rewind_input_schedule(self):
+        """
+        Skip scheduled keypresses that lie before the current instruction count
+        """
+
+        self.next_input_index = 0
+        while (
+            self.next_input_index < len(self.input_schedule)
+            and self.input_schedule[self.next_input_index][0] < self.instruction_count
+        ):
+            self.next_input_index += 1
+
+        self.update_next_input_count()
+
+    def update_next_input_count(self):
+        if self.next_input_index < len(self.input_schedule):
+            self.next_input_count = self.input_schedule[self.next_input_index][0]
+        else:
+            self.next_input_count = float("inf")
+
+    def press_scheduled_keys(self):
+        """
+        Press all scheduled keys that are due at the current instruction count
+        """
+
+        while self.next_input_count <= self.instruction_count:
+            _, key_name = self.input_schedule[self.next_input_index]
+            self.register_keypress(key_name)
+            self.next_input_index += 1
+            self.update_next_input_count()
+
+    def start_input_recording(self):
+        """
+        Record every keypress with its instruction count from now on
+        """
+
+        self.recorded_inputs = []
 
     def increment_pc(self):
         """
@@ -183,17 +394,29 @@ class Machine:
             print("Machine is halted! Press 'r' to reset")
             return
 
+        self.idle_period = None
+        self.counted_loop = None
+
+        if self.instruction_count >= self.next_input_count:
+            self.press_scheduled_keys()
+
         # Fetch the next instruction
         instruction = self.get_from_memory(self.registers["PC"])
 
         if not instruction:
             utils.ERROR(f"Empty instruction at line {self.registers['PC']}")
 
+        if self.coverage is not None:
+            self.coverage[self.registers["PC"]] = 1
+
+        self.cycle_count += self.cycle_costs[self.registers["PC"]]
         self.increment_pc()
 
         # Interpret the instruction
         self.execute_instruction(instruction)
 
+        self.instruction_count += 1
+
     def get_register(self, register):
         """
         Get the value of a register
@@ -231,27 +454,19 @@ class Machine:
 
         self.stop_at_breakpoints = True
         self.running_free = True
-
-    def find_all_breakpoints(self):
-        """
-        Find all breakpoints in the memory
-        """
-
-        self.breakpoints = []
-        for i, line in enumerate(self.memory):
-            if re.match(r".*;b.*", line):
-                self.breakpoints.append(i)
+        self.wake()
 
     def execute_instruction(self, assembly_line: str):
         """
         Perform a single instruction
         """
 
-        parts = re.split(r"\s*,\s*|\s+", assembly_line)
-        mnemonic, address_mode = parse_operation(parts)
+        parts = list(split_instruction(assembly_line))
+        mnemonic, address_mode = parse_operation(parts, self.isa)
 
         if mnemonic == "HALT":
-            print("HALT instruction reached")
+            if self.verbose:
+                print("HALT instruction reached")
             self.halted = True
             return  # do nothing
         elif mnemonic == "RET":
@@ -271,7 +486,7 @@ class Machine:
         reg, adr = parse_register_and_address(mnemonic, parts)
 
         if isinstance(adr, str):
-            adr = eval(adr)
+            adr = evaluate(adr)
 
         if mnemonic == "LD":
             self.load_value(reg, adr, address_mode)
@@ -293,18 +508,193 @@ class Machine:
         mnemonic, reg_name = parts
 
         if mnemonic == "PUSH":
+            if self.check_limits:
+                self.check_stack_pointer()
+            self.mark_memory_change(self.registers["SP"], self.registers[reg_name])
             self.memory[self.registers["SP"]] = self.registers[reg_name]
             self.registers["SP"] -= 1
         elif mnemonic == "POP":
             self.registers["SP"] += 1
             self.registers[reg_name] = self.memory[self.registers["SP"]]
 
+    def check_stack_pointer(self):
+        """
+        Raise an error if a push would overwrite a section
+        """
+
+        section = self.program.get_section_at(self.registers["SP"])
+        if section is not None:
+            utils.ERROR(
+                f"Stack pointer {self.registers['SP']} ran into section {section.name}"
+            )
+
+    def check_value(self, value):
+        """
+        Raise an error if `value` does not fit in a 24-bit register
+        """
+
+        if value > MAX_VALUE:
+            utils.ERROR(f"Value {value} is too large for 24-bit register")
+
     def perform_move(self, parts):
         """
-        Copy the value of GR[adr] into GR[reg]
+        Copy the value of GR[adr] into GR[reg], setting Z like the
+        hardware, which moves it through AR
         """
         destination, source = parts[1], parts[2]
         self.registers[destination] = self.registers[source]
+        self.flags["Z"] = 1 if self.registers[source] == 0 else 0
+
+    def forget_idle_loop(self):
+        self.idle_visit = None  # (branch address, registers and flags, count, cycles, time)
+        self.idle_period = None  # instructions of a detected idle loop
+        self.idle_period_cycles = 0  # cycles of those instructions
+        self.idle_period_s = 0  # how long the emulator took for them
+        self.memory_changed = False  # since the last backward branch
+        self.counted_loop = None  # loop just branched back to, see loops.py
+
+    def check_idle_loop(self, branch_address):
+        """
+        Called after a taken backward branch. If the last backward branch was
+        the same one, registers and flags are unchanged and no memory word
+        was changed in between, the machine is in the exact same state as
+        then: it repeats the same instructions until a key is pressed.
+        Those instructions are an idle loop, e.g. polling GR15, and whole
+        periods of it can be skipped without changing anything but the
+        instruction and cycle counts. Set `idle_period` to its length.
+        """
+
+        state = (tuple(self.registers.values()), tuple(self.flags.values()))
+        count = self.instruction_count + 1  # the branch is not counted yet
+        now = time.perf_counter()
+
+        visit = self.idle_visit
+        if (
+            visit is not None
+            and visit[0] == branch_address
+            and visit[1] == state
+            and not self.memory_changed
+        ):
+            self.idle_period = count - visit[2]
+            self.idle_period_cycles = self.cycle_count - visit[3]
+            self.idle_period_s = now - visit[4]
+
+        self.idle_visit = (branch_address, state, count, self.cycle_count, now)
+        self.memory_changed = False
+
+    def skip_idle_periods(self, max_count):
+        """
+        Skip whole periods of a detected idle loop, up to the next scheduled
+        keypress or `max_count` instructions
+        """
+
+        limit = min(max_count, self.next_input_count)
+        if limit != float("inf"):
+            periods = max((int(limit) - self.instruction_count) // self.idle_period, 0)
+            self.instruction_count += periods * self.idle_period
+            self.cycle_count += periods * self.idle_period_cycles
+
+        self.idle_period = None
+
+    def skip_counted_loop(self, max_count):
+        """
+        Jump over the iterations of the counted loop just branched back to,
+        up to the next scheduled keypress or `max_count` instructions.
+        Registers, flags and the instruction and cycle counts end up as if
+        every iteration was executed.
+        """
+
+        loop = self.counted_loop
+        self.counted_loop = None
+
+        if self.stop_at_breakpoints and any(
+            loop.start <= b <= loop.branch for b in self.breakpoints
+        ):
+            return  # stop there as usual
+        if self.memory[loop.start : loop.branch + 1] != self.program.memory[
+            loop.start : loop.branch + 1
+        ]:
+            return  # the loop was overwritten
+
+        value = self.registers[loop.register]
+        iterations = loop.iterations_left(value)
+        if iterations is None:
+            return  # never ends
+        if self.check_limits and loop.end_value > MAX_VALUE:
+            return  # fails in the last iteration
+
+        limit = min(max_count, self.next_input_count)
+        if limit != float("inf"):
+            iterations = min(iterations, (int(limit) - self.instruction_count) // loop.length)
+        if iterations <= 0:
+            return
+
+        # every iteration ends with the taken BNE back to the start
+        iteration_cycles = (
+            sum(self.cycle_costs[loop.start : loop.branch + 1]) + self.taken_branch_cycles["BNE"]
+        )
+        self.instruction_count += iterations * loop.length
+        self.cycle_count += iterations * iteration_cycles
+        self.registers[loop.register] = value + iterations * loop.step
+        if self.registers[loop.register] == loop.end_value:
+            # the loop ended, Z was set and the branch not taken
+            self.flags["Z"] = 1
+            self.registers["PC"] = loop.branch + 1
+            self.cycle_count -= self.taken_branch_cycles["BNE"]
+
+    def run(self, num_instructions):
+        """
+        Execute up to `num_instructions` instructions without any delay,
+        stop early if the machine halts. Idle and counted loops are skipped.
+        Return the number of executed instructions.
+        """
+
+        start_count = self.instruction_count
+        max_count = start_count + num_instructions
+
+        while self.instruction_count < max_count:
+            if self.halted:
+                break
+            self.execute_next_instruction()
+            if self.idle_period:
+                self.skip_idle_periods(max_count)
+            elif self.counted_loop:
+                self.skip_counted_loop(max_count)
+
+        return self.instruction_count - start_count
+
+    def start_parking(self):
+        """
+        Remember when the machine started to wait in the detected idle loop,
+        see `wake`
+        """
+
+        self.parked = (
+            time.perf_counter(),
+            self.idle_period,
+            self.idle_period_cycles,
+            self.idle_period_s,
+        )
+        self.idle_period = None
+
+    def wake(self):
+        """
+        Wake the runner (see `debug_server.run_machine`) if it waits. If
+        parked in an idle loop, first count the instructions and cycles the
+        loop would have executed in the meantime.
+        """
+
+        parked = self.parked
+        if parked is not None:
+            self.parked = None
+            since, period, period_cycles, period_s = parked
+            if period_s > 0:
+                periods = int((time.perf_counter() - since) / period_s)
+                self.instruction_count += periods * period
+                self.cycle_count += periods * period_cycles
+
+        if self.wake_event is not None:
+            self.wake_event.set()
 
     def halt(self):
         """
@@ -319,22 +709,32 @@ class Machine:
         """
 
         self.running_free = not self.running_free
+        self.wake()
 
-    def run_fast(self):
+    def step_free(self):
         """
-        Run the machine as fast as possible
-        If breakpoint is True, stop at the next breakpoint
+        Execute the next instruction as when running free: idle and counted
+        loops are skipped up to the next scheduled keypress, and the machine
+        pauses at breakpoints if asked to.
+        Return True if the machine waits in an idle loop for a keypress,
+        which is then to be parked.
         """
 
-        while True:
-            if self.halted:
-                continue
-            if self.running_free:
-                self.execute_next_instruction()
-            if self.stop_at_breakpoints and self.at_breakpoint():
-                self.toggle_pause()
+        self.execute_next_instruction()
 
-            time.sleep(TICK_DELAY_S)
+        waiting = False
+        if self.idle_period:
+            if self.next_input_count == float("inf"):
+                waiting = True
+            else:
+                self.skip_idle_periods(self.next_input_count)
+        elif self.counted_loop:
+            self.skip_counted_loop(self.next_input_count)
+
+        if self.stop_at_breakpoints and self.at_breakpoint():
+            self.toggle_pause()
+
+        return waiting
 
     def branch(self, mnemonic, destination):
         """
@@ -348,20 +748,32 @@ class Machine:
         else:
             utils.ERROR(f"Unknown destination {destination}")
 
+        branch_address = self.registers["PC"] - 1
+
         if mnemonic == "BRA":
             self.registers["PC"] = adr
         elif mnemonic == "BNE":
             if self.flags["Z"] == 0:
                 self.registers["PC"] = adr
+                self.cycle_count += self.taken_branch_cycles["BNE"]
         elif mnemonic == "BEQ":
             if self.flags["Z"] == 1:
                 self.registers["PC"] = adr
+                self.cycle_count += self.taken_branch_cycles["BEQ"]
         elif mnemonic == "JSR":
             self.perform_stack_operation(["PUSH", "PC"])
             self.registers["PC"] = adr
         else:
             utils.ERROR(f"Unknown branch mnemonic {mnemonic}")
 
+        if self.registers["PC"] <= branch_address:  # taken backward branch
+            if self.detect_idle_loops:
+                self.check_idle_loop(branch_address)
+
+            loop = self.counted_loops.get(self.registers["PC"])
+            if self.skip_counted_loops and loop and loop.branch == branch_address:
+                self.counted_loop = loop
+
     def load_value(self, reg, adr, address_mode):
         """
         Load value into register. If address_mode == '', then load
@@ -377,23 +789,45 @@ class Machine:
         else:
             utils.ERROR(f"Unknown address mode {address_mode}")
 
-        self.registers[reg] = utils.get_decimal_int(value)
+        value = utils.get_decimal_int(value)
+        if self.check_limits:
+            self.check_value(value)
+
+        self.registers[reg] = value
 
     def store_value(self, reg, adr: int, address_mode):
         """
         Store the value of register into memory[adr]
         """
 
-        # format as 24 bit binary string
-        data = f"0b{self.registers[reg]:024b}"
-
         if address_mode == "":  # direct
-            self.memory[adr] = data
+            self.set_memory(adr, self.registers[reg])
             return
         elif address_mode == "N":  # indexed
-            self.memory[self.registers["GR3"] + adr] = data
+            self.set_memory(self.registers["GR3"] + adr, self.registers[reg])
             return
 
+    def mark_memory_change(self, address, word):
+        """
+        Remember if writing `word` to `address` changes the memory.
+        Slicing never fails, so a bad address still fails on the write itself
+        (negative addresses always count as change).
+        """
+
+        if self.memory[address : address + 1] != [word]:
+            self.memory_changed = True
+            if 0 <= address < len(self.cycle_costs):
+                self.cycle_costs[address] = self.get_instruction_cycles(word)
+
+    def set_memory(self, address, value: int):
+        """
+        Store `value` at `address`, formatted as 24 bit binary string
+        """
+
+        word = f"0b{value:024b}"
+        self.mark_memory_change(address, word)
+        self.memory[address] = word
+
     def perform_alu_operation(
         self, mnemonic: str, reg: str, adr: int, address_mode: str
     ):
@@ -429,5 +863,8 @@ class Machine:
         if mnemonic == "CMP":
             return  # do not write result to register
 
+        if self.check_limits:
+            self.check_value(result)
+
         # write result to register
         self.registers[reg] = result
@@ -0,0 +1,317 @@
+"""
+Parsed intermediate representation (IR) of masm programs, the one place
+where source lines are read and taken apart (with the tokens of lexer.py):
+
+- `read_file`/`read_lines` return the source lines with includes expanded
+  (or kept), comment-only and empty lines dropped. Every line is a
+  `SourceLine`, a str that knows its file and line number.
+- `ParsedProgram` parses them into a `ParsedLine` per line: macro
+  definitions, section declarations, labels, includes, instructions and
+  data words. Macros and sections used by instructions and data are
+  substituted token by token in one pass, in the order of the source.
+
+The assembler, the linker and `Program` (the machines) all build on it, so
+they agree on what a line means. Layout is left to them, the assembler
+gives immediate operands a word of their own, the machines a line.
+"""
+
+import os
+from functools import lru_cache
+
+import utils
+from lexer import tokenize, strip, get_text, substitute
+from section import Section
+from instruction_decoding import parse_register_and_address
+
+MASM_DIR = os.path.join(utils.ROOT_DIR, "masm")
+
+ADDRESS_MODES = {"", "I", "X", "N"}
+
+
+class Location:
+    """
+    Represent where a source line comes from
+    """
+
+    def __init__(self, file_name: str, line_number: int):
+        self.file_name = file_name
+        self.line_number = line_number
+
+    def __str__(self) -> str:
+        return f"{self.file_name}:{self.line_number}"
+
+    def __repr__(self) -> str:
+        return f"Location({self.file_name}:{self.line_number})"
+
+
+class SourceLine(str):
+    """
+    Represent a source line, a str with its location
+    """
+
+    def __new__(cls, text: str, location: Location = None):
+        line = super().__new__(cls, text)
+        line.location = location
+        return line
+
+
+def get_include(line: str):
+    """
+    Return the file name of an include line `<FILE.s>`, None if `line` is
+    something else
+    """
+
+    tokens = strip(tokenize(line))
+    if tokens and tokens[0].kind == "include":
+        return tokens[0].text[1:-1]
+
+    return None
+
+
+def get_include_lines(file_name: str, masm_dir: str = MASM_DIR, includes: dict = None) -> list:
+    """
+    Return the lines of an included file, from `includes` (file name ->
+    source text) if given there, otherwise read from `masm_dir`
+    """
+
+    if includes and file_name in includes:
+        return includes[file_name].splitlines(keepends=True)
+
+    return open(os.path.join(masm_dir, file_name), "r").readlines()
+
+
+def read_lines(
+    asm_lines: list,
+    file_name: str = "<source>",
+    masm_dir: str = MASM_DIR,
+    includes: dict = None,
+    expand_includes: bool = True,
+    including: tuple = (),
+) -> list:
+    """
+    Return `asm_lines` of `file_name` as SourceLines without comment-only
+    and empty lines. Includes are replaced by the lines of the included
+    file (see `get_include_lines`), unless not `expand_includes`.
+    """
+
+    source_lines = []
+    for line_number, text in enumerate(asm_lines, 1):
+        if not text.endswith("\n"):
+            text += "\n"
+
+        if not strip(tokenize(text)):
+            continue  # empty or only a comment
+
+        include_file_name = get_include(text)
+        if include_file_name is not None and expand_includes:
+            if include_file_name in including + (file_name,):
+                utils.ERROR(f"{file_name}:{line_number}: {include_file_name} includes itself")
+            source_lines += read_lines(
+                get_include_lines(include_file_name, masm_dir, includes),
+                include_file_name,
+                masm_dir,
+                includes,
+                expand_includes,
+                including + (file_name,),
+            )
+        else:
+            source_lines.append(SourceLine(text, Location(file_name, line_number)))
+
+    return source_lines
+
+
+def read_file(
+    file_name: str, masm_dir: str = MASM_DIR, includes: dict = None, expand_includes: bool = True
+) -> list:
+    """
+    Return the source lines of `file_name` in `masm_dir`, see `read_lines`
+    """
+
+    asm_lines = open(os.path.join(masm_dir, file_name), "r").readlines()
+
+    return read_lines(asm_lines, file_name, masm_dir, includes, expand_includes)
+
+
+@lru_cache(maxsize=65536)
+def split_instruction(text: str) -> tuple:
+    """
+    Return the parts of an instruction line, the operation and its
+    operands, without spaces, comments and breakpoints:
+    `ST 1700+1, GR2 ;b // hp` -> ("ST", "1700+1", "GR2")
+    """
+
+    tokens = [token for token in strip(tokenize(text)) if token.kind != "breakpoint"]
+    if not tokens:
+        return ()
+
+    operands = [[]]
+    for token in tokens[1:]:
+        if token.kind == "comma":
+            operands.append([])
+        else:
+            operands[-1].append(token)
+
+    return (tokens[0].text, *(get_text(operand) for operand in operands if operand))
+
+
+@lru_cache(maxsize=65536)
+def decode_instruction(text: str, mnemonics: tuple) -> tuple:
+    """
+    Return (mnemonic, address mode, parts, breakpoint) of an instruction
+    (see `split_instruction`), None if `text` is no instruction of
+    `mnemonics`
+    """
+
+    parts = split_instruction(text)
+    if not parts or not parts[0][0].isalpha():
+        return None
+
+    operation = parts[0]
+    for mnemonic in mnemonics:
+        if operation.startswith(mnemonic) and operation[len(mnemonic) :] in ADDRESS_MODES:
+            break
+    else:
+        return None
+
+    breakpoint = any(token.kind == "breakpoint" for token in tokenize(text))
+    return mnemonic, operation[len(mnemonic) :], parts, breakpoint
+
+
+class ParsedLine:
+    """
+    Represent a source line taken apart, its `kind` is one of
+    - "macro": `_name = value`, with `name` and `value`
+    - "section": `%NAME start size`, with `name` and `section`
+    - "label": `name:`, with `name`
+    - "include": `<FILE.s>` (if not expanded), with `name`, the file name
+    - "instruction": with `mnemonic`, `mode`, `register` and `operand`
+      ("-" if not used) and `breakpoint`
+    - "data": with `value`
+    Instructions and data words have `expanded`, the stripped line with
+    macros and sections substituted.
+    """
+
+    def __init__(self, line: str, kind: str):
+        self.line = line
+        self.location = getattr(line, "location", None)
+        self.kind = kind
+        self.name = None
+        self.value = None
+        self.section = None
+        self.expanded = None
+        self.mnemonic = None
+        self.mode = None
+        self.register = "-"
+        self.operand = "-"
+        self.breakpoint = False
+        self.error = None  # for instructions with missing operands
+
+    @property
+    def size(self) -> int:
+        """
+        Words of the line in the assembled program
+        """
+
+        if self.kind == "instruction":
+            return 2 if self.mode == "I" and self.operand != "-" else 1
+        return 1 if self.kind == "data" else 0
+
+    def get_where(self) -> str:
+        return f"{self.location}: " if self.location else ""
+
+    def __repr__(self) -> str:
+        return f"ParsedLine({self.kind}, {self.line.strip()!r})"
+
+
+def parse_declaration(line: str) -> ParsedLine:
+    """
+    Return the ParsedLine of a macro definition, section declaration,
+    label or include, None if `line` is an instruction or data word
+    """
+
+    tokens = strip(tokenize(line))
+
+    if line.startswith("_"):
+        if len(tokens) < 3 or tokens[0].kind != "macro" or tokens[1].text != "=":
+            utils.ERROR(f"Invalid macro definition `{line.strip()}`")
+        parsed = ParsedLine(line, "macro")
+        parsed.name = tokens[0].text
+        parsed.value = get_text(tokens[2:])
+    elif line.startswith("%"):
+        parsed = ParsedLine(line, "section")
+        parsed.section = Section(line)
+        parsed.name = parsed.section.name
+    elif len(tokens) == 2 and tokens[0].kind == "name" and tokens[1].kind == "colon":
+        parsed = ParsedLine(line, "label")
+        parsed.name = tokens[0].text
+    elif get_include(line) is not None:
+        parsed = ParsedLine(line, "include")
+        parsed.name = get_include(line)
+    else:
+        return None
+
+    return parsed
+
+
+def parse_statement(line: str, expanded: str, mnemonics: tuple) -> ParsedLine:
+    """
+    Return the ParsedLine of an instruction or data word, `expanded` is
+    `line` with macros and sections substituted
+    """
+
+    decoded = decode_instruction(expanded, mnemonics)
+    if decoded is None:
+        parsed = ParsedLine(line, "data")
+        parsed.expanded = expanded
+        parsed.value = get_text(
+            token for token in strip(tokenize(expanded)) if token.kind != "breakpoint"
+        )
+        return parsed
+
+    parsed = ParsedLine(line, "instruction")
+    parsed.expanded = expanded
+    parsed.mnemonic, parsed.mode, parts, parsed.breakpoint = decoded
+    try:
+        parsed.register, parsed.operand = parse_register_and_address(parsed.mnemonic, parts)
+    except IndexError:
+        parsed.error = f"Missing operand in `{expanded}`"
+
+    return parsed
+
+
+class ParsedProgram:
+    """
+    Represent the parsed lines of a program, with all its sections (name
+    -> Section, wherever declared) and macros (name -> value)
+    """
+
+    def __init__(self, asm_lines: list, isa: dict = None, use_sections: bool = True):
+        """
+        Parse source lines (see `read_lines`). Sections are left in the
+        lines if not `use_sections`, like the linker does.
+        """
+
+        self.isa = isa if isa is not None else utils.get_mnemonics()
+        mnemonics = tuple(self.isa)
+
+        declarations = [parse_declaration(line) for line in asm_lines]
+        self.sections = {
+            parsed.name: parsed.section
+            for parsed in declarations
+            if parsed is not None and parsed.kind == "section"
+        }
+        sections = self.sections if use_sections else None
+
+        self.macros = {}
+        self.lines = []
+        for line, parsed in zip(asm_lines, declarations):
+            if parsed is None:
+                expanded = substitute(line, self.macros, sections).strip()
+                parsed = parse_statement(line, expanded, mnemonics)
+            elif parsed.kind == "macro":
+                self.macros[parsed.name] = parsed.value
+            self.lines.append(parsed)
+
+    @classmethod
+    def from_file(cls, file_name: str, masm_dir: str = MASM_DIR, includes: dict = None):
+        return cls(read_file(file_name, masm_dir, includes))
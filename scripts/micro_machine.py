@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Cycle-exact engine executing the microprogram itself: every micro-cycle
+moves a value over the bus (TB -> FB), runs the ALU, P and SP fields and
+picks the next uPC (SEQ), with the microinstructions, K1 and K2 read from
+hardware/uMem.vhd and hardware/cpu.vhd (see microcode.py).
+
+All registers change at the clock edge from the values before it, like in
+cpu.vhd, and reads of pMem are synchronous: the PM bus source is the word
+at ASR of the previous cycle. Keypresses set GR15 between instructions.
+An instruction ends when SEQ sets uPC to 0, so instruction counts match
+the other engines and input scripts work the same.
+
+Microcode changes can be checked without GHDL: `--lockstep` runs the
+program on this engine and on the instruction-level engine of
+binary_machine.py side by side and reports the first instruction after
+which registers, flags or memory differ.
+
+Usage: python micro_machine.py [hardware/pMem.vhd | image.bin]
+       [--umem <uMem.vhd>] [--cpu <cpu.vhd>] [--max-instructions N]
+       [--input-script <script.txt>] [--lockstep]
+"""
+
+import sys, time
+
+import utils
+from utils import COLORS
+from microcode import *
+from binary_machine import (
+    ADDRESS_MASK,
+    AR_MASK,
+    DEFAULT_MAX_INSTRUCTIONS,
+    PMEM_FILE,
+    REGISTER_NAMES,
+    WORD_MASK,
+    BinaryMachine,
+    Image,
+)
+from input_script import read_input_script
+
+
+class MicroMachine(BinaryMachine):
+    """
+    Represent the state of the machine down to the micro level:
+    IR, ASR, the pMem output register and uPC
+    """
+
+    def __init__(
+        self,
+        image_file_name: str = PMEM_FILE,
+        image: Image = None,
+        isa=None,
+        microcode: Microcode = None,
+    ):
+        self.microcode = microcode if microcode is not None else Microcode.from_files()
+        # (TB, FB, ALU, P, SP, SEQ, uADR) by uPC
+        self.micro_program = list(
+            zip(
+                self.microcode.tb,
+                self.microcode.fb,
+                self.microcode.alu,
+                self.microcode.p,
+                self.microcode.sp,
+                self.microcode.seq,
+                self.microcode.uadr,
+            )
+        )
+
+        super().__init__(image_file_name, image, isa)
+        self.detect_idle_loops = False  # every cycle is executed
+
+    def init_registers(self):
+        super().init_registers()
+        self.ir = 0
+        self.asr = 0
+        self.pm_out = 0  # output register of pMem
+        self.upc = 0
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot["micro"] = (self.ir, self.asr, self.pm_out, self.upc)
+        return snapshot
+
+    def restore(self, snapshot):
+        super().restore(snapshot)
+        self.ir, self.asr, self.pm_out, self.upc = snapshot["micro"]
+
+    def execute_next_instruction(self):
+        """
+        Run the micro-cycles of the next instruction
+        """
+
+        if self.halted:
+            print("Machine is halted! Press 'r' to reset")
+            return
+
+        self.idle_period = None
+
+        if self.instruction_count >= self.next_input_count:
+            self.press_scheduled_keys()
+
+        self.run_instructions(1)
+
+    def run(self, num_instructions):
+        """
+        Execute up to `num_instructions` instructions, stop early if the
+        machine halts. Return the number of executed instructions.
+        """
+
+        start_count = self.instruction_count
+        max_count = start_count + num_instructions
+
+        while self.instruction_count < max_count and not self.halted:
+            if self.instruction_count >= self.next_input_count:
+                self.press_scheduled_keys()
+            self.run_instructions(min(max_count, self.next_input_count) - self.instruction_count)
+
+        return self.instruction_count - start_count
+
+    def run_instructions(self, count: int):
+        """
+        Run micro-cycles until `count` instructions ended or the machine halts
+        """
+
+        micro_program = self.micro_program
+        k1, k2 = self.microcode.k1, self.microcode.k2
+        mov_opcode = int(self.isa["MOV"], 2) if "MOV" in self.isa else None  # mux of cpu.vhd
+        memory = self.memory
+        coverage = self.coverage
+        registers = self.registers
+
+        gr = [registers[name] for name in REGISTER_NAMES]
+        pc, sp, ar = registers["PC"], registers["SP"], registers["AR"]
+        ir, asr, pm_out, upc = self.ir, self.asr, self.pm_out, self.upc
+        fetch_address = self.fetch_address
+        cycles = 0
+        done = 0
+
+        try:
+            while done < count:
+                if upc == 0:
+                    fetch_address = pc
+                    if coverage is not None:
+                        coverage[pc] = 1
+
+                tb, fb, alu_op, p, sp_op, seq, uadr = micro_program[upc]
+                cycles += 1
+
+                # the bus, from the values before the clock edge
+                if tb == BUS_PM:
+                    bus = pm_out
+                elif tb == BUS_GRX:
+                    if upc < 15 and ir >> 13 & 0b11 == 0b11:
+                        bus = gr[3]  # indexed addressing
+                    elif ir >> 19 == mov_opcode and upc == k1[mov_opcode]:
+                        bus = gr[ir & 0b1111]  # MOV source, GR[adr]
+                    else:
+                        bus = gr[ir >> 15 & 0b1111]
+                elif tb == BUS_IR:
+                    bus = ir & ADDRESS_MASK
+                elif tb == BUS_PC:
+                    bus = pc
+                elif tb == BUS_AR:
+                    bus = ar & WORD_MASK
+                elif tb == BUS_ASR:
+                    bus = asr
+                elif tb == BUS_SP:
+                    bus = sp
+                else:
+                    bus = 0
+
+                # next uPC, from Z and IR before the clock edge
+                if seq == SEQ_NEXT:
+                    next_upc = upc + 1 & 0xFF
+                elif seq == SEQ_ZERO:
+                    next_upc = 0
+                    done += 1
+                elif seq == SEQ_K2:
+                    next_upc = k2[ir >> 13 & 0b11]
+                elif seq == SEQ_K1:
+                    next_upc = k1[ir >> 19]
+                    if next_upc == UNDEFINED:
+                        utils.ERROR(
+                            f"Opcode {ir >> 19:05b} at address {fetch_address} "
+                            "has no microprogram (K1)"
+                        )
+                elif seq == SEQ_IF_NOT_Z:
+                    next_upc = uadr if ar != 0 else upc + 1 & 0xFF
+                elif seq == SEQ_IF_Z:
+                    next_upc = uadr if ar == 0 else upc + 1 & 0xFF
+                elif seq == SEQ_JUMP:
+                    next_upc = uadr
+                elif seq == SEQ_IF_N:
+                    next_upc = uadr if ar >> 23 & 1 else upc + 1 & 0xFF
+                elif seq == SEQ_IF_C:
+                    next_upc = uadr if ar >> 24 else upc + 1 & 0xFF
+                elif seq == SEQ_IF_NOT_C:
+                    next_upc = uadr if not ar >> 24 else upc + 1 & 0xFF
+                elif seq == SEQ_HALT:
+                    if self.verbose:
+                        print("HALT instruction reached")
+                    self.halted = True
+                    done += 1
+                    break
+                else:
+                    utils.ERROR(f"Unknown SEQ {seq:04b} in uMem address {upc}")
+
+                # synchronous read of pMem, before this cycle's write
+                next_pm_out = memory[asr]
+
+                if fb == BUS_ASR:
+                    asr = bus & ADDRESS_MASK
+                elif fb == BUS_PM:
+                    memory[asr] = bus
+                elif fb == BUS_PC:
+                    pc = bus & ADDRESS_MASK
+                elif fb == BUS_IR:
+                    ir = bus
+                elif fb == BUS_GRX:
+                    gr[ir >> 15 & 0b1111] = bus
+
+                if p and fb != BUS_PC:
+                    pc = pc + 1 & ADDRESS_MASK
+
+                if sp_op == SP_DECREMENT:
+                    sp = sp - 1 & ADDRESS_MASK
+                elif sp_op == SP_INCREMENT:
+                    sp = sp + 1 & ADDRESS_MASK
+
+                if alu_op:
+                    if alu_op == ALU_LOAD:
+                        ar = bus
+                    elif alu_op == ALU_ADD:
+                        ar = ar + bus & AR_MASK
+                    elif alu_op == ALU_SUB or alu_op == ALU_CMP:
+                        ar = ar - bus & AR_MASK
+                    elif alu_op == ALU_AND:
+                        ar &= bus
+                    elif alu_op == ALU_OR:
+                        ar |= bus
+                    elif alu_op == ALU_MUL:
+                        ar = ar * bus & AR_MASK
+                    elif alu_op == ALU_LSR:
+                        ar >>= bus
+                    elif alu_op == ALU_LSL:
+                        ar = ar << bus & AR_MASK if bus < 25 else 0
+                    else:
+                        utils.ERROR(f"Unknown ALU operation {alu_op:04b} in uMem address {upc}")
+
+                pm_out = next_pm_out
+                upc = next_upc
+        finally:
+            for name, value in zip(REGISTER_NAMES, gr):
+                registers[name] = value
+            registers["PC"], registers["SP"] = pc, sp
+            self.set_ar(ar)
+            self.ir, self.asr, self.pm_out, self.upc = ir, asr, pm_out, upc
+            self.fetch_address = fetch_address
+            self.cycle_count += cycles
+            self.instruction_count += done
+
+
+def find_divergence(image: Image, events: list, max_instructions: int, microcode: Microcode = None):
+    """
+    Run `image` with keypresses `events` on a MicroMachine and a
+    BinaryMachine in lockstep, one instruction at a time.
+    Return None if they agree for `max_instructions` instructions or until
+    both halt or fail, otherwise a description of the first divergence.
+    """
+
+    micro = MicroMachine(image=image, microcode=microcode)
+    binary = BinaryMachine(image=image)
+    binary.detect_idle_loops = False
+
+    for machine in (micro, binary):
+        machine.verbose = False
+        machine.schedule_inputs(events)
+
+    for _ in range(max_instructions):
+        address = binary.registers["PC"]
+        word = binary.memory[address]
+
+        errors = []
+        for machine in (micro, binary):
+            try:
+                machine.run(1)
+                errors.append(None)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+
+        differences = [
+            f"{name}: micro {micro.registers[name]}, instruction {binary.registers[name]}"
+            for name in binary.registers
+            if micro.registers[name] != binary.registers[name]
+        ]
+        differences += [
+            f"{name}: micro {micro.flags[name]}, instruction {binary.flags[name]}"
+            for name in binary.flags
+            if micro.flags[name] != binary.flags[name]
+        ]
+        if micro.memory != binary.memory:
+            differing = next(
+                i for i, (a, b) in enumerate(zip(micro.memory, binary.memory)) if a != b
+            )
+            differences.append(
+                f"memory[{differing}]: micro {micro.memory[differing]}, "
+                f"instruction {binary.memory[differing]}"
+            )
+        if micro.halted != binary.halted or (errors[0] is None) != (errors[1] is None):
+            differences.append(
+                f"stopped: micro {micro.halted or errors[0]}, "
+                f"instruction {binary.halted or errors[1]}"
+            )
+
+        if differences:
+            return {
+                "instruction": binary.instruction_count,
+                "address": address,
+                "disassembly": binary.disassemble(word),
+                "line": image.lines[address] if image.lines else "",
+                "differences": differences,
+            }
+
+        if micro.halted or errors[0] is not None:
+            break
+
+    return None
+
+
+def main():
+    utils.change_dir_to_root()
+
+    umem_file = utils.get_arg_value(sys.argv, "--umem", UMEM_FILE)
+    cpu_file = utils.get_arg_value(sys.argv, "--cpu", CPU_FILE)
+    images = [
+        arg
+        for arg in sys.argv[1:]
+        if arg.endswith((".vhd", ".bin")) and arg not in (umem_file, cpu_file)
+    ]
+    image_file_name = images[0] if images else PMEM_FILE
+    microcode = Microcode.from_files(umem_file, cpu_file)
+    max_instructions = int(
+        utils.get_arg_value(sys.argv, "--max-instructions", DEFAULT_MAX_INSTRUCTIONS)
+    )
+    input_script = utils.get_arg_value(sys.argv, "--input-script")
+    events = read_input_script(input_script) if input_script else []
+
+    image = Image.from_file(image_file_name)
+
+    if "--lockstep" in sys.argv:
+        divergence = find_divergence(image, events, max_instructions, microcode)
+        if divergence is None:
+            print(f"{COLORS.OKGREEN}Engines agree on {image_file_name}{COLORS.ENDC}")
+            return
+
+        print(
+            f"{COLORS.FAIL}Engines diverge after instruction {divergence['instruction']}"
+            f"{COLORS.ENDC} at address {divergence['address']}: "
+            f"{divergence['disassembly']} ({divergence['line']})"
+        )
+        for difference in divergence["differences"]:
+            print(f"  {difference}")
+        sys.exit(1)
+
+    machine = MicroMachine(image=image, microcode=microcode)
+    machine.schedule_inputs(events)
+
+    t = time.time()
+    error = None
+    try:
+        machine.run(max_instructions)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    duration = time.time() - t
+
+    print(
+        f"{COLORS.BOLD}{image_file_name}{COLORS.ENDC}: {machine.instruction_count} "
+        f"instructions in {machine.cycle_count} cycles "
+        f"({machine.cycle_count / max(machine.instruction_count, 1):.2f} cycles per instruction)"
+    )
+    print("  ".join(f"{name}={value}" for name, value in machine.registers.items()))
+    print("  ".join(f"{name}={value}" for name, value in machine.flags.items()))
+    if error:
+        print(f"{COLORS.FAIL}{error}{COLORS.ENDC} at address {machine.fetch_address}")
+    print(f"{machine.cycle_count / duration:,.0f} cycles/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Read the microprogram of the CPU: the micro memory `u_mem_array` of
+hardware/uMem.vhd and the K1 (opcode -> uPC) and K2 (mode -> uPC) tables
+of hardware/cpu.vhd.
+
+Every microinstruction is predecoded into its fields
+
+    TB(24..22) FB(21..19) ALU(18..15) P(14) SP(13..12) SEQ(11..8) uADR(7..0)
+
+kept as one integer table per field, indexed by uPC, so engines can read
+them without any bit fiddling. Don't care bits ('-') are read as 0.
+"""
+
+import os, re
+
+import utils
+
+UMEM_FILE = os.path.join(utils.ROOT_DIR, "hardware", "uMem.vhd")
+CPU_FILE = os.path.join(utils.ROOT_DIR, "hardware", "cpu.vhd")
+
+UMEM_SIZE = 256  # 8-bit uPC
+UNDEFINED = -1  # K1/K2 entry of opcodes and modes without microprogram
+
+# bus sources (TB) and destinations (FB)
+BUS_ASR, BUS_PM, BUS_PC, BUS_AR, BUS_IR, BUS_GRX, BUS_SP, BUS_NONE = range(8)
+
+# ALU operations
+ALU_NOP, ALU_ADD, ALU_SUB, ALU_MUL, ALU_LOAD, ALU_AND, ALU_OR, ALU_LSR, ALU_LSL, ALU_CMP = range(10)
+
+# SP operations
+SP_KEEP, SP_DECREMENT, SP_INCREMENT = 0b00, 0b01, 0b10
+
+# sequencer operations
+(
+    SEQ_NEXT,
+    SEQ_K1,
+    SEQ_K2,
+    SEQ_ZERO,
+    SEQ_IF_NOT_Z,
+    SEQ_JUMP,
+    SEQ_IF_Z,
+    SEQ_IF_N,
+    SEQ_IF_C,
+    SEQ_IF_NOT_C,
+) = range(10)
+SEQ_HALT = 0b1111
+
+UMEM_ELEMENT_PATTERN = re.compile(r'\s*b"([01_\-]+)"\s*,?\s*(?:--\s*(.*))?')
+K_ENTRY_PATTERN = re.compile(r'b"([01]+)".*?WHEN\s*\((.*?)\)', re.IGNORECASE)
+
+
+class Microcode:
+    """
+    Represent the predecoded micro memory and the K1 and K2 tables
+    """
+
+    def __init__(self, words: list, comments: list, k1: list, k2: list):
+        self.words = words  # 25-bit microinstructions, by uPC
+        self.comments = comments
+        self.k1 = k1  # uPC by opcode, UNDEFINED if there is none
+        self.k2 = k2  # uPC by mode
+
+        self.tb = [word >> 22 & 0b111 for word in words]
+        self.fb = [word >> 19 & 0b111 for word in words]
+        self.alu = [word >> 15 & 0b1111 for word in words]
+        self.p = [word >> 14 & 0b1 for word in words]
+        self.sp = [word >> 12 & 0b11 for word in words]
+        self.seq = [word >> 8 & 0b1111 for word in words]
+        self.uadr = [word & 0b11111111 for word in words]
+
+    @classmethod
+    def from_files(cls, umem_file: str = UMEM_FILE, cpu_file: str = CPU_FILE):
+        with open(umem_file) as f:
+            words, comments = read_micro_memory(f.readlines())
+        with open(cpu_file) as f:
+            k1, k2 = read_k_tables(f.readlines())
+        return cls(words, comments, k1, k2)
+
+
+def read_micro_memory(lines: list) -> tuple:
+    """
+    Return the microinstructions and their comments from lines of uMem.vhd,
+    padded to UMEM_SIZE with zeros like its OTHERS entry
+    """
+
+    words = []
+    comments = []
+
+    array_started = False
+    for line in lines:
+        if re.match(r"\s*CONSTANT\s+u_mem_array", line, re.IGNORECASE):
+            array_started = True
+            continue
+        if not array_started:
+            continue
+        if re.match(r"\s*\);", line):
+            break
+
+        match = UMEM_ELEMENT_PATTERN.match(line)
+        if not match:
+            continue  # comment or OTHERS
+
+        bits, comment = match.groups()
+        bits = bits.replace("_", "").replace("-", "0")
+        if len(bits) != 25:
+            utils.ERROR(f"Microinstruction {match.group(1)} does not have 25 bits")
+
+        words.append(int(bits, 2))
+        comments.append((comment or "").strip())
+
+    if not words:
+        utils.ERROR("u_mem_array not found in micro memory file")
+
+    words += [0] * (UMEM_SIZE - len(words))
+    comments += [""] * (UMEM_SIZE - len(comments))
+
+    return words, comments
+
+
+def read_k_tables(lines: list) -> tuple:
+    """
+    Return the K1 table (32 opcodes) and the K2 table (4 modes)
+    from the `K1 <=` and `K2 <=` assignments in lines of cpu.vhd
+    """
+
+    text = "".join(lines)
+    tables = {}
+
+    for name, size, field in (("K1", 32, "OP"), ("K2", 4, "M")):
+        match = re.search(rf"\b{name}\s*<=(.*?);", text, re.DOTALL)
+        if not match:
+            utils.ERROR(f"{name} assignment not found in CPU file")
+
+        table = [UNDEFINED] * size
+        for upc, condition in K_ENTRY_PATTERN.findall(match.group(1)):
+            # e.g. (M = "00" OR M = "--"), don't care values never match
+            for value in re.findall(rf'{field}\s*=\s*"([01]+)"', condition):
+                table[int(value, 2)] = int(upc, 2)
+        tables[name] = table
+
+    return tables["K1"], tables["K2"]
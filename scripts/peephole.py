@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Peephole optimizer for preassembled masm lines (see preassemble.py), an
+optional pass before the assembler encodes them:
+
+    python peephole.py <file.s>             # report what it would save
+    python assembler.py <file.s> --optimize
+
+Rules, applied until none matches any more:
+- fold-immediates: `ADDI`/`SUBI` right after `LDI`, `ADDI` or `SUBI` of
+  the same register is folded into it, e.g.
+
+      LDI GR0, 34      ->    LDI GR0, 33
+      SUBI GR0, 1
+
+  After LDI only if the Z flag is not used before it is set again,
+  LDI leaves the flags alone. The same holds for ADDI after SUBI and
+  SUBI after ADDI: Z is taken from the 25 bits of AR, the carry
+  included, so `SUBI GR0, 5` and `ADDI GR0, 2` with GR0 = 3 leave Z = 0
+  where `SUBI GR0, 3` sets it.
+- thread-branches: a branch (or JSR) to a label whose first instruction
+  is `BRA` goes to where that BRA goes.
+- drop-cmp-zero: `CMPI GRx, 0` right after SUB, AND or OR of GRx, which
+  already set Z from GRx. Not after ADD, whose carry bit is part of Z on
+  the hardware (2^24 gives GRx = 0 but Z = 0).
+- dead-ldi: `LDI GRx` overwritten by a load, MOV or POP of GRx before it
+  is read.
+
+Rules only look at straight-line code, nothing with a label in between is
+changed. Only Z can be read by programs (BNE, BEQ), so other flags are not
+kept. Lines with breakpoints (`;b`) and GR14/GR15, which the beeper and the
+keyboard use outside of the program, are left alone.
+
+The report lists the words and the cycles saved for one execution of every
+changed place, by rule (cycles from cycle_model.py).
+"""
+
+import re, sys
+
+import utils
+from utils import COLORS
+from masm_ir import ParsedProgram, parse_statement
+from expression import evaluate
+from cycle_model import get_cycle_table
+from preassemble import preassemble
+
+RULES = ["fold-immediates", "thread-branches", "drop-cmp-zero", "dead-ldi"]
+
+# registers used by hardware outside the program
+RESERVED_REGISTERS = {"GR14", "GR15"}
+
+# instructions that set Z from their result
+FLAG_SETTERS = {"ADD", "SUB", "CMP", "AND", "OR", "MUL", "LSR", "MOV"}
+# instructions that leave straight-line code
+JUMPS = {"BRA", "BNE", "BEQ", "JSR", "RET", "HALT", "SWAP"}
+
+MAX_IMMEDIATE = 2**23  # folded values stay far from the 24-bit wrap
+
+COMMENT_PATTERN = re.compile(r"\s*(//|--|@).*")
+
+
+class Instruction:
+    """
+    Represent a decoded instruction line
+    """
+
+    def __init__(self, line: str, expanded: str, isa: dict):
+        parsed = parse_statement(line, expanded, tuple(isa))
+        self.mnemonic, self.mode = parsed.mnemonic, parsed.mode
+        self.register, self.address = parsed.register, parsed.operand
+        self.has_breakpoint = parsed.breakpoint
+
+        comment = COMMENT_PATTERN.search(line)
+        self.comment = comment.group(0).strip() if comment else ""
+        self.indent = re.match(r"\s*", line).group(0)
+
+        try:
+            self.value = evaluate(self.address)
+        except Exception:
+            self.value = None  # a label, or no address
+
+    def reads(self, register: str) -> bool:
+        """
+        Return True if the instruction may read `register`
+        """
+
+        if self.mode == "N" and register == "GR3":
+            return True
+        if self.mnemonic == "MOV":
+            return self.address == register  # the source
+        if self.mnemonic in {"LD", "POP"}:
+            return False
+        return self.register == register or self.mnemonic in JUMPS
+
+    def writes_only(self, register: str) -> bool:
+        """
+        Return True if the instruction sets `register` without reading it
+        """
+
+        return (
+            self.register == register
+            and self.mnemonic in {"LD", "POP", "MOV"}
+            and not self.reads(register)
+        )
+
+
+def decode_lines(asm_lines: list, isa: dict) -> tuple:
+    """
+    Find the instruction of every preassembled line, None for other lines,
+    with macros and sections expanded like the assembler does. Return the
+    instructions and the labels (label -> line index).
+    """
+
+    instructions = []
+    labels = {}
+    for i, parsed in enumerate(ParsedProgram(asm_lines, isa).lines):
+        instruction = None
+        if parsed.kind == "label":
+            labels[parsed.name] = i
+        elif parsed.kind == "instruction":
+            instruction = Instruction(parsed.line, parsed.expanded, isa)
+        instructions.append(instruction)
+
+    return instructions, labels
+
+
+class Peephole:
+    """
+    Optimize preassembled lines, counting what every rule saved
+    """
+
+    def __init__(self, asm_lines: list, isa: dict = None):
+        self.lines = list(asm_lines)
+        self.isa = isa if isa is not None else utils.get_mnemonics()
+        self.cycle_table = get_cycle_table()
+        self.saved = {rule: [0, 0, 0] for rule in RULES}  # places, words, cycles
+        self.decode_lines()
+
+    def decode_lines(self):
+        self.instructions, self.labels = decode_lines(self.lines, self.isa)
+
+    def get_words(self, i: int) -> int:
+        instruction = self.instructions[i]
+        return 2 if instruction.mode == "I" and instruction.address != "-" else 1
+
+    def get_cycles(self, i: int) -> int:
+        return self.cycle_table.get_line_cycles(self.lines[i].strip(), self.isa)
+
+    def save(self, rule: str, words: int, cycles: int):
+        self.saved[rule][0] += 1
+        self.saved[rule][1] += words
+        self.saved[rule][2] += cycles
+
+    def remove(self, i: int, rule: str):
+        self.save(rule, self.get_words(i), self.get_cycles(i))
+        del self.lines[i]
+        del self.instructions[i]
+        self.labels = {label: j - (j > i) for label, j in self.labels.items()}
+
+    def replace(self, i: int, text: str):
+        instruction = self.instructions[i]
+        comment = f" {instruction.comment}" if instruction.comment else ""
+        self.lines[i] = f"{instruction.indent}{text}{comment}\n"
+        self.instructions[i] = Instruction(self.lines[i], text, self.isa)
+
+    def next_instruction(self, i: int, through_labels: bool = False):
+        """
+        Return the index of the instruction after line `i` in straight-line
+        code, None if a label (unless `through_labels`), section or data
+        word comes first
+        """
+
+        for j in range(i + 1, len(self.lines)):
+            line = self.lines[j]
+            if self.instructions[j] is not None:
+                return j
+            if line.startswith("_") or through_labels and line.strip().endswith(":"):
+                continue
+            return None
+
+        return None
+
+    def is_flag_dead(self, i: int) -> bool:
+        """
+        Return True if Z is set again after line `i` before it can be read
+        """
+
+        j = self.next_instruction(i, through_labels=True)
+        while j is not None:
+            instruction = self.instructions[j]
+            if instruction.mnemonic in FLAG_SETTERS and instruction.mode in {"", "I"}:
+                return True
+            if instruction.mnemonic == "HALT":
+                return True
+            if instruction.mnemonic in JUMPS:
+                return False
+            j = self.next_instruction(j, through_labels=True)
+
+        return False
+
+    def is_changeable(self, i: int) -> bool:
+        instruction = self.instructions[i]
+        return (
+            instruction is not None
+            and not instruction.has_breakpoint
+            and instruction.register not in RESERVED_REGISTERS
+        )
+
+    def fold_immediates(self) -> bool:
+        for i, first in enumerate(self.instructions):
+            if not self.is_changeable(i) or first.mode != "I":
+                continue
+            if first.mnemonic not in {"LD", "ADD", "SUB"} or first.value is None:
+                continue
+
+            j = self.next_instruction(i)
+            if j is None or not self.is_changeable(j):
+                continue
+            second = self.instructions[j]
+            if second.mnemonic not in {"ADD", "SUB"} or second.mode != "I":
+                continue
+            if second.register != first.register or second.value is None:
+                continue
+            if not (0 <= first.value < MAX_IMMEDIATE and 0 < second.value < MAX_IMMEDIATE):
+                continue
+            if first.value == 0 and first.mnemonic != "LD":
+                continue
+
+            step = second.value if second.mnemonic == "ADD" else -second.value
+            if first.mnemonic == "LD":
+                value = first.value + step
+                if not 0 <= value < MAX_IMMEDIATE or not self.is_flag_dead(j):
+                    continue
+                text = f"LDI {first.register}, {value}"
+            else:
+                value = (first.value if first.mnemonic == "ADD" else -first.value) + step
+                if value == 0:
+                    continue  # would change Z
+                if first.mnemonic != second.mnemonic and not self.is_flag_dead(j):
+                    continue  # the carry of one of them is part of Z
+                text = f"{'ADDI' if value > 0 else 'SUBI'} {first.register}, {abs(value)}"
+
+            self.remove(j, "fold-immediates")
+            self.replace(i, text)
+            return True
+
+        return False
+
+    def get_branch_target(self, label: str):
+        """
+        Return the label the first instruction after `label` branches to
+        with BRA, None if it is something else
+        """
+
+        if label not in self.labels:
+            return None
+
+        j = self.next_instruction(self.labels[label], through_labels=True)
+        if j is None:
+            return None
+        instruction = self.instructions[j]
+        if instruction.mnemonic != "BRA" or instruction.mode != "" or instruction.has_breakpoint:
+            return None
+        if instruction.address not in self.labels:
+            return None
+
+        return instruction.address, j
+
+    def thread_branches(self) -> bool:
+        changed = False
+
+        for i, instruction in enumerate(self.instructions):
+            if not self.is_changeable(i) or instruction.mode != "":
+                continue
+            if instruction.mnemonic not in {"BRA", "BNE", "BEQ", "JSR"}:
+                continue
+
+            label = instruction.address
+            seen = {label}
+            cycles = 0
+            target = self.get_branch_target(label)
+            while target is not None and target[0] not in seen:
+                label = target[0]
+                seen.add(label)
+                cycles += self.get_cycles(target[1])
+                target = self.get_branch_target(label)
+
+            if target is not None:
+                continue  # BRAs in a cycle, never leaves it anyway
+            if label != instruction.address:
+                self.replace(i, f"{instruction.mnemonic} {label}")
+                self.save("thread-branches", 0, cycles)
+                changed = True
+
+        return changed
+
+    def drop_cmp_zero(self) -> bool:
+        for i, first in enumerate(self.instructions):
+            if first is None or first.mnemonic not in {"SUB", "AND", "OR"}:
+                continue
+
+            j = self.next_instruction(i)
+            if j is None or not self.is_changeable(j):
+                continue
+            second = self.instructions[j]
+            if second.mnemonic == "CMP" and second.mode == "I" and second.value == 0:
+                if second.register == first.register:
+                    self.remove(j, "drop-cmp-zero")
+                    return True
+
+        return False
+
+    def remove_dead_ldi(self) -> bool:
+        for i, first in enumerate(self.instructions):
+            if not self.is_changeable(i) or first.mnemonic != "LD" or first.mode != "I":
+                continue
+
+            j = self.next_instruction(i)
+            while j is not None:
+                instruction = self.instructions[j]
+                if instruction.writes_only(first.register):
+                    self.remove(i, "dead-ldi")
+                    return True
+                if instruction.reads(first.register):
+                    break
+                j = self.next_instruction(j)
+
+        return False
+
+    def optimize(self) -> list:
+        """
+        Apply all rules until none changes anything, return the lines
+        """
+
+        while (
+            self.fold_immediates()
+            or self.thread_branches()
+            or self.drop_cmp_zero()
+            or self.remove_dead_ldi()
+        ):
+            pass
+
+        return self.lines
+
+    def get_report(self) -> list:
+        """
+        Return the lines of a table of what every rule saved
+        """
+
+        report = [f"{'rule':<16} {'places':>6} {'words':>6} {'cycles':>6}"]
+        for rule, (places, words, cycles) in self.saved.items():
+            report.append(f"{rule:<16} {places:>6} {words:>6} {cycles:>6}")
+
+        total = [sum(saved[k] for saved in self.saved.values()) for k in range(3)]
+        report.append(f"{'total':<16} {total[0]:>6} {total[1]:>6} {total[2]:>6}")
+
+        return report
+
+
+def optimize(asm_lines: list, isa: dict = None) -> tuple:
+    """
+    Optimize preassembled lines, return the new lines and the report
+    """
+
+    peephole = Peephole(asm_lines, isa)
+    lines = peephole.optimize()
+
+    return lines, peephole.get_report()
+
+
+def print_report(file_name: str, report: list):
+    print(f"{COLORS.BOLD}Peephole {file_name}{COLORS.ENDC}, saved per execution:")
+    print("\n".join(report))
+
+
+def main():
+    utils.change_dir_to_root()
+
+    if len(sys.argv) < 2:
+        utils.ERROR("Usage: python peephole.py <file.s>")
+    file_name = sys.argv[1]
+
+    _, report = optimize(preassemble(file_name))
+    print_report(file_name, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,40 @@
-import utils, os
 from utils import COLORS
+from masm_ir import MASM_DIR, read_file, read_lines
 
-MASM_DIR = "masm"
+def check_halt(asm_lines: list):
+    """
+    Print an error if the program contains no HALT
+    """
+
+    if not any("HALT" in line for line in asm_lines):
+        print(f"{COLORS.FAIL}ERROR:{COLORS.ENDC} HALT instruction not found in program")
 
-def preassemble(asm_file_name: str) -> list[str]:
+def preassemble(asm_file_name: str, masm_dir: str = MASM_DIR) -> list[str]:
     """
     Preassemble the assembly file by performing various
     pre-processing steps.
     Return preassembled file lines
     """
     
-    # Find the root directory of the project
-    utils.change_dir_to_root()
-    
-    # Read the assembly file
-    asm_file_path = os.path.join(MASM_DIR, asm_file_name)
-    asm_lines = open(asm_file_path, "r").readlines()
-    
-    # Resolve all includes in the assembly file
-    utils.resolve_includes(asm_lines, masm_dir="masm")
-    
-    # Remove comments and empty lines
-    asm_lines = utils.get_without_empty_or_only_comment_lines(asm_lines)
+    # Read the assembly file, with includes resolved and
+    # comments and empty lines removed
+    asm_lines = read_file(asm_file_name, masm_dir)
 
-    utils.resolve_mov_on_stack(asm_lines)
+    check_halt(asm_lines)
 
-    # check if program contains HALT, otherwise crash
-    if not any("HALT" in line for line in asm_lines):
-        print(f"{COLORS.FAIL}ERROR:{COLORS.ENDC} HALT instruction not found in program")
+    return asm_lines
+
+def preassemble_lines(asm_lines: list, masm_dir: str = MASM_DIR, includes: dict = None) -> list[str]:
+    """
+    Perform the pre-processing steps on lines of assembly code.
+    Included files are taken from `includes` (file name -> source text)
+    if given there, otherwise read from `masm_dir`.
+    Return preassembled lines, each a SourceLine that knows its file and
+    line number (see masm_ir.py)
+    """
+
+    asm_lines = read_lines(asm_lines, masm_dir=masm_dir, includes=includes)
+
+    check_halt(asm_lines)
 
-    return asm_lines
\ No newline at end of file
+    return asm_lines
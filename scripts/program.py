@@ -0,0 +1,114 @@
+"""
+This script contains a `Program` class: an assembly program expanded into
+the initial memory of the machine, together with its labels, sections,
+macros and breakpoints.
+
+A program can be loaded from a file in the masm directory, or from source
+text in memory. Nothing here changes the working directory or reads files
+unless asked to, so programs can be created in test runners, worker pools
+and notebooks, and shared between any number of machines.
+"""
+
+import re
+
+import utils
+from masm_ir import ParsedProgram
+from preassemble import MASM_DIR, preassemble, preassemble_lines
+
+MEMORY_HEIGHT = 4096
+
+
+class Program:
+    """
+    Represent an expanded program:
+    - initial memory
+    - labels, sections and macros
+    - breakpoints
+    """
+
+    def __init__(self, asm_lines: list, isa: dict = None):
+        """
+        Expand preassembled lines (see preassemble.py) into the full memory.
+        - Macros are expanded,
+        - Sections are used
+        `isa` maps mnemonics to opcodes, if not given it is read from
+        hardware/fax.md.
+        """
+
+        parsed_program = ParsedProgram(asm_lines, isa)
+
+        self.sections = parsed_program.sections  # section name -> Section object
+        self.macros = parsed_program.macros  # macro name -> macro value
+        self.labels = {}  # label name -> line number
+
+        # init empty memory, and where every line comes from
+        self.memory = [""] * MEMORY_HEIGHT
+        self.locations = [None] * MEMORY_HEIGHT
+
+        current_section = None
+        for parsed in parsed_program.lines:
+            if parsed.kind == "section":
+                current_section = self.sections[parsed.name]
+                continue
+            if parsed.kind not in {"label", "instruction", "data"}:
+                continue
+            if current_section is None:
+                utils.ERROR(f"{parsed.get_where()}`{parsed.line.strip()}` is not in any section")
+
+            address = current_section.start + len(current_section.lines)
+            if parsed.kind == "label":
+                self.labels[parsed.name] = address
+                continue
+
+            # macros and sections are expanded already
+            current_section.lines.append(parsed.expanded)
+            if address < MEMORY_HEIGHT:
+                self.memory[address] = parsed.expanded
+                self.locations[address] = parsed.location
+
+        self.breakpoints = self.find_all_breakpoints()
+
+    def get_section_at(self, address: int):
+        """
+        Return the section whose lines hold `address`, None if there is none
+        """
+
+        for section in self.sections.values():
+            if section.start <= address < section.start + len(section.lines):
+                return section
+
+        return None
+
+    def find_all_breakpoints(self) -> list:
+        """
+        Find all breakpoints (lines containing `;b`) in the memory
+        """
+
+        breakpoints = []
+        for i, line in enumerate(self.memory):
+            if re.match(r".*;b.*", line):
+                breakpoints.append(i)
+
+        return breakpoints
+
+    @classmethod
+    def from_file(cls, asm_file_name: str, masm_dir: str = MASM_DIR, isa: dict = None):
+        """
+        Load program from `asm_file_name` in the masm directory
+        """
+
+        return cls(preassemble(asm_file_name, masm_dir), isa)
+
+    @classmethod
+    def from_source(cls, source: str, includes: dict = None, isa: dict = None):
+        """
+        Load program from source text. `includes` maps file names used in
+        `<...>` includes to their source text, includes not found in it
+        are read from the masm directory.
+        """
+
+        asm_lines = source.splitlines(keepends=True)
+        if asm_lines and not asm_lines[-1].endswith("\n"):
+            asm_lines[-1] += "\n"
+
+        return cls(preassemble_lines(asm_lines, includes=includes), isa)
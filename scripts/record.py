@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Record frames of the emulated map without a window.
+
+The machine is run as fast as possible, a frame is captured every
+`every_k_instructions` instructions. Nothing is throttled by the pygame
+clock and pygame is not needed at all. Frames are written either as a
+PNG sequence or as one raw RGB24 stream, which can be turned into a video:
+
+    ffmpeg -f rawvideo -pix_fmt rgb24 -s 624x480 -r 60 -i frames.rgb out.mp4
+
+Usage: python record.py <assembly_file.s> <out_dir> [--frames N]
+       [--every-k-instructions K] [--format png|raw] [--input-script <file>]
+
+Also available as `python emulate.py <assembly_file.s> --record <out_dir> ...`
+"""
+
+import os, sys
+
+import utils
+import frames
+from machine import Machine
+from input_script import read_input_script
+
+RECORD_FORMATS = {"png", "raw"}
+RAW_FILE_NAME = "frames.rgb"
+DEFAULT_NUM_FRAMES = 600
+DEFAULT_EVERY_K_INSTRUCTIONS = 10000
+FFMPEG_FPS = 60
+
+
+def record_frames(
+    machine,
+    out_dir: str,
+    num_frames: int,
+    every_k_instructions: int,
+    frame_format: str = "png",
+    tile_images=None,
+) -> int:
+    """
+    Run `machine` and write a frame of its map to `out_dir` every
+    `every_k_instructions` instructions, until `num_frames` frames are
+    written or the machine halts.
+
+    Return number of written frames.
+    """
+
+    if frame_format not in RECORD_FORMATS:
+        utils.ERROR(f"Unknown frame format {frame_format}, use one of {RECORD_FORMATS}")
+    if every_k_instructions < 1:
+        utils.ERROR("Must execute at least one instruction between frames")
+
+    if tile_images is None:
+        tile_images = frames.load_tile_images()
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    raw_file = None
+    if frame_format == "raw":
+        raw_file = open(os.path.join(out_dir, RAW_FILE_NAME), "wb")
+
+    num_written = 0
+    try:
+        while num_written < num_frames:
+            frame = frames.render_map(machine, tile_images)
+
+            if raw_file:
+                raw_file.write(frame.tobytes())
+            else:
+                frame_path = os.path.join(out_dir, f"frame_{num_written:06d}.png")
+                frames.write_png(frame_path, frame)
+            num_written += 1
+
+            if machine.halted:
+                break  # nothing will change anymore
+
+            machine.run(every_k_instructions)
+    finally:
+        if raw_file:
+            raw_file.close()
+
+    return num_written
+
+
+def print_summary(out_dir: str, frame_format: str, num_written: int):
+    """
+    Tell the user where the frames went and how to turn them into a video
+    """
+
+    print(f"Wrote {num_written} frames to {out_dir}")
+
+    size = f"{frames.MAP_SIZE_X_PX}x{frames.MAP_SIZE_Y_PX}"
+    if frame_format == "raw":
+        raw_path = os.path.join(out_dir, RAW_FILE_NAME)
+        print(
+            f"ffmpeg -f rawvideo -pix_fmt rgb24 -s {size} -r {FFMPEG_FPS} -i {raw_path} out.mp4"
+        )
+    else:
+        png_pattern = os.path.join(out_dir, "frame_%06d.png")
+        print(f"ffmpeg -framerate {FFMPEG_FPS} -i {png_pattern} out.mp4")
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+
+    utils.change_dir_to_root()
+
+    asm_file_name, out_dir = sys.argv[1], sys.argv[2]
+    num_frames = int(utils.get_arg_value(sys.argv, "--frames", DEFAULT_NUM_FRAMES))
+    every_k_instructions = int(
+        utils.get_arg_value(
+            sys.argv, "--every-k-instructions", DEFAULT_EVERY_K_INSTRUCTIONS
+        )
+    )
+    frame_format = utils.get_arg_value(sys.argv, "--format", "png")
+    input_script_file = utils.get_arg_value(sys.argv, "--input-script")
+
+    machine = Machine(asm_file_name)
+    if input_script_file is not None:
+        machine.schedule_inputs(read_input_script(input_script_file))
+    num_written = record_frames(
+        machine, out_dir, num_frames, every_k_instructions, frame_format
+    )
+    print_summary(out_dir, frame_format, num_written)
+
+
+if __name__ == "__main__":
+    main()
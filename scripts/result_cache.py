@@ -0,0 +1,128 @@
+"""
+Content-addressed cache of emulation results.
+
+A result is stored under the SHA-256 of everything that determines it:
+the expanded program (memory and labels, so changes to included files,
+macros and sections count), the scheduled keypresses, the engine version
+(machine.ENGINE_VERSION), the instruction limit and anything else the
+caller passes as `extra` (swept values, checkpoints, the tile ROM, ...).
+Results are JSON files in .emucache/, e.g. final registers, flags, memory
+digest, instruction and cycle counts or frame hashes. When the cache grows
+above its size limit, the least recently used results are removed.
+"""
+
+import hashlib, json, os
+
+import utils
+from machine import ENGINE_VERSION
+
+CACHE_DIR = os.path.join(utils.ROOT_DIR, ".emucache")
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def get_key(program, input_events: list, max_instructions: int, extra=None) -> str:
+    """
+    Return the cache key of running `program` (see program.py) with the
+    keypresses `input_events` for `max_instructions` instructions.
+    `extra` is anything JSON serializable that changes the result too.
+    """
+
+    description = {
+        "engine": ENGINE_VERSION,
+        "memory": program.memory,
+        "labels": sorted(program.labels.items()),
+        "inputs": [list(event) for event in input_events],
+        "max_instructions": max_instructions,
+        "extra": extra,
+    }
+
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def get_file_digest(file_name: str) -> str:
+    with open(file_name, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ResultCache:
+    """
+    Represent a directory of cached results with a size limit
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_since_eviction = 0
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str):
+        """
+        Return the result stored under `key`, None if there is none
+        """
+
+        path = self.get_path(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            os.utime(path)  # recently used
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return result
+
+    def put(self, key: str, result: dict):
+        """
+        Store `result` under `key`. Old results are evicted every
+        `max_bytes / 16` written bytes, call `evict` when done.
+        """
+
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # other processes never see half written results
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(result, f)
+        os.replace(temp_path, path)
+
+        self.bytes_since_eviction += os.path.getsize(path)
+        if self.bytes_since_eviction > self.max_bytes // 16:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used results until the cache fits in `max_bytes`
+        """
+
+        entries = []
+        for directory, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # removed by another process
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        self.bytes_since_eviction = 0
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def clear(self):
+        max_bytes, self.max_bytes = self.max_bytes, 0
+        self.evict()
+        self.max_bytes = max_bytes
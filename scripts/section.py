@@ -1,5 +1,7 @@
 import re
 
+from lexer import substitute
+
 
 class Section:
     """
@@ -36,10 +38,4 @@ def use_sections(line, sections):
     start linenum
     """
 
-    if not "%" in line:
-        return line # nothing to do
-    
-    for section_name, section in sections.items():
-        line = line.replace(f"%{section.name}", str(section.start))
-
-    return line
\ No newline at end of file
+    return substitute(line, sections=sections)
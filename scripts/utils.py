@@ -1,7 +1,15 @@
-import os, re, sys, time
+import glob, os, re, sys, time
+from pathlib import Path
 
 COMMENT_INITIATORS = {"--", "//", "@"}
 
+# root directory of the project, independent of the working directory
+ROOT_DIR = str(Path(__file__).resolve().parents[1])
+FAX_FILE = os.path.join(ROOT_DIR, "hardware", "fax.md")
+
+# mnemonics read from FAX_FILE, see get_mnemonics
+_mnemonics = None
+
 
 class COLORS:
     HEADER = "\033[95m"
@@ -35,22 +43,18 @@ def change_dir_to_root():
         os.chdir(os.pardir)
 
 
-def resolve_includes(asm_lines: list, masm_dir: str):
+def get_programs(masm_dir: str) -> list:
     """
-    Resolve all includes in the given assembly lines
+    Return the file names of all programs in `masm_dir`.
+    Files without a %PROGRAM section are only included by others.
     """
 
-    for i, line in enumerate(asm_lines):
-        if "<" not in line:
-            continue
-
-        include_file_name = re.search(r"<(.+)>", line).group(1)
-        include_file_path = os.path.join(masm_dir, include_file_name)
-
-        include_lines = open(include_file_path, "r").readlines()
+    programs = []
+    for path in sorted(glob.glob(os.path.join(masm_dir, "*.s"))):
+        if "%PROGRAM" in open(path).read():
+            programs.append(os.path.basename(path))
 
-        # replace the include line with the lines from the included file
-        asm_lines[i : i + 1] = include_lines
+    return programs
 
 
 def get_decimal_int(input_number_string: str) -> int:
@@ -68,7 +72,8 @@ def get_decimal_int(input_number_string: str) -> int:
     if not match:
         ERROR(f"Could not parse number string {input_number_string}")
 
-    number_base = match.group(2) or "d"  # default to decimal
+    # `$` is hexadecimal, default to decimal
+    number_base = match.group(2) or ("x" if match.group(1) == "$" else "d")
     number = match.group(3)
 
     # Convert the number to an integer based on its base
@@ -80,47 +85,39 @@ def get_decimal_int(input_number_string: str) -> int:
         return int(number, 16)
 
 
-def evaluate_expr(expr: str) -> int:
+def ERROR(msg: str):
     """
-    Given string of arithmetic expression between numbers
-    in binary, decimal or hexadecimal formats, return
-    the integer value of the expression.
+    Print error message and exit with code 1
     """
+    raise Exception(msg)
 
-    # # remove whitespace and underscores
-    # expr = re.sub(r"\s+|_", "", expr)
 
-    # # find all numbers in the expression
-    # numbers = re.findall(r"[0-9a-fA-F]+", expr)
+def get_mnemonics(fax_file: str = FAX_FILE) -> dict:
+    """
+    Get all the mnemonics from the hardware/fax.md file.
+    The default file is only read once per process.
+    """
 
-    # # replace the numbers with their decimal values
-    # for num in numbers:
-    #     expr = expr.replace(num, str(get_decimal_int(num)))
+    global _mnemonics
 
-    # return the decimal value of the expression
-    return eval(expr)
+    if fax_file != FAX_FILE:
+        return parse_mnemonics(open(fax_file, "r").readlines(), fax_file)
 
+    if _mnemonics is None:
+        with open(FAX_FILE, "r") as f:
+            _mnemonics = parse_mnemonics(f.readlines(), FAX_FILE)
 
-def ERROR(msg: str):
-    """
-    Print error message and exit with code 1
-    """
-    raise Exception(msg)
+    return _mnemonics
 
 
-def get_mnemonics():
+def parse_mnemonics(lines: list, fax_file: str = FAX_FILE) -> dict:
     """
-    Get all the mnemonics from the hardware/fax.md file
+    Parse the opcode table under `## OP-koder` from lines of fax.md.
+    Return dictionary of mnemonic -> binary opcode
     """
 
-    FAX_FILE = "hardware/fax.md"
-
-    change_dir_to_root()
-
-    with open(FAX_FILE, "r") as f:
-        lines = f.readlines()
     if not lines:
-        print(f"Error: Could not find/read {FAX_FILE}")
+        print(f"Error: Could not find/read {fax_file}")
         sys.exit(1)
     mnemonics = {}
     # find the opcodes header
@@ -132,7 +129,7 @@ def get_mnemonics():
 
     # no opcodes header found?
     if mnemonics_start_line is None:
-        print(f"Error: Could not find opcodes header in {FAX_FILE}")
+        print(f"Error: Could not find opcodes header in {fax_file}")
         sys.exit(1)
 
     # loop through opcodes
@@ -145,7 +142,7 @@ def get_mnemonics():
 
         parts = line.split()
         if len(parts) != 2:
-            print(f"Error: Could not parse opcode line {i + 1} in {FAX_FILE}")
+            print(f"Error: Could not parse opcode line {i + 1} in {fax_file}")
             sys.exit(1)
         opcode_binary, mnemonic = parts
         mnemonics[mnemonic] = opcode_binary
@@ -153,52 +150,37 @@ def get_mnemonics():
     return mnemonics
 
 
-def get_clean_lines(lines):
-    """
-    Return the lines which have no comments and are not empty
-    """
-    return [
-        line
-        for line in lines
-        if not re.match(rf"({'|'.join(COMMENT_INITIATORS)}).*", line) and line.strip()
-    ]
-
-
-def resolve_mov_on_stack(asm_lines):
+def get_arg_value(args: list, option: str, default=None):
     """
-    Replace MOV instructions with PUSH and POP instructions
+    Return the value following `option` in the command line `args`,
+    or `default` if the option is not given.
     """
 
-    for i, line in enumerate(asm_lines):
-        if "MOV" not in line:
-            continue
-
-        registers = re.findall(r"GR\d+", line)
+    if option not in args:
+        return default
 
-        push_line = f"PUSH {registers[1]}"
-        pop_line = f"POP {registers[0]}"
+    index = args.index(option)
+    if index + 1 >= len(args):
+        ERROR(f"Missing value for {option}")
 
-        # remove original line, add new lines
-        asm_lines[i : i + 1] = [push_line, pop_line]
+    return args[index + 1]
 
 
-def get_without_empty_or_only_comment_lines(lines):
+def get_arg_values(args: list, option: str) -> list:
     """
-    Remove empty lines and lines that are only comments
-    This allows code that has comments at the end of the line
+    Return the values following every occurrence of `option`
+    in the command line `args`.
     """
 
-    result = []
-    for line in lines:
-        # only comment -> skip
-        if re.match(rf"^\s*({'|'.join(COMMENT_INITIATORS)}).*", line):
-            continue
-        # empty line -> skip
-        if not line.strip():
+    values = []
+    for index, arg in enumerate(args):
+        if arg != option:
             continue
-        result.append(line)
+        if index + 1 >= len(args):
+            ERROR(f"Missing value for {option}")
+        values.append(args[index + 1])
 
-    return result
+    return values
 
 
 if __name__ == "__main__":
@@ -0,0 +1,833 @@
+"""
+This script contains a `VectorMachine` class, which runs many instances of
+the same program in lockstep with NumPy.
+
+All machines share the decoded program, their state is held in 2-D arrays:
+- memory (N, 4096) values and what kind of word each one is
+- registers (N, 18): GR0-GR15, PC, SP
+- flags (N, 4): Z, N, C, V
+
+Every step fetches the current instruction of all running machines at once,
+groups the machines by opcode and executes every group with vectorized
+operations, so divergent PCs are handled by masks. The results are the same
+as running each machine with the scalar `Machine`: the same registers,
+flags, instruction and cycle counts and memory (see `get_memory_words`).
+
+Like `Machine.run`, every machine skips the idle loops it waits in (up to
+its next scheduled keypress) and jumps over counted loops (see loops.py),
+so machines polling for input or in delay loops cost a step, not
+thousands. Machines drift apart in instruction count by that, every one
+stops at its own limit (`max_counts` of `step`).
+
+Differences to `Machine`, where the scalar machine would only fail later:
+- POP/RET of a word that was not pushed stops the machine with an error
+- values are 64-bit integers instead of unbounded Python integers
+"""
+
+import re
+import numpy as np
+
+import utils
+from section import use_sections
+from macros import use_macros
+from machine import KEY_NUMBERS, MAX_VALUE
+from program import MEMORY_HEIGHT
+from masm_ir import split_instruction
+from expression import evaluate
+from instruction_decoding import parse_operation, parse_register_and_address
+from cycle_model import get_cycle_table
+from loops import find_counted_loops
+
+NUM_REGISTERS = 18
+PC = 16
+SP = 17
+REGISTER_NAMES = [f"GR{i}" for i in range(16)] + ["PC", "SP"]
+REGISTER_INDICES = {name: i for i, name in enumerate(REGISTER_NAMES)}
+FLAG_NAMES = ["Z", "N", "C", "V"]
+Z = 0
+
+# internal opcodes of decoded instructions
+(
+    OP_EMPTY,  # no instruction at address
+    OP_INVALID,  # instruction can not be decoded, fails when executed
+    OP_OVERWRITTEN,  # instruction was overwritten by a store or push
+    OP_HALT,
+    OP_RET,
+    OP_BRA,
+    OP_BNE,
+    OP_BEQ,
+    OP_JSR,
+    OP_MOV,
+    OP_PUSH,
+    OP_POP,
+    OP_LD,
+    OP_ST,
+    OP_ADD,
+    OP_SUB,
+    OP_CMP,
+    OP_AND,
+    OP_OR,
+    OP_MUL,
+    OP_LSR,
+    OP_LSL,
+) = range(22)
+
+MNEMONIC_OPS = {
+    "HALT": OP_HALT,
+    "RET": OP_RET,
+    "BRA": OP_BRA,
+    "BNE": OP_BNE,
+    "BEQ": OP_BEQ,
+    "JSR": OP_JSR,
+    "MOV": OP_MOV,
+    "PUSH": OP_PUSH,
+    "POP": OP_POP,
+    "LD": OP_LD,
+    "ST": OP_ST,
+    "ADD": OP_ADD,
+    "SUB": OP_SUB,
+    "CMP": OP_CMP,
+    "AND": OP_AND,
+    "OR": OP_OR,
+    "MUL": OP_MUL,
+    "LSR": OP_LSR,
+    "LSL": OP_LSL,
+}
+ALU_OPS = {OP_ADD, OP_SUB, OP_CMP, OP_AND, OP_OR, OP_MUL, OP_LSR, OP_LSL}
+# ops that may branch back, by op
+IS_BRANCH = np.zeros(OP_LSL + 1, dtype=bool)
+IS_BRANCH[[OP_BRA, OP_BNE, OP_BEQ, OP_JSR]] = True
+
+NO_INPUT = np.iinfo(np.int64).max  # instruction count of no scheduled keypress
+
+# address modes
+MODE_DIRECT, MODE_IMMEDIATE, MODE_INDEXED, MODE_OTHER = range(4)
+MODES = {"": MODE_DIRECT, "I": MODE_IMMEDIATE, "N": MODE_INDEXED}
+
+# kinds of memory words
+WORD_PROGRAM = 0  # as loaded from the program
+WORD_STORED = 1  # written by ST, a 24-bit binary string in `Machine`
+WORD_PUSHED = 2  # written by PUSH/JSR, an integer in `Machine`
+
+
+class VectorMachine:
+    """
+    Represent the state of N machines running the same program
+    """
+
+    def __init__(self, program, num_machines: int, isa=None):
+        """
+        Create `num_machines` machines running `program` (see program.py).
+        `isa` maps mnemonics to opcodes, read from hardware/fax.md if not given.
+        """
+
+        self.program = program
+        self.num_machines = num_machines
+        self.isa = isa if isa is not None else utils.get_mnemonics()
+        self.sections = program.sections
+        self.labels = program.labels
+        self.macros = program.macros
+        # same as `Machine.check_limits`, `detect_idle_loops` and `skip_counted_loops`
+        self.check_limits = False
+        self.detect_idle_loops = True
+        self.skip_counted_loops = True
+
+        self.decode_program()
+        self.reset()
+
+    def decode_program(self):
+        """
+        Decode every word of the program once into arrays indexed by address
+        """
+
+        height = MEMORY_HEIGHT
+        self.code_op = np.full(height, OP_EMPTY, dtype=np.int64)
+        self.code_reg = np.zeros(height, dtype=np.int64)
+        self.code_adr = np.zeros(height, dtype=np.int64)
+        self.code_mode = np.zeros(height, dtype=np.int64)
+        self.decode_errors = {}  # address -> error message of OP_INVALID
+        self.code_mode_names = {}  # address -> address mode as written
+
+        # cycles of every instruction with its branch not taken (cycle_model.py)
+        cycle_table = get_cycle_table()
+        self.code_cycles = np.array(
+            [cycle_table.get_line_cycles(line, self.isa) for line in self.program.memory],
+            dtype=np.int64,
+        )
+        self.taken_branch_cycles = {
+            op: cycle_table.get_taken_cycles(mnemonic, self.isa)
+            for mnemonic, op in (("BNE", OP_BNE), ("BEQ", OP_BEQ))
+            if mnemonic in self.isa  # an explicit ISA may leave out unused opcodes
+        }
+
+        # numeric value of every word, if it can be read as data
+        self.program_values = np.zeros(height, dtype=np.int64)
+        self.program_numeric = np.zeros(height, dtype=bool)
+
+        # section of every address, the stack must not run into them
+        self.in_section = np.zeros(height, dtype=bool)
+        for section in self.sections.values():
+            self.in_section[section.start : section.start + len(section.lines)] = True
+
+        self.decode_counted_loops()
+
+        for address, line in enumerate(self.program.memory):
+            if not line:
+                continue
+
+            try:
+                self.program_values[address] = utils.get_decimal_int(line)
+                self.program_numeric[address] = True
+            except Exception:
+                pass  # not data
+
+            try:
+                self.decode_instruction(address, line)
+            except Exception as e:
+                self.code_op[address] = OP_INVALID
+                self.decode_errors[address] = f"{type(e).__name__}: {e}"
+
+    def decode_instruction(self, address: int, line: str):
+        """
+        Decode a single assembly line the same way `Machine` interprets it
+        """
+
+        parts = list(split_instruction(line))
+        mnemonic, address_mode = parse_operation(parts, self.isa)
+
+        if mnemonic not in MNEMONIC_OPS:
+            utils.ERROR(f"Unknown instruction {mnemonic}")
+        op = MNEMONIC_OPS[mnemonic]
+
+        reg, adr = "-", 0
+        if op in {OP_BRA, OP_BNE, OP_BEQ, OP_JSR}:
+            destination = parts[1]
+            if re.match(r"\d+", destination):
+                adr = int(destination)
+            elif destination in self.labels:
+                adr = self.labels[destination]
+            else:
+                utils.ERROR(f"Unknown destination {destination}")
+        elif op == OP_MOV:
+            reg, source = parts[1], parts[2]
+            adr = self.get_register_index(source)
+        elif op in {OP_PUSH, OP_POP}:
+            if len(parts) != 2:
+                utils.ERROR(f"Stack operation needs to have exactly 2 parts: {parts}")
+            reg = parts[1]
+        elif op in {OP_LD, OP_ST} or op in ALU_OPS:
+            reg, adr = parse_register_and_address(mnemonic, parts)
+            if isinstance(adr, str):
+                adr = evaluate(adr)
+
+        self.code_op[address] = op
+        self.code_reg[address] = self.get_register_index(reg) if reg != "-" else 0
+        self.code_adr[address] = adr
+        self.code_mode[address] = MODES.get(address_mode, MODE_OTHER)
+        self.code_mode_names[address] = address_mode
+
+    def decode_counted_loops(self):
+        """
+        Put the counted loops of the program (see loops.py) into arrays
+        indexed by loop start address, `loop_branch` is -1 where none starts
+        """
+
+        height = MEMORY_HEIGHT
+        self.loop_branch = np.full(height, -1, dtype=np.int64)
+        self.loop_reg = np.zeros(height, dtype=np.int64)
+        self.loop_step = np.zeros(height, dtype=np.int64)
+        self.loop_end = np.zeros(height, dtype=np.int64)
+        self.loop_length = np.ones(height, dtype=np.int64)
+        self.loop_cycles = np.zeros(height, dtype=np.int64)  # of an iteration
+
+        loops = find_counted_loops(self.program.memory, self.labels, self.isa)
+        for start, loop in loops.items():
+            if loop.register not in REGISTER_INDICES:
+                continue
+            self.loop_branch[start] = loop.branch
+            self.loop_reg[start] = REGISTER_INDICES[loop.register]
+            self.loop_step[start] = loop.step
+            self.loop_end[start] = loop.end_value
+            self.loop_length[start] = loop.length
+            # every iteration ends with the taken BNE back to the start
+            self.loop_cycles[start] = (
+                self.code_cycles[start : loop.branch + 1].sum() + self.taken_branch_cycles[OP_BNE]
+            )
+
+    @staticmethod
+    def get_register_index(register: str) -> int:
+        if register not in REGISTER_INDICES:
+            utils.ERROR(f"Unknown register {register}")
+        return REGISTER_INDICES[register]
+
+    def reset(self):
+        """
+        Reset all machines to the loaded program
+        """
+
+        n = self.num_machines
+        self.memory = np.tile(self.program_values, (n, 1))
+        self.word_kinds = np.full((n, MEMORY_HEIGHT), WORD_PROGRAM, dtype=np.int8)
+        self.registers = np.zeros((n, NUM_REGISTERS), dtype=np.int64)
+        self.registers[:, SP] = MEMORY_HEIGHT - 1
+        self.flags = np.zeros((n, 4), dtype=np.int64)
+        self.halted = np.zeros(n, dtype=bool)
+        self.failed = np.zeros(n, dtype=bool)
+        self.errors = [None] * n
+        self.instruction_count = np.zeros(n, dtype=np.int64)
+        self.cycle_count = np.zeros(n, dtype=np.int64)
+        self.schedule_inputs([[] for _ in range(n)])
+
+        # the last taken backward branch, see `Machine.check_idle_loop`
+        self.idle_branch = np.full(n, -1, dtype=np.int64)
+        self.idle_state = np.zeros((n, NUM_REGISTERS + 4), dtype=np.int64)
+        self.idle_count = np.zeros(n, dtype=np.int64)
+        self.idle_cycles = np.zeros(n, dtype=np.int64)
+        self.memory_changed = np.zeros(n, dtype=bool)  # since then
+
+    def schedule_inputs(self, events_per_machine: list):
+        """
+        Press keys when the instruction count of a machine is reached.
+        `events_per_machine` holds one list of (instruction count, key name)
+        for every machine, see input_script.py
+        """
+
+        if len(events_per_machine) != self.num_machines:
+            utils.ERROR("Need one list of input events per machine")
+
+        max_events = max([len(events) for events in events_per_machine] + [0])
+        # padding with a count that is never reached
+        self.input_counts = np.full(
+            (self.num_machines, max_events + 1), np.iinfo(np.int64).max, dtype=np.int64
+        )
+        self.input_keys = np.zeros((self.num_machines, max_events + 1), dtype=np.int64)
+
+        for i, events in enumerate(events_per_machine):
+            events = sorted(events, key=lambda event: event[0])
+            for j, (count, key_name) in enumerate(events):
+                self.input_counts[i, j] = count
+                self.input_keys[i, j] = KEY_NUMBERS[key_name.lower()]
+
+        # skip events before the current instruction count
+        self.next_input = (self.input_counts < self.instruction_count[:, None]).sum(axis=1)
+
+    def get_address(self, address_expr):
+        """
+        Return the memory address given by an expression which may use
+        macros and sections, see `Machine.get_address`
+        """
+
+        address_expr = use_macros(address_expr, self.macros)
+        address_expr = use_sections(address_expr, self.sections)
+
+        return evaluate(address_expr)
+
+    def set_memory(self, address: int, values, indices=None):
+        """
+        Store value(s) at `address`, like `Machine.set_memory`.
+        `values` is a single value or one value per machine in `indices`
+        (all machines if not given).
+        """
+
+        if indices is None:
+            indices = np.arange(self.num_machines)
+
+        changed = (self.word_kinds[indices, address] != WORD_STORED) | (
+            self.memory[indices, address] != values
+        )
+        self.memory_changed[np.asarray(indices)[changed]] = True
+
+        self.memory[indices, address] = values
+        self.word_kinds[indices, address] = WORD_STORED
+
+    def fail(self, indices, messages):
+        """
+        Stop machines `indices` with error `messages` (one string or one per machine)
+        """
+
+        if isinstance(messages, str):
+            messages = [messages] * len(indices)
+
+        for i, message in zip(indices, messages):
+            self.failed[i] = True
+            self.errors[i] = message
+
+    def get_running(self) -> np.ndarray:
+        return np.flatnonzero(~(self.halted | self.failed))
+
+    def press_scheduled_keys(self, active: np.ndarray):
+        """
+        Put keys into GR15 of machines whose next input is due
+        """
+
+        while True:
+            next_input = self.next_input[active]
+            due = self.input_counts[active, next_input] <= self.instruction_count[active]
+            if not due.any():
+                return
+            due_machines = active[due]
+            self.registers[due_machines, 15] = self.input_keys[due_machines, next_input[due]]
+            self.next_input[due_machines] += 1
+
+    def wrap_addresses(self, indices, addresses, access="index"):
+        """
+        Python list indexing: -4096..4095 are valid, negative ones wrap.
+        Fail machines with addresses outside with the error of a list
+        `access` ("index" or "assignment index"), return mask of valid ones.
+        """
+
+        valid = (addresses >= -MEMORY_HEIGHT) & (addresses < MEMORY_HEIGHT)
+        if not valid.all():
+            self.fail(indices[~valid], f"IndexError: list {access} out of range")
+
+        return valid, addresses % MEMORY_HEIGHT
+
+    def read_data(self, indices, addresses):
+        """
+        Read numbers from memory like `utils.get_decimal_int` on the words
+        of `Machine`. Fail machines where a word can not be read.
+        Return (mask of machines that succeeded, values)
+        """
+
+        valid, addresses = self.wrap_addresses(indices, addresses)
+
+        kinds = self.word_kinds[indices, addresses]
+        values = self.memory[indices, addresses]
+        readable = np.where(
+            kinds == WORD_PROGRAM,
+            self.program_numeric[addresses],
+            # negative values become unparsable binary strings in `Machine`
+            (kinds == WORD_PUSHED) | (values >= 0),
+        )
+
+        unreadable = valid & ~readable
+        if unreadable.any():
+            self.fail(
+                indices[unreadable],
+                [
+                    f"Could not parse memory word at address {a}"
+                    for a in addresses[unreadable]
+                ],
+            )
+
+        return valid & readable, values
+
+    def write_data(self, indices, addresses, values, kind):
+        valid, wrapped = self.wrap_addresses(indices, addresses, "assignment index")
+        indices, wrapped, values = indices[valid], wrapped[valid], values[valid]
+
+        # like `Machine.mark_memory_change`, negative addresses always count
+        changed = (
+            (self.word_kinds[indices, wrapped] != kind)
+            | (self.memory[indices, wrapped] != values)
+            | (addresses[valid] < 0)
+        )
+        self.memory_changed[indices[changed]] = True
+
+        self.memory[indices, wrapped] = values
+        self.word_kinds[indices, wrapped] = kind
+        return valid
+
+    def pop(self, indices):
+        """
+        Pop the top of the stack of machines `indices`.
+        Return (mask of machines that succeeded, values)
+        """
+
+        self.registers[indices, SP] += 1
+        sp = self.registers[indices, SP]
+
+        valid, sp = self.wrap_addresses(indices, sp)
+        pushed = self.word_kinds[indices, sp] == WORD_PUSHED
+        not_pushed = valid & ~pushed
+        if not_pushed.any():
+            self.fail(indices[not_pushed], "Popped a word that was not pushed")
+
+        return valid & pushed, self.memory[indices, sp]
+
+    def fail_too_large(self, indices, values) -> np.ndarray:
+        """
+        Fail machines whose value does not fit in 24 bits if limits are
+        checked, return mask of the others
+        """
+
+        fits = values <= MAX_VALUE
+        if self.check_limits and not fits.all():
+            self.fail(
+                indices[~fits],
+                [f"Value {v} is too large for 24-bit register" for v in values[~fits]],
+            )
+            return fits
+
+        return np.ones(len(indices), dtype=bool)
+
+    def push(self, indices, values):
+        if self.check_limits:
+            sp = self.registers[indices, SP]
+            into_section = (sp >= 0) & self.in_section[sp % MEMORY_HEIGHT]
+            if into_section.any():
+                self.fail(
+                    indices[into_section],
+                    [
+                        f"Stack pointer {p} ran into section "
+                        f"{self.program.get_section_at(p).name}"
+                        for p in sp[into_section]
+                    ],
+                )
+                ok = ~into_section
+                ok[ok] = self.push(indices[ok], values[ok])
+                return ok
+
+        valid = self.write_data(
+            indices, self.registers[indices, SP], values, WORD_PUSHED
+        )
+        self.registers[indices[valid], SP] -= 1
+        return valid
+
+    def step(self, max_counts=None, skipping=None) -> int:
+        """
+        Execute the next instruction of all running machines whose
+        instruction count is below `max_counts` (one per machine, no limit
+        if not given). Then machines in `skipping` (a mask, all if not
+        given) skip the idle or counted loop they just branched back to, up
+        to `max_counts` or their next scheduled keypress, like `Machine.run`.
+        The others go on like `Machine.execute_next_instruction`.
+        Return number of machines that executed an instruction.
+        """
+
+        active = self.get_running()
+        if max_counts is not None:
+            active = active[self.instruction_count[active] < max_counts[active]]
+        if not active.size:
+            return 0
+
+        self.press_scheduled_keys(active)
+
+        pc = self.registers[active, PC]
+        ops = self.code_op[pc]
+        kinds = self.word_kinds[active, pc]
+        ops[kinds != WORD_PROGRAM] = OP_OVERWRITTEN
+        # a pushed 0 is an empty instruction in `Machine`
+        ops[(kinds == WORD_PUSHED) & (self.memory[active, pc] == 0)] = OP_EMPTY
+
+        # fetching an empty word fails before the PC is incremented
+        empty = ops == OP_EMPTY
+        if empty.any():
+            self.fail(active[empty], [f"Empty instruction at line {p}" for p in pc[empty]])
+
+        self.registers[active[~empty], PC] += 1
+
+        succeeded = ~empty
+        for op in np.unique(ops[~empty]):
+            in_group = ops == op
+            group_succeeded = self.execute(op, active[in_group], pc[in_group])
+            succeeded[in_group] = group_succeeded
+
+        self.instruction_count[active[succeeded]] += 1
+        # counted when fetched, like `Machine`, also if the instruction fails.
+        # Overwritten words are data to the cycle model, 0 cycles.
+        cycles = np.where(kinds == WORD_PROGRAM, self.code_cycles[pc], 0)
+        self.cycle_count[active[~empty]] += cycles[~empty]
+
+        backward = succeeded & IS_BRANCH[ops] & (self.registers[active, PC] <= pc)
+        if backward.any():
+            self.skip_loops(active[backward], pc[backward], max_counts, skipping)
+
+        return int(succeeded.sum())
+
+    def skip_loops(self, indices, pc, max_counts, skipping):
+        """
+        Machines `indices` took the backward branch at `pc`. Find the ones
+        in an idle loop (see `check_idle_loops`), skip whole periods of it
+        like `Machine.skip_idle_periods` and jump over counted loops like
+        `Machine.skip_counted_loop`, up to the limits of `step`.
+        """
+
+        limits = self.input_counts[indices, self.next_input[indices]]
+        if max_counts is not None:
+            limits = np.minimum(limits, max_counts[indices])
+        may_skip = np.ones(len(indices), dtype=bool) if skipping is None else skipping[indices]
+
+        idle = np.zeros(len(indices), dtype=bool)
+        if self.detect_idle_loops:
+            idle, periods, period_cycles = self.check_idle_loops(indices, pc)
+
+            skip = idle & may_skip & (limits != NO_INPUT)
+            if skip.any():
+                counts = self.instruction_count[indices[skip]]
+                num_periods = np.maximum((limits[skip] - counts) // periods[skip], 0)
+                self.instruction_count[indices[skip]] += num_periods * periods[skip]
+                self.cycle_count[indices[skip]] += num_periods * period_cycles[skip]
+
+        if self.skip_counted_loops:
+            counted = ~idle & may_skip
+            counted[counted] = self.loop_branch[self.registers[indices[counted], PC]] == pc[counted]
+            if counted.any():
+                self.skip_counted_loop(indices[counted], limits[counted])
+
+    def check_idle_loops(self, indices, pc):
+        """
+        Like `Machine.check_idle_loop` for machines `indices` after a taken
+        backward branch at `pc`: the machines whose last backward branch
+        was the same one, with the same registers and flags and no memory
+        word changed since, are in an idle loop.
+        Return (mask of those, their periods in instructions and cycles)
+        """
+
+        state = np.concatenate([self.registers[indices], self.flags[indices]], axis=1)
+        counts = self.instruction_count[indices]
+        cycles = self.cycle_count[indices]
+
+        idle = (
+            (self.idle_branch[indices] == pc)
+            & (self.idle_state[indices] == state).all(axis=1)
+            & ~self.memory_changed[indices]
+        )
+        periods = counts - self.idle_count[indices]
+        period_cycles = cycles - self.idle_cycles[indices]
+
+        self.idle_branch[indices] = pc
+        self.idle_state[indices] = state
+        self.idle_count[indices] = counts
+        self.idle_cycles[indices] = cycles
+        self.memory_changed[indices] = False
+
+        return idle, periods, period_cycles
+
+    def skip_counted_loop(self, indices, limits):
+        """
+        Jump machines `indices`, just branched back to the start of a counted
+        loop, over its iterations up to `limits`, like
+        `Machine.skip_counted_loop`
+        """
+
+        start = self.registers[indices, PC]
+        branch = self.loop_branch[start]
+        length = self.loop_length[start]
+
+        # the loop must not be overwritten
+        offsets = np.arange(3)
+        addresses = np.minimum(start[:, None] + offsets, MEMORY_HEIGHT - 1)
+        intact = (
+            (self.word_kinds[indices[:, None], addresses] == WORD_PROGRAM)
+            | (offsets >= length[:, None])
+        ).all(axis=1)
+
+        reg = self.loop_reg[start]
+        step = self.loop_step[start]
+        end_value = self.loop_end[start]
+        value = self.registers[indices, reg]
+
+        # see `CountedLoop.iterations_left`
+        distance = end_value - value
+        nonzero_step = np.where(step == 0, 1, step)
+        iterations = np.where(
+            step == 0,
+            np.where(distance == 0, 1, 0),
+            np.where(distance % nonzero_step == 0, distance // nonzero_step, 0),
+        )
+        if self.check_limits:
+            intact &= end_value <= MAX_VALUE  # fails in the last iteration
+
+        bounded = limits != NO_INPUT
+        counts = self.instruction_count[indices]
+        iterations[bounded] = np.minimum(
+            iterations[bounded], (limits[bounded] - counts[bounded]) // length[bounded]
+        )
+
+        skip = intact & (iterations > 0)
+        indices, start, branch, iterations = indices[skip], start[skip], branch[skip], iterations[skip]
+        reg, step, end_value, value = reg[skip], step[skip], end_value[skip], value[skip]
+
+        self.instruction_count[indices] += iterations * self.loop_length[start]
+        self.cycle_count[indices] += iterations * self.loop_cycles[start]
+        self.registers[indices, reg] = value + iterations * step
+
+        # the loop ended, Z was set and the branch not taken
+        ended = self.registers[indices, reg] == end_value
+        self.flags[indices[ended], Z] = 1
+        self.registers[indices[ended], PC] = branch[ended] + 1
+        self.cycle_count[indices[ended]] -= self.taken_branch_cycles[OP_BNE]
+
+    def execute(self, op, indices, pc) -> np.ndarray:
+        """
+        Execute instruction `op` for machines `indices` with instructions
+        at addresses `pc`. Return mask of machines that succeeded.
+        """
+
+        reg = self.code_reg[pc]
+        adr = self.code_adr[pc]
+        ok = np.ones(len(indices), dtype=bool)
+
+        if op == OP_INVALID or op == OP_OVERWRITTEN:
+            messages = []
+            for p in pc:
+                if op == OP_INVALID:
+                    messages.append(self.decode_errors[p])
+                else:
+                    messages.append(f"Unknown operation in overwritten word at line {p}")
+            self.fail(indices, messages)
+            return ~ok
+        elif op == OP_HALT:
+            self.halted[indices] = True
+        elif op == OP_BRA:
+            self.registers[indices, PC] = adr
+        elif op == OP_BNE or op == OP_BEQ:
+            taken = self.flags[indices, Z] == (1 if op == OP_BEQ else 0)
+            self.registers[indices[taken], PC] = adr[taken]
+            self.cycle_count[indices[taken]] += self.taken_branch_cycles[op]
+        elif op == OP_JSR:
+            ok = self.push(indices, self.registers[indices, PC])
+            self.registers[indices[ok], PC] = adr[ok]
+        elif op == OP_RET:
+            ok, values = self.pop(indices)
+            self.registers[indices[ok], PC] = values[ok]
+        elif op == OP_MOV:
+            self.registers[indices, reg] = self.registers[indices, adr]
+            self.flags[indices, Z] = self.registers[indices, reg] == 0
+        elif op == OP_PUSH:
+            ok = self.push(indices, self.registers[indices, reg])
+        elif op == OP_POP:
+            ok, values = self.pop(indices)
+            self.registers[indices[ok], reg[ok]] = values[ok]
+        elif op == OP_LD:
+            ok = self.execute_load(indices, pc, reg, adr)
+        elif op == OP_ST:
+            ok = self.execute_store(indices, pc, reg, adr)
+        else:
+            ok = self.execute_alu(op, indices, pc, reg, adr)
+
+        return ok
+
+    def get_operand_addresses(self, indices, pc, adr):
+        """
+        Effective addresses of direct and indexed operands
+        """
+
+        indexed = self.code_mode[pc] == MODE_INDEXED
+        return np.where(indexed, self.registers[indices, 3] + adr, adr)
+
+    def fail_unknown_modes(self, indices, pc, known_mask, message):
+        unknown = ~known_mask
+        if unknown.any():
+            self.fail(
+                indices[unknown],
+                [message.format(mode=self.code_mode_names[p]) for p in pc[unknown]],
+            )
+        return known_mask
+
+    def execute_load(self, indices, pc, reg, adr):
+        mode = self.code_mode[pc]
+        ok = self.fail_unknown_modes(
+            indices, pc, mode != MODE_OTHER, "Unknown address mode {mode}"
+        )
+
+        from_memory = ok & (mode != MODE_IMMEDIATE)
+        values = adr.copy()
+        read_ok, read_values = self.read_data(
+            indices[from_memory],
+            self.get_operand_addresses(indices[from_memory], pc[from_memory], adr[from_memory]),
+        )
+        values[from_memory] = read_values
+        ok[from_memory] = read_ok
+        ok[ok] = self.fail_too_large(indices[ok], values[ok])
+
+        self.registers[indices[ok], reg[ok]] = values[ok]
+        return ok
+
+    def execute_store(self, indices, pc, reg, adr):
+        mode = self.code_mode[pc]
+        # other address modes do nothing in `Machine`
+        stores = (mode == MODE_DIRECT) | (mode == MODE_INDEXED)
+
+        ok = np.ones(len(indices), dtype=bool)
+        ok[stores] = self.write_data(
+            indices[stores],
+            self.get_operand_addresses(indices[stores], pc[stores], adr[stores]),
+            self.registers[indices[stores], reg[stores]],
+            WORD_STORED,
+        )
+        return ok
+
+    def execute_alu(self, op, indices, pc, reg, adr):
+        mode = self.code_mode[pc]
+        ok = self.fail_unknown_modes(
+            indices,
+            pc,
+            (mode == MODE_DIRECT) | (mode == MODE_IMMEDIATE),
+            "UnboundLocalError: value of address mode {mode} is not defined",
+        )
+
+        direct = ok & (mode == MODE_DIRECT)
+        values = adr.copy()
+        read_ok, read_values = self.read_data(indices[direct], adr[direct])
+        values[direct] = read_values
+        ok[direct] = read_ok
+
+        indices, reg, values = indices[ok], reg[ok], values[ok]
+        current = self.registers[indices, reg]
+
+        if op == OP_ADD:
+            result = current + values
+        elif op == OP_SUB or op == OP_CMP:
+            result = current - values
+        elif op == OP_AND:
+            result = current & values
+        elif op == OP_OR:
+            result = current | values
+        elif op == OP_MUL:
+            result = current * values
+        elif op == OP_LSR or op == OP_LSL:
+            negative = values < 0
+            if negative.any():
+                self.fail(indices[negative], "ValueError: negative shift count")
+                ok[np.flatnonzero(ok)[negative]] = False
+                indices, reg, values, current = (
+                    indices[~negative],
+                    reg[~negative],
+                    values[~negative],
+                    current[~negative],
+                )
+            result = current >> values if op == OP_LSR else current << values
+
+        self.flags[indices, Z] = result == 0
+
+        if op != OP_CMP:
+            fits = self.fail_too_large(indices, result)
+            ok[np.flatnonzero(ok)[~fits]] = False
+            self.registers[indices[fits], reg[fits]] = result[fits]
+
+        return ok
+
+    def run(self, num_steps: int) -> int:
+        """
+        Step all machines `num_steps` times, stop early if none is running.
+        Return the number of steps taken.
+        """
+
+        for i in range(num_steps):
+            if not self.step():
+                return i
+
+        return num_steps
+
+    def get_registers(self, i: int) -> dict:
+        return {name: int(v) for name, v in zip(REGISTER_NAMES, self.registers[i])}
+
+    def get_flags(self, i: int) -> dict:
+        return {name: int(v) for name, v in zip(FLAG_NAMES, self.flags[i])}
+
+    def get_memory_words(self, i: int) -> list:
+        """
+        Return the memory of machine `i` as the words `Machine` would hold
+        """
+
+        words = list(self.program.memory)
+        for address in np.flatnonzero(self.word_kinds[i] != WORD_PROGRAM):
+            value = int(self.memory[i, address])
+            if self.word_kinds[i, address] == WORD_STORED:
+                words[address] = f"0b{value:024b}"
+            else:
+                words[address] = value
+
+        return words
@@ -0,0 +1,127 @@
+"""
+Watch the source files of a program, the main file and everything it
+includes, and hot reload it into a running machine when one of them is
+saved (see `Machine.hot_reload`): code edits take effect at once, without
+playing back up to the same point again.
+
+Files are polled by their modification time and size, a few stat calls
+per poll, so no extra packages are needed and editors that replace files
+on save are noticed too.
+
+    python emulate.py path.s --watch
+"""
+
+import asyncio
+import os
+
+from utils import COLORS
+from program import Program
+from masm_ir import MASM_DIR, get_include
+
+POLL_INTERVAL_S = 0.25
+
+
+def get_source_files(asm_file_name: str, masm_dir: str = MASM_DIR) -> list:
+    """
+    Return the paths of `asm_file_name` and all files it includes
+    (recursively), each once
+    """
+
+    paths = []
+    file_names = [asm_file_name]
+    while file_names:
+        path = os.path.join(masm_dir, file_names.pop(0))
+        if path in paths:
+            continue
+        paths.append(path)
+
+        try:
+            source_lines = open(path).readlines()
+        except FileNotFoundError:
+            continue  # reported when the program is loaded
+        file_names += [
+            file_name for file_name in map(get_include, source_lines) if file_name is not None
+        ]
+
+    return paths
+
+
+class FileWatcher:
+    """
+    Notice changes of a set of files by polling
+    """
+
+    def __init__(self, paths: list):
+        self.set_paths(paths)
+
+    def set_paths(self, paths: list):
+        self.paths = list(paths)
+        self.stamps = {path: self.get_stamp(path) for path in self.paths}
+
+    @staticmethod
+    def get_stamp(path: str):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self) -> list:
+        """
+        Return the paths changed (or removed) since the last poll
+        """
+
+        changed = []
+        for path in self.paths:
+            stamp = self.get_stamp(path)
+            if stamp != self.stamps[path]:
+                self.stamps[path] = stamp
+                changed.append(path)
+
+        return changed
+
+
+def reload_program(machine, asm_file_name: str, masm_dir: str = MASM_DIR):
+    """
+    Load `asm_file_name` again and hot reload it into `machine`.
+    Errors in the changed source are printed, the machine runs on.
+    """
+
+    try:
+        program = Program.from_file(asm_file_name, masm_dir, machine.isa)
+    except Exception as e:
+        print(f"{COLORS.FAIL}Not reloaded, {type(e).__name__}: {e}{COLORS.ENDC}")
+        return
+
+    patched = machine.hot_reload(program)
+    if patched is None:
+        print(
+            f"{COLORS.WARNING}Reloaded {asm_file_name}{COLORS.ENDC}: layout changed, "
+            "reset with unchanged sections kept"
+        )
+    else:
+        print(f"{COLORS.OKGREEN}Reloaded {asm_file_name}{COLORS.ENDC}: {patched} words patched")
+
+
+async def watch_program(
+    machine, asm_file_name: str, masm_dir: str = MASM_DIR, interval: float = POLL_INTERVAL_S
+):
+    """
+    Hot reload `asm_file_name` into `machine` whenever one of its files
+    changes, forever
+    """
+
+    watcher = FileWatcher(get_source_files(asm_file_name, masm_dir))
+    print(f"Watching {', '.join(os.path.basename(path) for path in watcher.paths)}")
+
+    while True:
+        await asyncio.sleep(interval)
+        if not watcher.poll():
+            continue
+
+        reload_program(machine, asm_file_name, masm_dir)
+
+        # includes may have been added or removed
+        paths = get_source_files(asm_file_name, masm_dir)
+        if paths != watcher.paths:
+            watcher.set_paths(paths)
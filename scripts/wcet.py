@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+"""
+Static best and worst case cycle counts of an assembled program, per
+subroutine and per loop iteration, from the cycle costs of the microcode
+(see cycle_model.py).
+
+    python wcet.py <file.s | pMem.vhd | image.bin> [--loop <label>]
+
+Every JSR target (and address 0) is the entry of a routine. The control
+flow graph of a routine follows its branches but not its calls, a JSR
+costs its own cycles plus those of the called routine. Loops are the
+natural loops of the graph (a branch back to an instruction that
+dominates it), analysed innermost first. A loop runs its body at most
+`bound` times:
+- annotated on the first instruction of the loop or a branch back to it,
+  e.g. `BRA balloon_animation // bound: 4`
+- or inferred for simple counters, a register set with LDI before the
+  loop, stepped once every iteration with ADDI/SUBI and tested by the
+  BNE back to the loop, with CMPI before it or after the step to 0:
+
+      LDI GR0, 2
+  delay_loop:
+      SUBI GR0, 1
+      BNE delay_loop
+
+Loops without a bound, like waiting for a key, make everything around
+them unbounded. Best cases take annotated loops once.
+
+The report ends with one iteration of the main loop (`loop` of path.s
+by default) against the clock cycles of one VGA frame, derived from
+vga_motor.vhd.
+"""
+
+import math, os, re, sys
+
+import utils
+from utils import COLORS, ERROR
+from binary_machine import Image, IMMEDIATE, WORD_MASK, ADDRESS_MASK
+from cycle_model import get_cycle_table
+from microcode import UNDEFINED
+
+VGA_FILE = os.path.join(utils.ROOT_DIR, "hardware", "vga_motor.vhd")
+DEFAULT_LOOP = "loop"
+BOUND_PATTERN = re.compile(r"\bbound:\s*(\d+)")
+MAX_INIT_DISTANCE = 32  # instructions searched back for the LDI of a counter
+
+INF = math.inf
+NO_PATH = (INF, -INF)  # (best, worst) of no path at all
+
+
+def add(path: tuple, cost: tuple) -> tuple:
+    """
+    Return the (best, worst) cycles of `path` followed by `cost`
+    """
+
+    if path == NO_PATH or cost == NO_PATH:
+        return NO_PATH
+    return path[0] + cost[0], path[1] + cost[1]
+
+
+def either(a: tuple, b: tuple) -> tuple:
+    """
+    Return the (best, worst) cycles of taking path `a` or path `b`
+    """
+
+    return min(a[0], b[0]), max(a[1], b[1])
+
+
+def format_cycles(cycles) -> str:
+    if cycles == INF:
+        return "unbounded"
+    if cycles == -INF:
+        return "-"
+    return f"{cycles:,}"
+
+
+class Loop:
+    """
+    Represent a natural loop, all branches back to one header
+    """
+
+    def __init__(self, header: int, body: set, branches: list):
+        self.header = header
+        self.body = body
+        self.branches = branches  # addresses of the branches back to the header
+        self.bound = None  # (min, max) runs of the body, None if unknown
+        self.bound_source = ""
+        self.iteration = NO_PATH  # from the header back to it
+        self.exit = NO_PATH  # from the header out of the loop, in the last run
+        self.total = NO_PATH
+
+
+class Routine:
+    """
+    Represent a subroutine and the loops of its control flow graph
+    """
+
+    def __init__(self, entry: int):
+        self.entry = entry
+        self.nodes = set()
+        self.calls = set()
+        self.paths = {}  # (header, address) -> paths found by Analysis.walk
+        self.loops = {}  # header -> Loop
+        self.cycles = NO_PATH  # from the entry to RET or HALT
+        self.error = None
+
+
+class Analysis:
+    """
+    Analyse the machine code of an image
+    """
+
+    def __init__(self, image: Image, isa: dict = None):
+        self.image = image
+        self.memory = image.memory
+        self.isa = isa if isa is not None else utils.get_mnemonics()
+        self.mnemonics = {int(opcode, 2): mnemonic for mnemonic, opcode in self.isa.items()}
+        self.cycle_table = get_cycle_table()
+        self.names = {}
+        for label, address in sorted(image.labels.items(), key=lambda item: -len(item[0])):
+            self.names[address] = label
+        self.routines = {}
+        self.in_progress = set()  # routines being analysed, to find recursion
+
+    def get_name(self, address: int) -> str:
+        return self.names.get(address, str(address))
+
+    def decode(self, address: int) -> tuple:
+        """
+        Return (mnemonic, GRx, mode, ADR) of the instruction at `address`
+        """
+
+        word = self.memory[address]
+        return (
+            self.mnemonics.get(word >> 19 & 0b11111),
+            word >> 15 & 0b1111,
+            word >> 13 & 0b11,
+            word & ADDRESS_MASK,
+        )
+
+    def get_immediate(self, address: int) -> int:
+        return self.memory[address + 1 & ADDRESS_MASK] & WORD_MASK
+
+    def get_successors(self, address: int) -> list:
+        """
+        Return (address, extra cycles of the edge) of all instructions that
+        can follow the one at `address`, without following JSR
+        """
+
+        mnemonic, _, mode, adr = self.decode(address)
+        opcode = self.memory[address] >> 19 & 0b11111
+        next_address = address + (2 if mode == IMMEDIATE else 1) & ADDRESS_MASK
+
+        if mnemonic in {"RET", "HALT"} or self.cycle_table.opcodes[opcode] == UNDEFINED:
+            return []  # LSL has no microprogram and stops the machine
+        if mnemonic == "SWAP":
+            ERROR(f"SWAP at {address} jumps to a computed address")
+        if mnemonic == "BRA":
+            return [(adr, 0)]
+        if mnemonic in {"BNE", "BEQ"}:
+            return [(next_address, 0), (adr, self.cycle_table.taken[opcode])]
+
+        return [(next_address, 0)]
+
+    def get_node_cycles(self, address: int) -> tuple:
+        """
+        Return the (best, worst) cycles of the instruction at `address`,
+        with the routine it calls
+        """
+
+        cycles = self.cycle_table.get_word_cycles(self.memory[address])
+        mnemonic, _, _, adr = self.decode(address)
+        if mnemonic != "JSR":
+            return cycles, cycles
+
+        callee = self.analyse_routine(adr)
+        if callee.cycles == NO_PATH:
+            return INF, INF  # never returns
+        return add((cycles, cycles), callee.cycles)
+
+    def analyse_routine(self, entry: int) -> Routine:
+        """
+        Return the analysed routine starting at `entry`
+        """
+
+        if entry in self.routines:
+            return self.routines[entry]
+
+        routine = Routine(entry)
+        if entry in self.in_progress:
+            routine.error = "recursive"
+            routine.cycles = (0, INF)
+            return routine
+
+        self.in_progress.add(entry)
+        try:
+            self.find_nodes(routine)
+            self.find_loops(routine)
+            for loop in sorted(routine.loops.values(), key=lambda loop: len(loop.body)):
+                self.analyse_loop(routine, loop)
+            routine.cycles = self.walk(routine, entry, routine.nodes, None)[2]
+        except Exception as e:
+            routine.error = str(e)
+            routine.cycles = (0, INF)
+        finally:
+            self.in_progress.discard(entry)
+
+        self.routines[entry] = routine
+        return routine
+
+    def find_nodes(self, routine: Routine):
+        routine.successors = {}
+        stack = [routine.entry]
+        while stack:
+            address = stack.pop()
+            if address in routine.nodes:
+                continue
+            routine.nodes.add(address)
+
+            mnemonic, _, _, adr = self.decode(address)
+            if mnemonic is None:
+                ERROR(f"Word at {address} is no instruction")
+            if mnemonic == "JSR":
+                routine.calls.add(adr)
+
+            routine.successors[address] = self.get_successors(address)
+            stack += [successor for successor, _ in routine.successors[address]]
+
+        routine.predecessors = {address: [] for address in routine.nodes}
+        for address, successors in routine.successors.items():
+            for successor, _ in successors:
+                routine.predecessors[successor].append(address)
+
+    def find_dominators(self, routine: Routine) -> dict:
+        """
+        Return address -> set of addresses that dominate it
+        """
+
+        dominators = {address: set(routine.nodes) for address in routine.nodes}
+        dominators[routine.entry] = {routine.entry}
+
+        changed = True
+        while changed:
+            changed = False
+            for address in routine.nodes - {routine.entry}:
+                predecessors = routine.predecessors[address]
+                new = set.intersection(*(dominators[p] for p in predecessors)) | {address}
+                if new != dominators[address]:
+                    dominators[address] = new
+                    changed = True
+
+        return dominators
+
+    def find_loops(self, routine: Routine):
+        routine.dominators = self.find_dominators(routine)
+
+        for address, successors in routine.successors.items():
+            for header, _ in successors:
+                if header not in routine.dominators[address]:
+                    continue  # not a branch back
+
+                # the body reaches the branch without passing the header
+                body = {header}
+                stack = [address]
+                while stack:
+                    node = stack.pop()
+                    if node not in body:
+                        body.add(node)
+                        stack += routine.predecessors[node]
+
+                if header in routine.loops:
+                    routine.loops[header].body |= body
+                    routine.loops[header].branches.append(address)
+                else:
+                    routine.loops[header] = Loop(header, body, [address])
+
+        for loop in routine.loops.values():
+            loop.bound, loop.bound_source = self.find_bound(routine, loop)
+
+    def find_bound(self, routine: Routine, loop: Loop) -> tuple:
+        """
+        Return ((min, max) runs of the body, "annotated" or "inferred"),
+        (None, "") if the loop has no bound
+        """
+
+        for address in [loop.header] + loop.branches:
+            match = BOUND_PATTERN.search(self.image.lines[address])
+            if match:
+                return (1, int(match.group(1))), "annotated"
+
+        runs = self.infer_counter(routine, loop)
+        if runs is not None:
+            return (runs, runs), "inferred"
+
+        return None, ""
+
+    def get_written_registers(self, address: int, routine: Routine = None) -> set:
+        """
+        Return the registers the instruction at `address` may write,
+        with the routine it calls
+        """
+
+        mnemonic, grx, _, adr = self.decode(address)
+        if mnemonic in {"LD", "ADD", "SUB", "AND", "OR", "LSR", "MUL", "POP", "MOV"}:
+            return {grx}
+        if mnemonic == "JSR":
+            callee = self.analyse_routine(adr)
+            return set().union(*(self.get_written_registers(a) for a in callee.nodes))
+        return set()
+
+    def infer_counter(self, routine: Routine, loop: Loop):
+        """
+        Return the runs of the body of a counted loop, None if it is none
+        """
+
+        if len(loop.branches) != 1:
+            return None
+        branch = loop.branches[0]
+        if self.decode(branch)[0] != "BNE" or len(routine.predecessors[branch]) != 1:
+            return None
+
+        # the test: CMPI GRx, end or the step itself
+        test = routine.predecessors[branch][0]
+        mnemonic, register, mode, _ = self.decode(test)
+        if mnemonic == "CMP" and mode == IMMEDIATE:
+            end = self.get_immediate(test)
+        elif mnemonic in {"ADD", "SUB"} and mode == IMMEDIATE:
+            end = 0
+        else:
+            return None
+
+        # exactly one write of the register, a step done every iteration
+        writes = [a for a in loop.body if register in self.get_written_registers(a)]
+        if len(writes) != 1 or writes[0] not in routine.dominators[branch]:
+            return None
+        mnemonic, _, mode, _ = self.decode(writes[0])
+        if mnemonic not in {"ADD", "SUB"} or mode != IMMEDIATE:
+            return None
+        step = self.get_immediate(writes[0])
+        if mnemonic == "SUB":
+            step = -step
+
+        # the LDI before the loop
+        entries = [p for p in routine.predecessors[loop.header] if p not in loop.body]
+        if len(entries) != 1:
+            return None
+        address = entries[0]
+        for _ in range(MAX_INIT_DISTANCE):
+            if register in self.get_written_registers(address):
+                mnemonic, _, mode, _ = self.decode(address)
+                if mnemonic != "LD" or mode != IMMEDIATE:
+                    return None
+                start = self.get_immediate(address)
+                if step == 0 or (end - start) % step != 0 or (end - start) // step < 1:
+                    return None
+                return (end - start) // step
+            if len(routine.predecessors[address]) != 1:
+                return None
+            address = routine.predecessors[address][0]
+
+        return None
+
+    def analyse_loop(self, routine: Routine, loop: Loop):
+        _, loop.iteration, loop.exit = self.walk(routine, loop.header, loop.body, loop.header)
+
+        if loop.bound is None:
+            runs = (1, INF)
+        else:
+            runs = loop.bound
+
+        if loop.exit == NO_PATH:
+            loop.total = (INF, INF)  # never leaves
+            return
+
+        best = loop.exit[0] + (runs[0] - 1) * loop.iteration[0] if runs[0] > 1 else loop.exit[0]
+        worst = loop.exit[1] + (runs[1] - 1) * loop.iteration[1] if runs[1] > 1 else loop.exit[1]
+        loop.total = (best, worst)
+
+    def walk(self, routine: Routine, address: int, region: set, header) -> tuple:
+        """
+        Return (address, (best, worst) back to `header`, (best, worst) out
+        of `region`) of the paths from `address`, with its own cycles. The
+        loops inside `region` are taken as a whole.
+        """
+
+        key = (header, address)
+        if key in routine.paths:
+            if routine.paths[key] is None:
+                ERROR(f"Control flow at {self.get_name(address)} is not structured")
+            return routine.paths[key]
+        routine.paths[key] = None  # in progress
+
+        back, out = NO_PATH, NO_PATH
+
+        inner = routine.loops.get(address)
+        if inner is not None and address != header and inner.body <= region:
+            # a loop inside the region, continue where it is left
+            cost = inner.total
+            exits = {
+                successor
+                for node in inner.body
+                for successor, _ in routine.successors[node]
+                if successor not in inner.body
+            }
+            if any(not routine.successors[node] for node in inner.body):
+                out = either(out, cost)  # RET or HALT in the loop
+            for successor in exits:
+                back, out = self.follow(routine, cost, successor, region, header, back, out)
+        else:
+            cost = self.get_node_cycles(address)
+            if not routine.successors[address]:
+                out = cost
+            for successor, extra in routine.successors[address]:
+                edge_cost = add(cost, (extra, extra))
+                back, out = self.follow(routine, edge_cost, successor, region, header, back, out)
+
+        routine.paths[key] = (address, back, out)
+        return routine.paths[key]
+
+    def follow(self, routine, cost, successor, region, header, back, out) -> tuple:
+        """
+        Return `back` and `out` with the paths going on to `successor`
+        """
+
+        if successor == header:
+            return either(back, cost), out
+        if successor not in region:
+            return back, either(out, cost)
+
+        _, successor_back, successor_out = self.walk(routine, successor, region, header)
+        return either(back, add(cost, successor_back)), either(out, add(cost, successor_out))
+
+    def analyse(self) -> list:
+        """
+        Analyse the routine at 0 and all routines it calls, return them
+        """
+
+        self.analyse_routine(0)
+        return sorted(self.routines.values(), key=lambda routine: routine.entry)
+
+
+def get_frame_cycles(vga_file: str = VGA_FILE) -> tuple:
+    """
+    Return (cycles of the CPU clock per VGA frame, description) from the
+    pixel counters and the clock divider of vga_motor.vhd
+    """
+
+    source = open(vga_file).read()
+    x_match = re.search(r"IF \(x_subpixel = (\d+)\)", source)
+    y_match = re.search(r"IF \(y_subpixel = (\d+)\)", source)
+    divider_match = re.search(r"ClkDiv\s*:\s*unsigned\((\d+) DOWNTO 0\)", source)
+    if not (x_match and y_match and divider_match):
+        ERROR(f"Pixel counters or clock divider not found in {vga_file}")
+
+    width, height = int(x_match.group(1)) + 1, int(y_match.group(1)) + 1
+    divider = 2 ** (int(divider_match.group(1)) + 1)
+
+    return width * height * divider, f"{width} x {height} pixels, {divider} cycles each"
+
+
+def load_image(file_name: str) -> Image:
+    """
+    Load an assembled image, assembling a .s file from the masm
+    directory in memory
+    """
+
+    if file_name.endswith((".vhd", ".bin")):
+        return Image.from_file(file_name)
+
+    from preassemble import preassemble
+    import assembler
+
+    sections, labels, words = assembler.assemble(preassemble(file_name))
+    memory = assembler.get_image(sections, words)
+    memory += [0] * (assembler.PMEM_HEIGHT - len(memory))
+    lines = [""] * assembler.PMEM_HEIGHT
+    for name, section in sections.items():
+        for i, (_, comment) in enumerate(words[name]):
+            lines[section.start + i] = comment
+
+    return Image(memory, labels, sections, lines)
+
+
+def main():
+    utils.change_dir_to_root()
+
+    if len(sys.argv) < 2:
+        ERROR("Usage: python wcet.py <file.s | pMem.vhd | image.bin> [--loop <label>]")
+    file_name = sys.argv[1]
+    loop_label = utils.get_arg_value(sys.argv, "--loop", DEFAULT_LOOP)
+
+    analysis = Analysis(load_image(file_name))
+    routines = analysis.analyse()
+
+    print(f"{COLORS.BOLD}{file_name}{COLORS.ENDC}: {len(routines)} routines")
+    print(f"{'routine':<28} {'address':>7} {'best':>10} {'worst':>10}")
+    for routine in routines:
+        best, worst = routine.cycles
+        if routine.cycles == NO_PATH:
+            best, worst = -INF, -INF
+            note = "  never returns"
+        elif routine.error:
+            note = f"  {COLORS.WARNING}{routine.error}{COLORS.ENDC}"
+        else:
+            note = ""
+        print(
+            f"{analysis.get_name(routine.entry):<28} {routine.entry:>7} "
+            f"{format_cycles(best):>10} {format_cycles(worst):>10}{note}"
+        )
+
+    print()
+    print(f"{'loop':<28} {'address':>7} {'bound':>15} {'iteration best':>15} {'worst':>10}")
+    for routine in routines:
+        for loop in sorted(routine.loops.values(), key=lambda loop: loop.header):
+            bound = f"{loop.bound[1]} {loop.bound_source}" if loop.bound else "none"
+            print(
+                f"{analysis.get_name(loop.header):<28} {loop.header:>7} {bound:>15} "
+                f"{format_cycles(loop.iteration[0]):>15} {format_cycles(loop.iteration[1]):>10}"
+            )
+
+    frame_cycles, frame_description = get_frame_cycles()
+    print()
+    print(f"VGA frame: {frame_cycles:,} cycles ({frame_description})")
+
+    main_loops = [
+        loop
+        for routine in routines
+        for loop in routine.loops.values()
+        if loop.header == analysis.image.labels.get(loop_label)
+    ]
+    if not main_loops:
+        print(f"No loop at label {loop_label}")
+        return
+
+    best, worst = main_loops[0].iteration
+    if worst == INF:
+        print(f"One iteration of {loop_label} is unbounded, annotate its inner loops")
+    elif worst <= frame_cycles:
+        print(
+            f"{COLORS.OKGREEN}One iteration of {loop_label} fits in a frame{COLORS.ENDC}: "
+            f"{format_cycles(best)} to {format_cycles(worst)} cycles, "
+            f"{worst / frame_cycles:.1%} of a frame at worst"
+        )
+    else:
+        print(
+            f"{COLORS.FAIL}One iteration of {loop_label} does not fit in a frame{COLORS.ENDC}: "
+            f"{format_cycles(best)} to {format_cycles(worst)} cycles, "
+            f"{worst / frame_cycles:.1f} frames at worst"
+        )
+
+
+if __name__ == "__main__":
+    main()